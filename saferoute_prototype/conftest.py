@@ -0,0 +1,108 @@
+import json
+import os
+import random
+import time
+
+import pytest
+
+from road_graph import load_overpass_json
+
+# Grid spacing in degrees (~110 m)
+GRID_STEP = 0.001
+GRID_ORIGIN = (40.0, -74.0)
+
+
+def grid_point(row: int, col: int):
+    return [GRID_ORIGIN[0] + row * GRID_STEP, GRID_ORIGIN[1] + col * GRID_STEP]
+
+
+def grid_dump(size: int) -> dict:
+    """Overpass-style dump of a size x size street grid: "Row <i>" ways run east-west,
+    "Column <j>" ways north-south, crossing at shared node ids."""
+    elements = []
+    for i in range(size):
+        for name, cells in ((f'Row {i}', [(i, j) for j in range(size)]),
+                            (f'Column {i}', [(j, i) for j in range(size)])):
+            elements.append({
+                'type': 'way', 'id': len(elements) + 1,
+                'tags': {'highway': 'residential', 'name': name},
+                'nodes': [r * size + c + 1 for r, c in cells],
+                'geometry': [dict(zip(('lat', 'lon'), grid_point(r, c))) for r, c in cells],
+            })
+    return {'elements': elements}
+
+
+def street_dump(size: int, seed: int) -> dict:
+    """A grid with jittered intersections and some one-way rows and columns, so that
+    shortest paths are mostly unique and not symmetric."""
+    rng = random.Random(seed)
+    data = grid_dump(size)
+    jitter = {}
+    for way in data['elements']:
+        for ref, pt in zip(way['nodes'], way['geometry']):
+            dlat, dlon = jitter.setdefault(ref, (rng.uniform(-3e-4, 3e-4), rng.uniform(-3e-4, 3e-4)))
+            pt['lat'] += dlat
+            pt['lon'] += dlon
+        if rng.random() < 0.3:
+            way['tags']['oneway'] = rng.choice(('yes', '-1'))
+    return data
+
+
+@pytest.fixture(scope='session')
+def grid_graph():
+    return load_overpass_json(grid_dump(10))
+
+
+ADMIN_TOKEN = 'test-admin-token'
+
+
+@pytest.fixture(scope='session')
+def api(tmp_path_factory):
+    """saferoute_api on the 10 x 10 grid, scratch databases and stub upstreams (loadtest's),
+    as a TestClient (``.module`` the API module, ``.stub`` the upstream stub server). The module
+    is imported once per session: its state carries across tests."""
+    from loadtest import Recordings, StubServer
+
+    tmp = tmp_path_factory.mktemp('api')
+    graph_path = tmp / 'grid.json'
+    graph_path.write_text(json.dumps(grid_dump(10)))
+    south, west = grid_point(0, 0)
+    north, east = grid_point(9, 9)
+    stub = StubServer(0, Recordings(), region=(south, west, north, east)).start()
+    env = dict(stub.env(), SAFEROUTE_ROAD_GRAPH=str(graph_path), SAFEROUTE_DB=str(tmp / 'sos.db'),
+               SAFEROUTE_ADMIN_TOKEN=ADMIN_TOKEN, SAFEROUTE_HUB='')
+    saved = {k: os.environ.get(k) for k in env}
+    os.environ.update(env)
+    try:
+        from fastapi.testclient import TestClient
+        import saferoute_api
+        with TestClient(saferoute_api.app) as client:
+            client.module = saferoute_api
+            client.stub = stub
+            yield client
+    finally:
+        stub.shutdown()
+        for k, v in saved.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+
+
+def wait_for(predicate, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError('condition not reached')
+        time.sleep(0.02)
+
+
+def post_hazard(client, hazard_id: str, points, hazard_type: str = 'flooded', name=None, status=None):
+    """Push one GeoJSON hazard through POST /admin/hazards ([lat, lon] points)."""
+    props = {'id': hazard_id, 'hazard_type': hazard_type, 'name': name}
+    if status:
+        props['status'] = status
+    feature = {'type': 'Feature', 'properties': props,
+               'geometry': {'type': 'LineString', 'coordinates': [[p[1], p[0]] for p in points]}}
+    r = client.post('/admin/hazards', content=json.dumps(feature), headers={'X-Admin-Token': ADMIN_TOKEN})
+    assert r.status_code == 202, r.text
@@ -0,0 +1,501 @@
+"""
+Contraction hierarchy (CH) and hub labels over the local road graph.
+
+Built offline and saved to a memory-mapped file next to the road network:
+    python contraction.py build [road_network.json] [road_network.ch]
+
+Preprocessing contracts the nodes one by one (fewest added shortcuts first,
+lazily re-evaluated) and adds a shortcut u -> w past a contracted node v
+only when a bounded witness search finds no path at least as short around
+v. Every node then gets a forward and a backward hub label: the nodes its
+upward CH search settles without being stalled, with their distances. The
+distance between s and t is the minimum over the hubs common to the forward
+label of s and the backward label of t, so a query is one merge of two
+sorted arrays of a few dozen entries, and the route is the hub's parent
+chain with its shortcuts unpacked.
+
+Everything is built on hazard-free lengths. Hazard penalties only make
+edges more expensive, so under penalties:
+  * the label route is still optimal if none of its edges is penalised (the
+    usual case: hazards are local), and
+  * otherwise the route is an A* over the penalised graph whose heuristic is
+    the exact hazard-free distance to the target, read from the labels,
+    which is admissible and consistent and keeps the search on the detour.
+So the index never needs rebuilding when hazards change.
+
+Labels grow with the extract: a city is tens of MB; for a whole county,
+build from a smaller extract or expect a few hundred MB (shared by every
+worker through the page cache).
+"""
+
+import array
+import bisect
+import heapq
+import math
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+INF = math.inf
+MAGIC = b'SRCH'
+FORMAT_VERSION = 1
+BYTE_ORDER_MARK = 0x01020304
+# magic, version, byte order mark, graph checksum, nodes, edges, up arcs, down arcs, label entries (fwd, bwd);
+# native byte order like the arrays, so the byte order mark catches an index from the other endianness
+_HEADER = struct.Struct('=4sIIIqqqqqq')
+# Nodes a witness search may settle before giving up (and adding the shortcut)
+WITNESS_SETTLE_LIMIT = 60
+
+
+def graph_checksum(graph) -> int:
+    """CRC of the graph's topology and lengths, to refuse an index built for another extract."""
+    crc = zlib.crc32(memoryview(graph.offsets).cast('B'))
+    crc = zlib.crc32(memoryview(graph.targets).cast('B'), crc)
+    return zlib.crc32(memoryview(graph.lengths).cast('B'), crc)
+
+
+def _sections(n: int, up: int, down: int, fwd: int, bwd: int) -> List[Tuple[str, str, int]]:
+    """(name, typecode, length) of every array in the file, in file order."""
+    sections = []
+    for prefix, arcs in (('up', up), ('down', down)):
+        sections += [(f'{prefix}_offsets', 'i', n + 1), (f'{prefix}_head', 'i', arcs), (f'{prefix}_weight', 'd', arcs),
+                     (f'{prefix}_first', 'i', arcs), (f'{prefix}_second', 'i', arcs)]
+    for prefix, entries in (('fwd', fwd), ('bwd', bwd)):
+        sections += [(f'{prefix}_offsets', 'q', n + 1), (f'{prefix}_hub', 'i', entries),
+                     (f'{prefix}_dist', 'd', entries), (f'{prefix}_parent', 'i', entries)]
+    return sections
+
+
+class ContractionHierarchy:
+    """Query side of an index file, bound to the RoadGraph it was built from.
+
+    Arcs, CSR by node u: ``up_*`` are arcs u -> head to higher ranked nodes,
+    ``down_*`` are arcs head -> u arriving from higher ranked nodes. A
+    shortcut past v is the down arc ``*_first`` of v followed by the up arc
+    ``*_second`` of v; road edges have -1 there.
+
+    Labels, CSR by node: ``fwd_*`` (from the node) and ``bwd_*`` (to the
+    node) list hub, distance and the hub's parent in the search, sorted by hub.
+    """
+
+    def __init__(self, graph, arrays: Dict[str, object], mm: Optional[mmap.mmap] = None):
+        self.graph = graph
+        self._mm = mm
+        for name, value in arrays.items():
+            setattr(self, name, value)
+        self.queries = 0
+        self.detours = 0
+
+    @property
+    def num_arcs(self) -> int:
+        return len(self.up_head) + len(self.down_head)
+
+    def _meet(self, s: int, t: int) -> Tuple[float, int]:
+        """(distance, hub) from the forward label of ``s`` and the backward label of ``t``."""
+        f_hub, f_dist, b_hub, b_dist = self.fwd_hub, self.fwd_dist, self.bwd_hub, self.bwd_dist
+        i, i_end = self.fwd_offsets[s], self.fwd_offsets[s + 1]
+        j, j_end = self.bwd_offsets[t], self.bwd_offsets[t + 1]
+        best, hub = INF, -1
+        while i < i_end and j < j_end:
+            x, y = f_hub[i], b_hub[j]
+            if x == y:
+                d = f_dist[i] + b_dist[j]
+                if d < best:
+                    best, hub = d, x
+                i += 1
+                j += 1
+            elif x < y:
+                i += 1
+            else:
+                j += 1
+        return best, hub
+
+    def distance(self, source: int, target: int) -> float:
+        """Hazard-free road distance (metres), inf if unreachable."""
+        return 0.0 if source == target else self._meet(source, target)[0]
+
+    def _chain(self, node: int, hub: int, forward: bool) -> List[int]:
+        """Nodes from ``hub`` back to ``node`` along the parents in node's label."""
+        offsets, hubs, parents = (self.fwd_offsets, self.fwd_hub, self.fwd_parent) if forward else \
+            (self.bwd_offsets, self.bwd_hub, self.bwd_parent)
+        lo, hi = offsets[node], offsets[node + 1]
+        chain = [hub]
+        while chain[-1] != node:
+            k = bisect.bisect_left(hubs, chain[-1], lo, hi)
+            chain.append(parents[k])
+        return chain
+
+    def _unpack(self, arc: int, up: bool, out: List[int]):
+        """Append the road nodes an arc passes through, excluding where it starts."""
+        stack = [(arc, up)]
+        while stack:
+            i, up = stack.pop()
+            first = self.up_first[i] if up else self.down_first[i]
+            if first < 0:
+                # an up arc ends at its head, a down arc at the node it is stored under
+                out.append(self.up_head[i] if up else bisect.bisect_right(self.down_offsets, i) - 1)
+                continue
+            stack.append((self.up_second[i] if up else self.down_second[i], True))
+            stack.append((first, False))
+
+    def _arc(self, offsets, heads, node: int, head: int) -> int:
+        for i in range(offsets[node], offsets[node + 1]):
+            if heads[i] == head:
+                return i
+        raise KeyError((node, head))
+
+    def path(self, source: int, target: int) -> Optional[Tuple[List[int], float]]:
+        """Hazard-free (node path, cost) between two graph nodes, or None."""
+        self.queries += 1
+        if source == target:
+            return [source], 0.0
+        best, hub = self._meet(source, target)
+        if hub < 0:
+            return None
+        nodes = [source]
+        climb = self._chain(source, hub, True)
+        for x, p in zip(climb[-2::-1], climb[:0:-1]):
+            self._unpack(self._arc(self.up_offsets, self.up_head, p, x), True, nodes)
+        descent = self._chain(target, hub, False)
+        for x, p in zip(descent, descent[1:]):
+            self._unpack(self._arc(self.down_offsets, self.down_head, p, x), False, nodes)
+        return nodes, best
+
+    def _penalised(self, nodes: List[int], penalties: Dict[int, float]) -> bool:
+        """Does the road edge taken by any step of ``nodes`` carry a penalty?"""
+        offsets, targets, lengths = self.graph.offsets, self.graph.targets, self.graph.lengths
+        for u, v in zip(nodes, nodes[1:]):
+            best_e, best = -1, INF
+            for e in range(offsets[u], offsets[u + 1]):
+                if targets[e] == v and lengths[e] < best:
+                    best_e, best = e, lengths[e]
+            if best_e in penalties:
+                return True
+        return False
+
+    def shortest_path(self, source: int, target: int,
+                      penalties: Optional[Dict[int, float]] = None) -> Optional[Tuple[List[int], float]]:
+        """Same contract as RoadGraph.shortest_path."""
+        found = self.path(source, target)
+        if found is None or not penalties or not self._penalised(found[0], penalties):
+            return found
+        self.detours += 1
+        return self._astar(source, target, penalties)
+
+    def _astar(self, source: int, target: int, penalties: Dict[int, float]) -> Optional[Tuple[List[int], float]]:
+        """A* over the penalised road graph with exact hazard-free distances as the heuristic."""
+        offsets, targets, lengths = self.graph.offsets, self.graph.targets, self.graph.lengths
+        f_offsets, f_hub, f_dist = self.fwd_offsets, self.fwd_hub, self.fwd_dist
+        lo, hi = self.bwd_offsets[target], self.bwd_offsets[target + 1]
+        to_target = dict(zip(self.bwd_hub[lo:hi], self.bwd_dist[lo:hi]))
+
+        def h(v: int) -> float:
+            best = INF
+            for k in range(f_offsets[v], f_offsets[v + 1]):
+                d = to_target.get(f_hub[k])
+                if d is not None and f_dist[k] + d < best:
+                    best = f_dist[k] + d
+            return best
+
+        h0 = 0.0 if source == target else h(source)
+        if h0 == INF:
+            return None
+        dist = {source: 0.0}
+        prev: Dict[int, int] = {}
+        heap = [(h0, 0.0, source)]
+        while heap:
+            _, g, u = heapq.heappop(heap)
+            if u == target:
+                break
+            if g > dist[u]:
+                continue
+            for e in range(offsets[u], offsets[u + 1]):
+                w = lengths[e]
+                mult = penalties.get(e)
+                if mult is not None:
+                    if mult == INF:
+                        continue
+                    w *= mult
+                v = targets[e]
+                ng = g + w
+                if ng < dist.get(v, INF):
+                    hv = 0.0 if v == target else h(v)
+                    if hv == INF:
+                        continue
+                    dist[v] = ng
+                    prev[v] = u
+                    heapq.heappush(heap, (ng + hv, ng, v))
+        else:
+            return None
+        path = [target]
+        while path[-1] != source:
+            path.append(prev[path[-1]])
+        path.reverse()
+        return path, dist[target]
+
+    def route_between(self, src: int, dst: int,
+                      penalties: Optional[Dict[int, float]] = None) -> Optional[List[List[float]]]:
+        """Same contract as RoadGraph.route_between."""
+        found = self.shortest_path(src, dst, penalties)
+        if found is None:
+            return None
+        lats, lons = self.graph.lats, self.graph.lons
+        return [[lats[n], lons[n]] for n in found[0]]
+
+    def stats(self) -> dict:
+        n = max(1, self.graph.num_nodes)
+        return {
+            'arcs': self.num_arcs,
+            'avg_label': round((len(self.fwd_hub) + len(self.bwd_hub)) / (2 * n), 1),
+            'queries': self.queries,
+            'hazard_detours': self.detours,
+        }
+
+
+# --- preprocessing ---
+def _witness(out: List[Dict[int, float]], source: int, avoid: int, limit: float) -> Dict[int, float]:
+    """Distances from ``source`` in the remaining graph without ``avoid``, up to ``limit``."""
+    dist = {source: 0.0}
+    heap = [(0.0, source)]
+    settled = 0
+    while heap:
+        d, u = heapq.heappop(heap)
+        if d > dist[u]:
+            continue
+        if d > limit or settled >= WITNESS_SETTLE_LIMIT:
+            break
+        settled += 1
+        for v, w in out[u].items():
+            if v == avoid:
+                continue
+            nd = d + w
+            if nd < dist.get(v, INF):
+                dist[v] = nd
+                heapq.heappush(heap, (nd, v))
+    return dist
+
+
+def _shortcuts(out: List[Dict[int, float]], inn: List[Dict[int, float]], v: int) -> List[Tuple[int, int, float]]:
+    """Shortcuts (u, w, weight) needed to contract ``v`` now."""
+    needed = []
+    outs = out[v]
+    if not outs:
+        return needed
+    max_out = max(outs.values())
+    for u, w_in in inn[v].items():
+        dist = _witness(out, u, v, w_in + max_out)
+        for w, w_out in outs.items():
+            if w != u and dist.get(w, INF) > w_in + w_out:
+                needed.append((u, w, w_in + w_out))
+    return needed
+
+
+def _contract(graph):
+    """Contract every node; returns per-node up / down arc lists of
+    (head, weight, (v, first, second) or None) with positions local to v."""
+    n = graph.num_nodes
+    offsets, targets, lengths = graph.offsets, graph.targets, graph.lengths
+    # remaining graph, parallel edges collapsed to the shortest; via[(u, w)] for shortcuts
+    out: List[Dict[int, float]] = [{} for _ in range(n)]
+    inn: List[Dict[int, float]] = [{} for _ in range(n)]
+    via: Dict[Tuple[int, int], Tuple[int, int, int]] = {}
+    for u in range(n):
+        for e in range(offsets[u], offsets[u + 1]):
+            v = targets[e]
+            if v != u and lengths[e] < out[u].get(v, INF):
+                out[u][v] = inn[v][u] = lengths[e]
+    deleted_neighbours = [0] * n
+    level = [0] * n
+
+    def priority(v: int) -> int:
+        # edge difference, plus contracted neighbours and depth to spread contraction evenly
+        return 2 * (len(_shortcuts(out, inn, v)) - len(out[v]) - len(inn[v])) + deleted_neighbours[v] + level[v]
+
+    heap = [(priority(v), v) for v in range(n)]
+    heapq.heapify(heap)
+    up: List[list] = [[] for _ in range(n)]
+    down: List[list] = [[] for _ in range(n)]
+    contracted = bytearray(n)
+    while heap:
+        _, v = heapq.heappop(heap)
+        if contracted[v]:
+            continue
+        current = priority(v)
+        if heap and current > heap[0][0]:
+            # lazy update: its priority went up since it was queued
+            heapq.heappush(heap, (current, v))
+            continue
+        shortcuts = _shortcuts(out, inn, v)
+        contracted[v] = 1
+        # every remaining neighbour ranks above v
+        up_pos, down_pos = {}, {}
+        for w, weight in out[v].items():
+            up_pos[w] = len(up[v])
+            up[v].append((w, weight, via.get((v, w))))
+            del inn[w][v]
+            deleted_neighbours[w] += 1
+            level[w] = max(level[w], level[v] + 1)
+        for u, weight in inn[v].items():
+            down_pos[u] = len(down[v])
+            down[v].append((u, weight, via.get((u, v))))
+            del out[u][v]
+            deleted_neighbours[u] += 1
+            level[u] = max(level[u], level[v] + 1)
+        for u, w, weight in shortcuts:
+            if weight < out[u].get(w, INF):
+                out[u][w] = inn[w][u] = weight
+                via[(u, w)] = (v, down_pos[u], up_pos[w])
+        out[v] = {}
+        inn[v] = {}
+    return up, down
+
+
+def _label(ch: ContractionHierarchy, s: int, forward: bool) -> List[Tuple[int, float, int]]:
+    """(hub, distance, parent) for every node the upward search from ``s`` settles unstalled."""
+    if forward:
+        out_off, out_head, out_w = ch.up_offsets, ch.up_head, ch.up_weight
+        in_off, in_head, in_w = ch.down_offsets, ch.down_head, ch.down_weight
+    else:
+        out_off, out_head, out_w = ch.down_offsets, ch.down_head, ch.down_weight
+        in_off, in_head, in_w = ch.up_offsets, ch.up_head, ch.up_weight
+    dist = {s: 0.0}
+    parent = {s: -1}
+    heap = [(0.0, s)]
+    label = []
+    while heap:
+        d, u = heapq.heappop(heap)
+        if d > dist[u]:
+            continue
+        # stall-on-demand: a higher node reaches u more cheaply, so u is no hub of s
+        if any(in_head[i] in dist and dist[in_head[i]] + in_w[i] < d for i in range(in_off[u], in_off[u + 1])):
+            continue
+        label.append((u, d, parent[u]))
+        for i in range(out_off[u], out_off[u + 1]):
+            v = out_head[i]
+            nd = d + out_w[i]
+            if nd < dist.get(v, INF):
+                dist[v] = nd
+                parent[v] = u
+                heapq.heappush(heap, (nd, v))
+    label.sort()
+    return label
+
+
+def build(graph) -> ContractionHierarchy:
+    """Contract ``graph`` and label every node (offline; a minute for a town, longer for a county)."""
+    n = graph.num_nodes
+    up, down = _contract(graph)
+    arrays = {}
+    for prefix, lists in (('up', up), ('down', down)):
+        arrays[f'{prefix}_offsets'] = offs = array.array('i', [0])
+        for arcs in lists:
+            offs.append(offs[-1] + len(arcs))
+    for prefix, lists in (('up', up), ('down', down)):
+        heads, weights, firsts, seconds = array.array('i'), array.array('d'), array.array('i'), array.array('i')
+        for arcs in lists:
+            for head, weight, shortcut in arcs:
+                heads.append(head)
+                weights.append(weight)
+                if shortcut is None:
+                    firsts.append(-1)
+                    seconds.append(-1)
+                else:
+                    v, first, second = shortcut
+                    firsts.append(arrays['down_offsets'][v] + first)
+                    seconds.append(arrays['up_offsets'][v] + second)
+        arrays.update({f'{prefix}_head': heads, f'{prefix}_weight': weights,
+                       f'{prefix}_first': firsts, f'{prefix}_second': seconds})
+    ch = ContractionHierarchy(graph, arrays)
+    for prefix, forward in (('fwd', True), ('bwd', False)):
+        offs, hubs, dists, parents = array.array('q', [0]), array.array('i'), array.array('d'), array.array('i')
+        for s in range(n):
+            for hub, d, parent in _label(ch, s, forward):
+                hubs.append(hub)
+                dists.append(d)
+                parents.append(parent)
+            offs.append(len(hubs))
+        for name, values in (('offsets', offs), ('hub', hubs), ('dist', dists), ('parent', parents)):
+            setattr(ch, f'{prefix}_{name}', values)
+    return ch
+
+
+def save(ch: ContractionHierarchy, path: str):
+    counts = (ch.graph.num_nodes, len(ch.up_head), len(ch.down_head), len(ch.fwd_hub), len(ch.bwd_hub))
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, BYTE_ORDER_MARK, graph_checksum(ch.graph),
+                             counts[0], ch.graph.num_edges, *counts[1:]))
+        for name, typecode, length in _sections(*counts):
+            values = getattr(ch, name)
+            assert len(values) == length, name
+            f.write(b'\0' * (-f.tell() % 8))
+            f.write(memoryview(values).cast('B'))
+    os.replace(tmp, path)
+
+
+def load(path: str, graph) -> Optional[ContractionHierarchy]:
+    """Map the index at ``path``; None when it is missing, truncated or was built for a different graph."""
+    if graph is None or not path or not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError) as e:
+        # ValueError: an empty file cannot be mapped
+        print(f"[contraction] {path}: cannot map ({e}), routing with A*")
+        return None
+    try:
+        ch = _open(path, mm, graph)
+    except (ValueError, TypeError, struct.error) as e:
+        print(f"[contraction] {path}: unreadable index ({e}), routing with A*")
+        ch = None
+    if ch is None:
+        mm.close()
+    return ch
+
+
+def _open(path: str, mm: mmap.mmap, graph) -> Optional[ContractionHierarchy]:
+    if len(mm) < _HEADER.size:
+        print(f"[contraction] {path}: truncated, routing with A*")
+        return None
+    magic, version, bom, checksum, n, m, up, down, fwd, bwd = _HEADER.unpack_from(mm, 0)
+    if magic != MAGIC or version != FORMAT_VERSION or bom != BYTE_ORDER_MARK:
+        print(f"[contraction] {path}: unsupported index format, routing with A*")
+        return None
+    if (n, m) != (graph.num_nodes, graph.num_edges) or checksum != graph_checksum(graph):
+        print(f"[contraction] {path} was built for another road network, routing with A*")
+        return None
+    # check every array fits before any view is taken: mm can only be closed while none is exported
+    bounds = []
+    pos = _HEADER.size
+    for name, typecode, length in _sections(n, up, down, fwd, bwd):
+        pos += -pos % 8
+        size = length * array.array(typecode).itemsize
+        bounds.append((name, typecode, pos, pos + size))
+        pos += size
+    if pos > len(mm):
+        print(f"[contraction] {path}: truncated, routing with A*")
+        return None
+    view = memoryview(mm)
+    arrays = {name: view[start:end].cast(typecode) for name, typecode, start, end in bounds}
+    return ContractionHierarchy(graph, arrays, mm)
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1] == 'build':
+        from road_graph import load_road_graph
+        src = sys.argv[2] if len(sys.argv) > 2 else 'road_network.json'
+        out_path = sys.argv[3] if len(sys.argv) > 3 else os.path.splitext(src)[0] + '.ch'
+        g = load_road_graph(src)
+        if g is None:
+            sys.exit(f"No road network at {src}")
+        started = time.time()
+        built = build(g)
+        save(built, out_path)
+        print(f"Saved {out_path}: {g.num_nodes} nodes, {built.num_arcs} arcs, "
+              f"{built.stats()['avg_label']} hubs per label in {time.time() - started:.1f}s")
+    else:
+        print(__doc__)
@@ -0,0 +1,171 @@
+"""
+In-process event bus behind the /events server-sent-events stream.
+
+Each event is JSON-encoded into its SSE frame once, at publish time, and the
+same bytes object is handed to every subscriber, so fan-out costs one queue
+put per client rather than one encode per client. Subscribers have bounded
+queues: a client that falls behind is not allowed to grow memory, its backlog
+is dropped and replaced by a single ``resync`` event telling it to refetch
+state (e.g. GET /sos with its cursor). Recent frames are kept in a ring so a
+reconnecting EventSource can resume from its Last-Event-ID. Event ids are
+``<epoch>-<n>`` with a random epoch per bus: the counter restarts with every
+process, so a Last-Event-ID from before a restart (or from another worker) gets
+a resync rather than a replay matched against someone else's numbers.
+
+publish() may be called from any thread (the hazard feed applier and the state
+hub threads publish); delivery always happens on the event loop the
+subscribers live on.
+"""
+
+import asyncio
+import itertools
+import json
+import os
+import threading
+from collections import deque
+from typing import Iterable, List, Optional, Set
+
+DEFAULT_QUEUE_SIZE = 256
+DEFAULT_REPLAY = 1024
+# Comment frame sent on idle streams so proxies keep the connection open
+KEEPALIVE_FRAME = b': keepalive\n\n'
+KEEPALIVE_INTERVAL = 15.0
+
+TOPICS = ('sos', 'hazard', 'route')
+# Event type -> topic a subscriber filters on
+EVENT_TOPICS = {'sos': 'sos', 'hazard': 'hazard', 'route_invalidated': 'route'}
+
+
+def client_topic(client_id: str) -> str:
+    """Topic of the events addressed to one client (e.g. its repaired route)."""
+    return f"client:{client_id}"
+
+
+def encode_frame(event_id: str, event: str, data) -> bytes:
+    payload = json.dumps(data, separators=(',', ':'))
+    return f"id: {event_id}\nevent: {event}\ndata: {payload}\n\n".encode()
+
+
+class Subscriber:
+    def __init__(self, topics: Set[str], maxsize: int):
+        self.topics = topics
+        self.queue: "asyncio.Queue[bytes]" = asyncio.Queue(maxsize=maxsize)
+        self.dropped = 0
+
+
+class EventBus:
+    def __init__(self, queue_size: int = DEFAULT_QUEUE_SIZE, replay: int = DEFAULT_REPLAY,
+                 epoch: Optional[str] = None):
+        self.queue_size = queue_size
+        self.epoch = epoch or os.urandom(4).hex()
+        self.published = 0
+        self.resyncs = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._recent: deque = deque(maxlen=replay)  # (sequence number, topic, frame)
+        self._subscribers: List[Subscriber] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def __len__(self) -> int:
+        return len(self._subscribers)
+
+    def _event_id(self, seq: int) -> str:
+        return f"{self.epoch}-{seq}"
+
+    def _sequence(self, event_id: Optional[str]) -> Optional[int]:
+        """Sequence number of an id this bus published; None for another epoch's or a malformed one."""
+        epoch, _, seq = (event_id or '').rpartition('-')
+        return int(seq) if epoch == self.epoch and seq.isdigit() else None
+
+    def publish(self, event: str, data, topic: Optional[str] = None) -> str:
+        """Encode an event once and fan it out to every subscriber of its topic
+        (``topic`` overrides the event's default one, e.g. client_topic(id))."""
+        topic = topic or EVENT_TOPICS.get(event, event)
+        with self._lock:
+            seq = next(self._ids)
+            event_id = self._event_id(seq)
+            frame = encode_frame(event_id, event, data)
+            self._recent.append((seq, topic, frame))
+            self.published += 1
+            loop = self._loop
+        if loop is None or loop.is_closed():
+            return event_id
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._deliver(topic, frame)
+        else:
+            try:
+                loop.call_soon_threadsafe(self._deliver, topic, frame)
+            except RuntimeError:
+                pass  # loop shut down between the check and the call
+        return event_id
+
+    def _deliver(self, topic: str, frame: bytes):
+        for sub in list(self._subscribers):
+            if topic not in sub.topics:
+                continue
+            try:
+                sub.queue.put_nowait(frame)
+            except asyncio.QueueFull:
+                self._resync(sub)
+
+    def _resync(self, sub: Subscriber, reason: str = 'slow consumer'):
+        """Drop a subscriber's backlog in favour of one resync event."""
+        sub.dropped += sub.queue.qsize()
+        while not sub.queue.empty():
+            sub.queue.get_nowait()
+        with self._lock:
+            event_id = self._event_id(next(self._ids))
+            self.resyncs += 1
+        sub.queue.put_nowait(encode_frame(event_id, 'resync', {'reason': reason}))
+
+    def subscribe(self, topics: Optional[Iterable[str]] = None, last_event_id: Optional[str] = None,
+                  client_id: Optional[str] = None) -> Subscriber:
+        """Register a subscriber on the running loop, replaying events after ``last_event_id``
+        (the client's Last-Event-ID, as sent). With a ``client_id`` it also receives the events
+        addressed to that client."""
+        self._loop = asyncio.get_running_loop()
+        sub = Subscriber(set(topics or TOPICS), self.queue_size)
+        if client_id:
+            sub.topics.add(client_topic(client_id))
+        resume = self._sequence(last_event_id)
+        with self._lock:
+            backlog = [] if resume is None else [(topic, frame) for seq, topic, frame in self._recent if seq > resume]
+            self._subscribers.append(sub)
+        if last_event_id and resume is None:
+            # an id from before a restart or from another worker: nothing here follows it
+            self._resync(sub, 'unknown event id')
+        elif resume is not None and self._recent and self._recent[0][0] > resume + 1:
+            # the gap is older than the replay ring: the client has to refetch
+            self._resync(sub, 'missed events')
+        for topic, frame in backlog:
+            if topic in sub.topics:
+                try:
+                    sub.queue.put_nowait(frame)
+                except asyncio.QueueFull:
+                    self._resync(sub)
+                    break
+        return sub
+
+    def unsubscribe(self, sub: Subscriber):
+        with self._lock:
+            if sub in self._subscribers:
+                self._subscribers.remove(sub)
+
+    async def stream(self, sub: Subscriber, keepalive: float = KEEPALIVE_INTERVAL):
+        """Yield SSE frames for a subscriber until the client goes away."""
+        try:
+            yield b'retry: 3000\n\n'
+            while True:
+                try:
+                    yield await asyncio.wait_for(sub.queue.get(), timeout=keepalive)
+                except asyncio.TimeoutError:
+                    yield KEEPALIVE_FRAME
+        finally:
+            self.unsubscribe(sub)
+
+    def stats(self) -> dict:
+        return {'subscribers': len(self._subscribers), 'published': self.published, 'resyncs': self.resyncs}
@@ -0,0 +1,144 @@
+"""
+Persistent geocode cache shared by every uvicorn worker.
+
+Backed by a SQLite file in WAL mode so concurrent workers read without
+blocking each other. Entries are keyed by a normalized address, expire after
+a TTL, and the least recently used ones are evicted once the cache grows past
+``max_entries``. Addresses Nominatim could not resolve are cached as negative
+entries with a shorter TTL so they are not retried on every request.
+
+Expired entries are kept for another ``stale_ttl`` so lookup() can hand
+them out as "stale" while the caller refreshes them (stale-while-revalidate)
+or while Nominatim is unavailable.
+"""
+
+import re
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from metrics import SQLITE_SECONDS
+
+DEFAULT_TTL = 30 * 24 * 3600
+DEFAULT_NEGATIVE_TTL = 3600
+DEFAULT_STALE_TTL = 30 * 24 * 3600
+DEFAULT_MAX_ENTRIES = 50000
+# last_used is only rewritten when older than this, so hits rarely need a write
+_TOUCH_INTERVAL = 300
+
+
+def normalize_address(address: str) -> str:
+    """Case-fold and collapse punctuation/whitespace so trivially different spellings share a key."""
+    key = address.lower().replace('.', '')
+    key = re.sub(r'\s*,\s*', ', ', key)
+    key = re.sub(r'\s+', ' ', key)
+    return key.strip(' ,')
+
+
+class GeocodeCache:
+    def __init__(self, path: str, ttl: float = DEFAULT_TTL, negative_ttl: float = DEFAULT_NEGATIVE_TTL,
+                 max_entries: int = DEFAULT_MAX_ENTRIES, stale_ttl: float = DEFAULT_STALE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.negative_hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._puts = 0
+        conn = self._conn()
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS geocode (
+            key TEXT PRIMARY KEY,
+            lat REAL,
+            lon REAL,
+            expires REAL,
+            last_used REAL
+        )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS geocode_last_used ON geocode (last_used)')
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _count(self, attr: str):
+        with self._stats_lock:
+            setattr(self, attr, getattr(self, attr) + 1)
+
+    def get(self, address: str) -> Tuple[bool, Optional[List[float]]]:
+        """Return (found, coords). A negative entry is (True, None); a miss is (False, None)."""
+        state, coords = self.lookup(address)
+        return (True, coords) if state == 'fresh' else (False, None)
+
+    @SQLITE_SECONDS.time(db='geocode', op='get')
+    def lookup(self, address: str) -> Tuple[str, Optional[List[float]]]:
+        """Return (state, coords) with state "fresh", "stale" (expired less than stale_ttl ago) or "miss"."""
+        key = normalize_address(address)
+        now = time.time()
+        conn = self._conn()
+        row = conn.execute('SELECT lat, lon, expires, last_used FROM geocode WHERE key = ?', (key,)).fetchone()
+        if row is None or row[2] < now - self.stale_ttl:
+            self._count('misses')
+            return 'miss', None
+        if now - row[3] > _TOUCH_INTERVAL:
+            conn.execute('UPDATE geocode SET last_used = ? WHERE key = ?', (now, key))
+            conn.commit()
+        coords = [row[0], row[1]] if row[0] is not None else None
+        if row[2] < now:
+            self._count('stale_hits')
+            return 'stale', coords
+        self._count('hits' if coords is not None else 'negative_hits')
+        return 'fresh', coords
+
+    @SQLITE_SECONDS.time(db='geocode', op='put')
+    def put(self, address: str, coords: Optional[List[float]]):
+        """Store a result; ``coords=None`` records a failed lookup."""
+        key = normalize_address(address)
+        now = time.time()
+        ttl = self.ttl if coords is not None else self.negative_ttl
+        lat, lon = (coords[0], coords[1]) if coords is not None else (None, None)
+        conn = self._conn()
+        conn.execute('INSERT OR REPLACE INTO geocode (key, lat, lon, expires, last_used) VALUES (?, ?, ?, ?, ?)',
+                     (key, lat, lon, now + ttl, now))
+        conn.commit()
+        with self._stats_lock:
+            self._puts += 1
+            check = self._puts % 100 == 1
+        if check:
+            self.evict()
+
+    def evict(self):
+        """Drop entries past their stale window, then the least recently used ones beyond max_entries."""
+        conn = self._conn()
+        conn.execute('DELETE FROM geocode WHERE expires < ?', (time.time() - self.stale_ttl,))
+        (size,) = conn.execute('SELECT COUNT(*) FROM geocode').fetchone()
+        if size > self.max_entries:
+            conn.execute('DELETE FROM geocode WHERE key IN (SELECT key FROM geocode ORDER BY last_used LIMIT ?)',
+                         (size - self.max_entries,))
+        conn.commit()
+
+    def stats(self) -> dict:
+        (size,) = self._conn().execute('SELECT COUNT(*) FROM geocode').fetchone()
+        with self._stats_lock:
+            hits, negative_hits, stale_hits, misses = self.hits, self.negative_hits, self.stale_hits, self.misses
+        lookups = hits + negative_hits + stale_hits + misses
+        return {
+            'hits': hits,
+            'negative_hits': negative_hits,
+            'stale_hits': stale_hits,
+            'misses': misses,
+            'hit_ratio': round((hits + negative_hits + stale_hits) / lookups, 3) if lookups else None,
+            'entries': size,
+        }
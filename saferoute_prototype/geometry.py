@@ -0,0 +1,153 @@
+"""
+Geometry helpers shared by the SafeRoute routing modules.
+Coordinates are [lat, lon] pairs in degrees; distances are metres.
+
+The batch kernels (polyline_length_m, haversine_matrix, nearest_index,
+polylines_crossed) use NumPy when it is installed and fall back to the
+scalar functions otherwise.
+"""
+
+import math
+from typing import List, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # scalar fallbacks below still work without NumPy
+    np = None
+
+# Upper bound on route x hazard segment pairs tested per NumPy block
+_PAIR_BLOCK = 1 << 21
+
+EARTH_RADIUS_M = 6371008.8
+
+
+def haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Great-circle distance in metres between two lat/lon points."""
+    p1 = math.radians(lat1)
+    p2 = math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lon2 - lon1)
+    h = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(h)))
+
+
+def seg_intersect(a: Tuple[float,float], b: Tuple[float,float], c: Tuple[float,float], d: Tuple[float,float],
+                  touching: bool = False) -> bool:
+    # Check if segment AB intersects CD using orientation tests
+    # (proper crossings only, unless ``touching``: then shared endpoints, an endpoint on the
+    # other segment and collinear overlaps count too)
+    def orient(p, q, r):
+        return (q[1]-p[1])*(r[0]-q[0]) - (q[0]-p[0])*(r[1]-q[1])
+    def on_segment(p, q, r):
+        return min(p[0], q[0]) <= r[0] <= max(p[0], q[0]) and min(p[1], q[1]) <= r[1] <= max(p[1], q[1])
+    p, q, r, s = a, b, c, d
+    o1 = orient(p,q,r)
+    o2 = orient(p,q,s)
+    o3 = orient(r,s,p)
+    o4 = orient(r,s,q)
+    if o1*o2 < 0 and o3*o4 < 0:
+        return True
+    if touching:
+        return ((o1 == 0 and on_segment(p, q, r)) or (o2 == 0 and on_segment(p, q, s)) or
+                (o3 == 0 and on_segment(r, s, p)) or (o4 == 0 and on_segment(r, s, q)))
+    return False
+
+
+def point_segment_dist_m(p: Tuple[float,float], a: Tuple[float,float], b: Tuple[float,float]) -> float:
+    """Approximate distance in metres from point p to segment ab (local equirectangular projection)."""
+    kx = 111320.0 * math.cos(math.radians(p[0]))
+    ky = 110574.0
+    ax, ay = (a[1]-p[1])*kx, (a[0]-p[0])*ky
+    bx, by = (b[1]-p[1])*kx, (b[0]-p[0])*ky
+    dx, dy = bx-ax, by-ay
+    seg2 = dx*dx + dy*dy
+    t = 0.0 if seg2 == 0 else max(0.0, min(1.0, -(ax*dx + ay*dy) / seg2))
+    return math.hypot(ax + t*dx, ay + t*dy)
+
+
+
+# --- Batch kernels ---
+def polyline_length_m(poly: Sequence[Sequence[float]]) -> float:
+    """Length in metres of a [lat, lon] polyline."""
+    if len(poly) < 2:
+        return 0.0
+    if np is None:
+        return sum(haversine_m(poly[i][0], poly[i][1], poly[i+1][0], poly[i+1][1]) for i in range(len(poly)-1))
+    pts = np.radians(np.asarray(poly, dtype=float))
+    lat, lon = pts[:, 0], pts[:, 1]
+    h = np.sin(np.diff(lat) / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2
+    return float(np.sum(2 * EARTH_RADIUS_M * np.arcsin(np.minimum(1.0, np.sqrt(h)))))
+
+
+def haversine_matrix(a: Sequence[Sequence[float]], b: Sequence[Sequence[float]]):
+    """All-pairs great-circle distances (metres) between point lists a (n) and b (m), as n x m."""
+    if np is None:
+        return [[haversine_m(p[0], p[1], q[0], q[1]) for q in b] for p in a]
+    pa = np.radians(np.asarray(a, dtype=float).reshape(-1, 2))
+    pb = np.radians(np.asarray(b, dtype=float).reshape(-1, 2))
+    lat1, lon1 = pa[:, 0:1], pa[:, 1:2]
+    lat2, lon2 = pb[:, 0], pb[:, 1]
+    h = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.minimum(1.0, np.sqrt(h)))
+
+
+def nearest_index(points: Sequence[Sequence[float]], lat: float, lon: float) -> Tuple[int, float]:
+    """(index, distance in metres) of the point closest to lat/lon; (-1, inf) if there are none."""
+    if len(points) == 0:
+        return -1, math.inf
+    if np is None:
+        dists = [haversine_m(lat, lon, p[0], p[1]) for p in points]
+        i = min(range(len(dists)), key=dists.__getitem__)
+        return i, dists[i]
+    d = haversine_matrix([[lat, lon]], points)[0]
+    i = int(np.argmin(d))
+    return i, float(d[i])
+
+
+def polylines_crossed(route: Sequence[Sequence[float]], hazards: List[Sequence[Sequence[float]]]) -> List[bool]:
+    """For each hazard polyline, whether any of its segments properly crosses the route.
+
+    Same strict orientation test as seg_intersect, evaluated for every
+    route segment x hazard segment pair at once in bbox-pruned blocks.
+    """
+    if np is None or len(route) < 2:
+        return [any(seg_intersect(tuple(route[i]), tuple(route[i+1]), tuple(h[j]), tuple(h[j+1]))
+                    for i in range(len(route)-1) for j in range(len(h)-1)) for h in hazards]
+    owners = []
+    segs = []
+    for k, h in enumerate(hazards):
+        if len(h) >= 2:
+            hp = np.asarray(h, dtype=float)
+            segs.append(np.stack([hp[:-1], hp[1:]], axis=1))
+            owners.append(np.full(len(hp) - 1, k))
+    crossed = np.zeros(len(hazards), dtype=bool)
+    if not segs:
+        return crossed.tolist()
+    hz = np.concatenate(segs)
+    owner = np.concatenate(owners)
+    R, S = hz[:, 0], hz[:, 1]
+    hz_lo = np.minimum(R, S)
+    hz_hi = np.maximum(R, S)
+    rp = np.asarray(route, dtype=float)
+    P_all, Q_all = rp[:-1], rp[1:]
+    # consecutive route segments are spatially coherent, so blocks have tight bboxes
+    rows = max(1, _PAIR_BLOCK // len(hz))
+    for start in range(0, len(P_all), rows):
+        P, Q = P_all[start:start+rows], Q_all[start:start+rows]
+        lo = np.minimum(P, Q).min(axis=0)
+        hi = np.maximum(P, Q).max(axis=0)
+        keep = np.all((hz_hi >= lo) & (hz_lo <= hi), axis=1) & ~crossed[owner]
+        if not keep.any():
+            continue
+        r, s_, own = R[keep], S[keep], owner[keep]
+        p0, p1 = P[:, 0:1], P[:, 1:2]
+        q0, q1 = Q[:, 0:1], Q[:, 1:2]
+        o1 = (q1 - p1) * (r[:, 0] - q0) - (q0 - p0) * (r[:, 1] - q1)
+        o2 = (q1 - p1) * (s_[:, 0] - q0) - (q0 - p0) * (s_[:, 1] - q1)
+        o3 = (s_[:, 1] - r[:, 1]) * (p0 - s_[:, 0]) - (s_[:, 0] - r[:, 0]) * (p1 - s_[:, 1])
+        o4 = (s_[:, 1] - r[:, 1]) * (q0 - s_[:, 0]) - (s_[:, 0] - r[:, 0]) * (q1 - s_[:, 1])
+        hit = ((o1 * o2 < 0) & (o3 * o4 < 0)).any(axis=0)
+        crossed[own[hit]] = True
+        if crossed.all():
+            break
+    return crossed.tolist()
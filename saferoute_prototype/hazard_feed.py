@@ -0,0 +1,704 @@
+"""
+Streaming hazard feed ingestion.
+
+Hazard updates arrive as GeoJSON (one Feature or FeatureCollection per line)
+or as CAP 1.2 alerts (XML documents) from a followed file, a listening TCP /
+Unix socket, or POST /admin/hazards. Reader threads parse and validate each
+record into HazardUpdate objects and push them onto a bounded queue (a slow
+applier back-pressures the producers instead of growing memory). One applier
+thread drains the queue in batches of up to MAX_BATCH updates, or whatever
+arrived within BATCH_WINDOW of the first one, so an update waits at most
+about BATCH_WINDOW before it is live. Per batch, HazardSet coalesces updates
+per hazard id, drops stale and duplicate ones, snaps the new geometry to
+road-graph edges and derives the edge penalties incrementally; the API then
+commits the whole batch under one hazard_version bump.
+
+GeoJSON coordinates are [lon, lat]; properties used: ``id`` (or the feature
+id), ``hazard_type`` (flooded / fire / powerline / blocked, common aliases
+accepted), ``name``, ``status`` ("cleared" / "cancelled" removes the hazard),
+``updated`` and ``expires`` (ISO 8601 or epoch seconds).
+"""
+
+import heapq
+import json
+import math
+import os
+import queue
+import re
+import socket
+import threading
+import time
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from datetime import datetime
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from road_graph import HAZARD_PENALTIES
+
+# Updates applied together under one hazard_version
+MAX_BATCH = 2000
+# Longest an update waits for its batch to fill (seconds)
+BATCH_WINDOW = 0.25
+# Parsed updates waiting for the applier; readers block when it is full
+QUEUE_SIZE = 20000
+# Validation limits
+MAX_ID_LEN = 256
+MAX_NAME_LEN = 200
+MAX_POINTS = 10000
+MAX_RECORD_BYTES = 1 << 20
+# Removed hazard ids remembered so late, out-of-order updates for them are dropped
+MAX_TOMBSTONES = 100000
+# Sides of the polygon a CAP <circle> is approximated with
+CIRCLE_SIDES = 16
+# How often a followed file is polled for new lines (seconds)
+FOLLOW_INTERVAL = 0.2
+
+HAZARD_ALIASES = {
+    'flood': 'flooded', 'flooding': 'flooded', 'flash flood': 'flooded', 'water': 'flooded',
+    'wildfire': 'fire', 'smoke': 'fire',
+    'power': 'powerline', 'power outage': 'powerline', 'downed powerline': 'powerline', 'electric': 'powerline',
+    'closed': 'blocked', 'closure': 'blocked', 'road closed': 'blocked', 'debris': 'blocked', 'landslide': 'blocked',
+}
+# Keywords searched in a CAP <event> when it carries no hazard_type parameter
+CAP_EVENT_KEYWORDS = (('flood', 'flooded'), ('fire', 'fire'), ('power', 'powerline'), ('electric', 'powerline'))
+CLEARED_STATUSES = {'cleared', 'cancelled', 'canceled', 'inactive', 'removed', 'expired', 'resolved'}
+
+_ALERT_END = re.compile(r'</(?:\w+:)?alert\s*>')
+
+
+class HazardUpdate:
+    __slots__ = ('id', 'name', 'hazard_type', 'parts', 'active', 'updated', 'expires', 'received')
+
+    def __init__(self, hazard_id: str, hazard_type: Optional[str], parts: List[List[List[float]]],
+                 name: Optional[str] = None, active: bool = True, updated: Optional[float] = None,
+                 expires: Optional[float] = None, received: Optional[float] = None):
+        self.id = hazard_id
+        self.hazard_type = hazard_type
+        # one or more polylines of [lat, lon] points
+        self.parts = parts
+        self.name = name
+        self.active = active
+        self.received = received if received is not None else time.time()
+        self.updated = updated if updated is not None else self.received
+        self.expires = expires
+
+    def fingerprint(self) -> tuple:
+        return (self.active, self.hazard_type, self.name, self.expires,
+                tuple(tuple(map(tuple, part)) for part in self.parts))
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, d: dict) -> 'HazardUpdate':
+        return cls(d['id'], d.get('hazard_type'), d.get('parts') or [], d.get('name'), d.get('active', True),
+                   d.get('updated'), d.get('expires'), d.get('received'))
+
+
+class Hazard:
+    """An active hazard and the road-graph edges its geometry snapped to."""
+    __slots__ = ('id', 'name', 'hazard_type', 'parts', 'updated', 'expires', 'edges')
+
+    def __init__(self, update: HazardUpdate, edges: frozenset):
+        self.id = update.id
+        self.name = update.name
+        self.hazard_type = update.hazard_type
+        self.parts = update.parts
+        self.updated = update.updated
+        self.expires = update.expires
+        self.edges = edges
+
+    def streets(self) -> List[dict]:
+        """The hazard as /find_safe_zone style hazard streets, one per polyline."""
+        return [{'id': self.id, 'name': self.name or self.id, 'hazard_type': self.hazard_type, 'geometry': part}
+                for part in self.parts]
+
+
+class HazardDelta:
+    """What one batch changed; ``penalties`` is a new dict, the previous one is never mutated."""
+    __slots__ = ('upserted', 'removed', 'changed_edges', 'penalties', 'names_added', 'names_removed')
+
+    def __init__(self):
+        self.upserted: List[Hazard] = []
+        self.removed: List[Hazard] = []
+        self.changed_edges: List[int] = []
+        self.penalties: Dict[int, float] = {}
+        self.names_added: List[Tuple[str, str]] = []
+        self.names_removed: List[Tuple[str, str]] = []
+
+    def __bool__(self) -> bool:
+        return bool(self.upserted or self.removed)
+
+    def changed_geometries(self) -> List[List[List[float]]]:
+        return [part for hz in self.upserted + self.removed for part in hz.parts]
+
+
+# --- parsing and validation ---
+def parse_time(value) -> Optional[float]:
+    """Epoch seconds from an ISO 8601 string or a number (seconds or milliseconds)."""
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return float(value) / 1000.0 if value > 1e11 else float(value)
+    text = str(value).strip()
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    dt = datetime.fromisoformat(text.replace('Z', '+00:00'))
+    return dt.timestamp()
+
+
+def normalize_hazard_type(value) -> str:
+    text = str(value or '').strip().lower().replace('_', ' ')
+    text = HAZARD_ALIASES.get(text, text)
+    if text not in HAZARD_PENALTIES:
+        raise ValueError(f"unknown hazard_type: {value!r}")
+    return text
+
+
+def _check_point(lat, lon) -> List[float]:
+    lat, lon = float(lat), float(lon)
+    if not (math.isfinite(lat) and math.isfinite(lon)) or not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError(f"coordinate out of range: {lat},{lon}")
+    return [lat, lon]
+
+
+def validate(update: HazardUpdate) -> HazardUpdate:
+    if not isinstance(update.id, str) or not update.id or len(update.id) > MAX_ID_LEN:
+        raise ValueError('hazard id missing or too long')
+    if update.name is not None and len(update.name) > MAX_NAME_LEN:
+        raise ValueError('hazard name too long')
+    if not update.active:
+        return update
+    if update.hazard_type not in HAZARD_PENALTIES:
+        raise ValueError(f"unknown hazard_type: {update.hazard_type!r}")
+    if not update.parts or not all(update.parts):
+        raise ValueError('active hazard without geometry')
+    if sum(len(part) for part in update.parts) > MAX_POINTS:
+        raise ValueError('hazard geometry too large')
+    return update
+
+
+def _geojson_parts(geometry: dict) -> List[List[List[float]]]:
+    kind = geometry.get('type')
+    coords = geometry.get('coordinates')
+    if kind == 'Point':
+        lines = [[coords]]
+    elif kind in ('LineString', 'MultiPoint'):
+        lines = [coords] if kind == 'LineString' else [[p] for p in coords]
+    elif kind == 'MultiLineString':
+        lines = coords
+    elif kind == 'Polygon':
+        lines = coords[:1]  # exterior ring
+    elif kind == 'MultiPolygon':
+        lines = [poly[0] for poly in coords if poly]
+    elif kind == 'GeometryCollection':
+        return [part for g in geometry.get('geometries', []) for part in _geojson_parts(g)]
+    else:
+        raise ValueError(f"unsupported geometry type: {kind!r}")
+    # GeoJSON positions are [lon, lat(, alt)]
+    return [[_check_point(p[1], p[0]) for p in line] for line in lines]
+
+
+def parse_geojson(obj, received: Optional[float] = None) -> List[HazardUpdate]:
+    if obj.get('type') == 'FeatureCollection':
+        return [u for feature in obj.get('features', []) for u in parse_geojson(feature, received)]
+    if obj.get('type') != 'Feature':
+        raise ValueError('expected a GeoJSON Feature or FeatureCollection')
+    props = obj.get('properties') or {}
+    hazard_id = props.get('id', obj.get('id'))
+    if hazard_id is None:
+        raise ValueError('feature without id')
+    status = str(props.get('status', 'active')).lower()
+    active = status not in CLEARED_STATUSES and props.get('active', True) is not False
+    geometry = obj.get('geometry')
+    parts = _geojson_parts(geometry) if geometry else []
+    hazard_type = normalize_hazard_type(props.get('hazard_type', props.get('type'))) if active else \
+        props.get('hazard_type')
+    name = props.get('name')
+    return [validate(HazardUpdate(str(hazard_id), hazard_type, parts, str(name) if name is not None else None,
+                                  active, parse_time(props.get('updated', props.get('timestamp'))),
+                                  parse_time(props.get('expires')), received))]
+
+
+def _local(tag: str) -> str:
+    return tag.rsplit('}', 1)[-1]
+
+
+def _children(el, name: str):
+    return [c for c in el if _local(c.tag) == name]
+
+
+def _text(el, name: str) -> Optional[str]:
+    for c in el:
+        if _local(c.tag) == name:
+            return (c.text or '').strip()
+    return None
+
+
+def _cap_pairs(text: str) -> List[List[float]]:
+    return [_check_point(*pair.split(',')[:2]) for pair in text.split()]
+
+
+def _cap_circle(text: str) -> List[List[float]]:
+    center, radius_km = text.split()
+    lat, lon = _check_point(*center.split(','))
+    r = float(radius_km) * 1000.0
+    dlat = r / 111320.0
+    dlon = r / (111320.0 * max(0.01, math.cos(math.radians(lat))))
+    ring = [[lat + dlat * math.cos(2 * math.pi * i / CIRCLE_SIDES), lon + dlon * math.sin(2 * math.pi * i / CIRCLE_SIDES)]
+            for i in range(CIRCLE_SIDES)]
+    return ring + ring[:1]
+
+
+def _cap_hazard_type(info) -> str:
+    for param in _children(info, 'parameter'):
+        if (_text(param, 'valueName') or '').lower() == 'hazard_type':
+            return normalize_hazard_type(_text(param, 'value'))
+    event = (_text(info, 'event') or '').lower()
+    for keyword, hazard_type in CAP_EVENT_KEYWORDS:
+        if keyword in event:
+            return hazard_type
+    return 'blocked'
+
+
+def parse_cap(text: str, received: Optional[float] = None) -> List[HazardUpdate]:
+    """A CAP 1.2 <alert>: Alert / Update add the hazard (an Update replaces the alerts it
+    references), Cancel removes the referenced alerts. Test, exercise and draft alerts are ignored."""
+    root = ET.fromstring(text)
+    if _local(root.tag) != 'alert':
+        raise ValueError('expected a CAP <alert>')
+    identifier = _text(root, 'identifier')
+    if not identifier:
+        raise ValueError('CAP alert without identifier')
+    if (_text(root, 'status') or 'Actual').lower() not in ('actual', 'system'):
+        return []
+    msg_type = (_text(root, 'msgType') or 'Alert').lower()
+    sent = parse_time(_text(root, 'sent'))
+    # references: "sender,identifier,sent" triples separated by whitespace
+    referenced = [ref.split(',')[1] for ref in (_text(root, 'references') or '').split() if ref.count(',') >= 2]
+    updates = [HazardUpdate(ref, None, [], active=False, updated=sent, received=received) for ref in referenced]
+    if msg_type == 'cancel':
+        updates.append(HazardUpdate(identifier, None, [], active=False, updated=sent, received=received))
+        return [validate(u) for u in updates]
+    infos = _children(root, 'info')
+    if not infos:
+        raise ValueError('CAP alert without info')
+    info = infos[0]
+    parts, name = [], None
+    for area in _children(info, 'area'):
+        name = name or _text(area, 'areaDesc')
+        parts += [_cap_pairs(p.text or '') for p in _children(area, 'polygon')]
+        parts += [_cap_circle(c.text or '') for c in _children(area, 'circle')]
+    updates.append(HazardUpdate(identifier, _cap_hazard_type(info), parts, name or _text(info, 'headline'), True,
+                                sent, parse_time(_text(info, 'expires')), received))
+    return [validate(u) for u in updates]
+
+
+def parse_record(text: str, received: Optional[float] = None) -> List[HazardUpdate]:
+    """One feed record: a CAP alert if it starts with '<', a GeoJSON object otherwise."""
+    text = text.strip()
+    if len(text) > MAX_RECORD_BYTES:
+        raise ValueError('record too large')
+    if text.startswith('<'):
+        return parse_cap(text, received)
+    return parse_geojson(json.loads(text), received)
+
+
+def split_records(lines: Iterable[str]) -> Iterator[str]:
+    """Frame a line stream into records: one GeoJSON object per line, a CAP alert
+    from its first line through ``</alert>``. Blank and '#' comment lines are skipped."""
+    pending: List[str] = []
+    size = 0
+    for line in lines:
+        if pending:
+            pending.append(line)
+            size += len(line)
+            if _ALERT_END.search(line) or size > MAX_RECORD_BYTES:
+                yield ''.join(pending)
+                pending, size = [], 0
+            continue
+        stripped = line.strip()
+        if not stripped or stripped.startswith('#'):
+            continue
+        if stripped.startswith('<') and not _ALERT_END.search(stripped):
+            pending, size = [line], len(line)
+            continue
+        yield stripped
+    if pending:
+        yield ''.join(pending)
+
+
+# --- current hazard set: dedupe, edge snapping, incremental penalties ---
+class HazardSet:
+    def __init__(self, graph=None):
+        self.graph = graph
+        self.hazards: Dict[str, Hazard] = {}
+        self.penalties: Dict[int, float] = {}
+        self.duplicates = 0
+        self.stale = 0
+        self.expired = 0
+        # hazard id -> (updated, fingerprint) of the last accepted update, removals included
+        self._seen: "OrderedDict[str, Tuple[float, tuple]]" = OrderedDict()
+        # edge id -> {hazard id: multiplier} of the hazards covering it
+        self._edge_refs: Dict[int, Dict[str, float]] = {}
+        self._names: Dict[Tuple[str, str], int] = {}
+        self._expiry: List[Tuple[float, str]] = []
+        # held by apply: the feed applier and hub threads mutate the set while others read it
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.hazards)
+
+    def _snap(self, update: HazardUpdate) -> frozenset:
+        if self.graph is None:
+            return frozenset()
+        edges = set()
+        for part in update.parts:
+            edges.update(self.graph.edges_for_hazard(update.name, part))
+        return frozenset(edges)
+
+    def _remember(self, update: HazardUpdate):
+        self._seen[update.id] = (update.updated, update.fingerprint())
+        self._seen.move_to_end(update.id)
+        while len(self._seen) > len(self.hazards) + MAX_TOMBSTONES:
+            oldest = next(iter(self._seen))
+            if oldest in self.hazards:
+                self._seen.move_to_end(oldest)
+            else:
+                del self._seen[oldest]
+
+    def _name_ref(self, hz: Hazard, delta: int, out: HazardDelta):
+        if not hz.name:
+            return
+        key = (hz.hazard_type, hz.name)
+        count = self._names.get(key, 0) + delta
+        if count > 0:
+            self._names[key] = count
+            if count == 1 and delta > 0:
+                out.names_added.append(key)
+        else:
+            self._names.pop(key, None)
+            out.names_removed.append(key)
+
+    def _due(self, now: float) -> List[HazardUpdate]:
+        """Removals for hazards whose ``expires`` has passed."""
+        out = []
+        while self._expiry and self._expiry[0][0] <= now:
+            expires, hazard_id = heapq.heappop(self._expiry)
+            hz = self.hazards.get(hazard_id)
+            if hz is not None and hz.expires == expires:
+                out.append(HazardUpdate(hazard_id, hz.hazard_type, [], active=False, updated=now, received=now))
+                self.expired += 1
+        return out
+
+    def next_expiry(self) -> Optional[float]:
+        return self._expiry[0][0] if self._expiry else None
+
+    def resume_expiry(self):
+        """Schedule the expiry of every active hazard (after mirroring with ``expire=False``)."""
+        with self._lock:
+            self._expiry = [(hz.expires, hz.id) for hz in self.hazards.values() if hz.expires is not None]
+            heapq.heapify(self._expiry)
+
+    def snapshot(self) -> List[Hazard]:
+        """The active hazards, copied between batches (never half-way through an apply)."""
+        with self._lock:
+            return list(self.hazards.values())
+
+    def last_update(self, hazard_id: str) -> Optional[float]:
+        """``updated`` of the last accepted update for a hazard id, removals included."""
+        seen = self._seen.get(hazard_id)
+        return seen[0] if seen is not None else None
+
+    def apply(self, updates: Iterable[HazardUpdate], now: Optional[float] = None,
+              snapped: Optional[Dict[str, frozenset]] = None, expire: bool = True) -> HazardDelta:
+        """Fold a batch of updates into the set; returns what changed. ``snapped`` maps
+        hazard id -> edges already matched on this graph (from a snapshot or the authority).
+        ``expire=False`` mirrors another process's set: updates are taken as they are and
+        nothing expires here, the authority's removals do that."""
+        with self._lock:
+            return self._apply(updates, now, snapped, expire)
+
+    def _apply(self, updates, now, snapped, expire) -> HazardDelta:
+        now = now if now is not None else time.time()
+        latest: Dict[str, HazardUpdate] = {}
+        for u in list(updates) + (self._due(now) if expire else []):
+            prev = latest.get(u.id)
+            if prev is None or u.updated >= prev.updated:
+                latest[u.id] = u
+            else:
+                self.stale += 1
+        delta = HazardDelta()
+        touched = set()
+        for u in latest.values():
+            seen = self._seen.get(u.id)
+            if seen is not None:
+                if u.updated < seen[0]:
+                    self.stale += 1
+                    continue
+                if u.fingerprint() == seen[1]:
+                    self.duplicates += 1
+                    continue
+            if expire and u.active and u.expires is not None and u.expires <= now:
+                u = HazardUpdate(u.id, u.hazard_type, [], active=False, updated=u.updated, received=u.received)
+            old = self.hazards.get(u.id)
+            if not u.active and old is None:
+                self._remember(u)
+                continue
+            if old is not None:
+                del self.hazards[u.id]
+                delta.removed.append(old)
+                self._name_ref(old, -1, delta)
+                for e in old.edges:
+                    refs = self._edge_refs.get(e)
+                    if refs is not None:
+                        refs.pop(u.id, None)
+                        if not refs:
+                            del self._edge_refs[e]
+                touched.update(old.edges)
+            if u.active:
+                hz = Hazard(u, snapped[u.id] if snapped and u.id in snapped else self._snap(u))
+                self.hazards[u.id] = hz
+                delta.upserted.append(hz)
+                self._name_ref(hz, 1, delta)
+                mult = HAZARD_PENALTIES[u.hazard_type]
+                for e in hz.edges:
+                    self._edge_refs.setdefault(e, {})[u.id] = mult
+                touched.update(hz.edges)
+                if expire and u.expires is not None:
+                    heapq.heappush(self._expiry, (u.expires, u.id))
+            self._remember(u)
+        if not delta:
+            delta.penalties = self.penalties
+            return delta
+        penalties = dict(self.penalties)
+        for e in touched:
+            refs = self._edge_refs.get(e)
+            mult = max(refs.values()) if refs else None
+            if mult is not None and mult > 1.0:
+                if penalties.get(e) != mult:
+                    penalties[e] = mult
+                    delta.changed_edges.append(e)
+            elif e in penalties:
+                del penalties[e]
+                delta.changed_edges.append(e)
+        self.penalties = delta.penalties = penalties
+        return delta
+
+    def streets(self) -> List[dict]:
+        return [street for hz in self.snapshot() for street in hz.streets()]
+
+
+# --- sources ---
+def follow_file(path: str, emit: Callable[[str], None], stop: threading.Event, follow: bool = True):
+    """Feed every record of ``path``, then keep feeding appended lines (tail -f, reopening
+    the file when it is rotated or truncated)."""
+    while not stop.is_set():
+        try:
+            fh = open(path, 'r', encoding='utf-8', errors='replace')
+        except OSError:
+            if not follow:
+                return
+            stop.wait(1.0)
+            continue
+        with fh:
+            inode = os.fstat(fh.fileno()).st_ino
+
+            def lines():
+                partial = ''
+                while not stop.is_set():
+                    line = fh.readline()
+                    if line:
+                        if not line.endswith('\n'):
+                            partial += line  # writer is mid-line
+                            continue
+                        yield partial + line
+                        partial = ''
+                        continue
+                    if not follow:
+                        if partial:
+                            yield partial
+                        return
+                    try:
+                        st = os.stat(path)
+                        if st.st_ino != inode or st.st_size < fh.tell():
+                            return  # rotated or truncated: reopen
+                    except OSError:
+                        return
+                    stop.wait(FOLLOW_INTERVAL)
+
+            for record in split_records(lines()):
+                emit(record)
+        if not follow:
+            return
+
+
+def _serve_connection(conn: socket.socket, emit: Callable[[str], None], stop: threading.Event):
+    with conn, conn.makefile('r', encoding='utf-8', errors='replace') as fh:
+        for record in split_records(line for line in fh if not stop.is_set()):
+            emit(record)
+
+
+def serve_socket(address: str, emit: Callable[[str], None], stop: threading.Event):
+    """Accept producers on ``tcp://host:port`` or ``unix:/path`` and feed the records each one writes."""
+    if address.startswith('unix:'):
+        path = address[len('unix:'):]
+        if os.path.exists(path):
+            os.unlink(path)
+        srv = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        srv.bind(path)
+    else:
+        host, port = address[len('tcp://'):].rsplit(':', 1)
+        srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        srv.bind((host or '127.0.0.1', int(port)))
+    srv.listen(16)
+    srv.settimeout(0.5)
+    with srv:
+        while not stop.is_set():
+            try:
+                conn, _ = srv.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            conn.settimeout(None)
+            threading.Thread(target=_serve_connection, args=(conn, emit, stop), daemon=True).start()
+
+
+# --- pipeline ---
+class HazardFeed:
+    """Readers -> bounded queue -> one batching applier calling ``apply(delta)``."""
+
+    def __init__(self, sources: Iterable[str], hazard_set: HazardSet, apply: Callable[[HazardDelta], object],
+                 max_batch: int = MAX_BATCH, batch_window: float = BATCH_WINDOW, queue_size: int = QUEUE_SIZE):
+        self.sources = [s for s in sources if s]
+        self.hazard_set = hazard_set
+        self.apply = apply
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.received = 0
+        self.rejected = 0
+        self.applied = 0
+        self.batches = 0
+        self.last_error = None
+        self.last_batch_ms = None
+        self.max_latency_ms = 0.0
+        # set on a replica worker (state_hub): updates go to the authority instead of the local queue
+        self.relay: Optional[Callable[[List[HazardUpdate]], None]] = None
+        self._latency_ms = None
+        self._queue: "queue.Queue[HazardUpdate]" = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._threads: List[threading.Thread] = []
+
+    def submit(self, record: str) -> int:
+        """Parse one record and queue its updates (blocks while the queue is full).
+        Returns the number of updates queued; invalid records are counted and dropped."""
+        try:
+            updates = parse_record(record)
+        except Exception as e:
+            with self._stats_lock:
+                self.rejected += 1
+                self.last_error = str(e)[:200]
+            return 0
+        self.enqueue(updates)
+        with self._stats_lock:
+            self.received += len(updates)
+        return len(updates)
+
+    def enqueue(self, updates: List[HazardUpdate]):
+        if self.relay is not None:
+            self.relay(updates)
+            return
+        for u in updates:
+            self._queue.put(u)
+
+    def submit_text(self, text: str) -> Tuple[int, int]:
+        """Queue every record of a multi-record body; returns (updates queued, records rejected)."""
+        rejected = self.rejected
+        queued = sum(self.submit(record) for record in split_records(text.splitlines(True)))
+        return queued, self.rejected - rejected
+
+    def _take_batch(self) -> List[HazardUpdate]:
+        timeout = None
+        next_expiry = self.hazard_set.next_expiry()
+        if next_expiry is not None:
+            timeout = max(0.0, next_expiry - time.time())
+        try:
+            first = self._queue.get(timeout=min(timeout, 1.0) if timeout is not None else 1.0)
+        except queue.Empty:
+            return []
+        batch = [first]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get_nowait() if remaining <= 0 else self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def run_once(self, batch: List[HazardUpdate]):
+        started = time.time()
+        delta = self.hazard_set.apply(batch, started)
+        if delta:
+            self.apply(delta)
+        done = time.time()
+        with self._stats_lock:
+            self.batches += 1 if batch else 0
+            self.applied += len(batch)
+            self.last_batch_ms = round((done - started) * 1000, 2)
+            if batch:
+                latency = (done - min(u.received for u in batch)) * 1000
+                self.max_latency_ms = max(self.max_latency_ms, latency)
+                self._latency_ms = latency if self._latency_ms is None else 0.9 * self._latency_ms + 0.1 * latency
+
+    def _applier(self):
+        while not self._stop.is_set():
+            batch = self._take_batch()
+            next_expiry = self.hazard_set.next_expiry()
+            if batch or (next_expiry is not None and next_expiry <= time.time()):
+                try:
+                    self.run_once(batch)
+                except Exception as e:
+                    with self._stats_lock:
+                        self.last_error = str(e)[:200]
+
+    def _reader(self, source: str):
+        if source.startswith(('tcp://', 'unix:')):
+            serve_socket(source, self.submit, self._stop)
+        else:
+            follow_file(source[len('file:'):] if source.startswith('file:') else source, self.submit, self._stop)
+
+    def start(self):
+        self._threads = [threading.Thread(target=self._applier, name='hazard-feed-apply', daemon=True)]
+        self._threads += [threading.Thread(target=self._reader, args=(s,), name=f'hazard-feed:{s}', daemon=True)
+                          for s in self.sources]
+        for t in self._threads:
+            t.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                'sources': self.sources,
+                'active_hazards': len(self.hazard_set),
+                'penalised_edges': len(self.hazard_set.penalties),
+                'received': self.received,
+                'rejected': self.rejected,
+                'duplicates': self.hazard_set.duplicates,
+                'stale': self.hazard_set.stale,
+                'expired': self.hazard_set.expired,
+                'applied': self.applied,
+                'batches': self.batches,
+                'queued': self._queue.qsize(),
+                'last_batch_ms': self.last_batch_ms,
+                'latency_ms': round(self._latency_ms, 1) if self._latency_ms is not None else None,
+                'max_latency_ms': round(self.max_latency_ms, 1),
+                'last_error': self.last_error,
+            }
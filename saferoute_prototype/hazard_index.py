@@ -0,0 +1,147 @@
+"""
+Uniform-grid spatial index over hazard polyline segments.
+
+Every segment is registered in the grid cells its bounding box touches, so
+"does this route cross a hazard?" and "which hazards are near this point?"
+only test the segments sharing a cell with the query instead of every
+segment of every hazard. Hazards can be inserted and removed one at a time
+as the hazard set changes.
+"""
+
+import math
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from geometry import point_segment_dist_m, seg_intersect
+
+# ~220 m of latitude per cell: a few OSM segments per cell on city streets
+DEFAULT_CELL_DEG = 0.002
+
+
+class HazardIndex:
+    """Grid of cells -> (hazard id, segment number) entries."""
+
+    def __init__(self, cell_deg: float = DEFAULT_CELL_DEG):
+        self.cell_deg = cell_deg
+        self._cells: Dict[Tuple[int, int], List[Tuple[object, int]]] = {}
+        self._hazards: Dict[object, dict] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._hazards)
+
+    def __contains__(self, hazard_id) -> bool:
+        return hazard_id in self._hazards
+
+    def get(self, hazard_id) -> Optional[dict]:
+        return self._hazards.get(hazard_id)
+
+    def ids(self) -> List[object]:
+        return list(self._hazards)
+
+    def _cell(self, lat: float, lon: float) -> Tuple[int, int]:
+        return int(math.floor(lat / self.cell_deg)), int(math.floor(lon / self.cell_deg))
+
+    def _cells_for_box(self, south: float, west: float, north: float, east: float) -> Iterable[Tuple[int, int]]:
+        y0, x0 = self._cell(south, west)
+        y1, x1 = self._cell(north, east)
+        for y in range(y0, y1 + 1):
+            for x in range(x0, x1 + 1):
+                yield y, x
+
+    def _segment_cells(self, a, b) -> Iterable[Tuple[int, int]]:
+        return self._cells_for_box(min(a[0], b[0]), min(a[1], b[1]), max(a[0], b[0]), max(a[1], b[1]))
+
+    def insert(self, hazard_id, geometry: List[List[float]], hazard_type: Optional[str] = None,
+               name: Optional[str] = None):
+        """Add (or replace) a hazard polyline."""
+        with self._lock:
+            if hazard_id in self._hazards:
+                self._remove(hazard_id)
+            geometry = [[float(p[0]), float(p[1])] for p in geometry]
+            self._hazards[hazard_id] = {'id': hazard_id, 'name': name, 'hazard_type': hazard_type,
+                                        'geometry': geometry}
+            if len(geometry) == 1:
+                geometry = geometry * 2
+            for i in range(len(geometry) - 1):
+                for cell in self._segment_cells(geometry[i], geometry[i + 1]):
+                    self._cells.setdefault(cell, []).append((hazard_id, i))
+
+    def remove(self, hazard_id) -> bool:
+        """Drop a hazard; returns False if it was not indexed."""
+        with self._lock:
+            return self._remove(hazard_id)
+
+    def _remove(self, hazard_id) -> bool:
+        hz = self._hazards.pop(hazard_id, None)
+        if hz is None:
+            return False
+        geometry = hz['geometry']
+        if len(geometry) == 1:
+            geometry = geometry * 2
+        for i in range(len(geometry) - 1):
+            for cell in self._segment_cells(geometry[i], geometry[i + 1]):
+                entries = self._cells.get(cell)
+                if entries:
+                    entries[:] = [en for en in entries if en[0] != hazard_id]
+                    if not entries:
+                        del self._cells[cell]
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._cells.clear()
+            self._hazards.clear()
+
+    def _segment(self, hazard_id, i):
+        geometry = self._hazards[hazard_id]['geometry']
+        if len(geometry) == 1:
+            return geometry[0], geometry[0]
+        return geometry[i], geometry[i + 1]
+
+    def crossing_segment(self, a: Tuple[float, float], b: Tuple[float, float], touching: bool = False) -> Set[object]:
+        """Ids of hazards whose polyline properly crosses segment ab (or touches it, with ``touching``)."""
+        found = set()
+        seen = set()
+        with self._lock:
+            for cell in self._segment_cells(a, b):
+                for entry in self._cells.get(cell, ()):
+                    if entry in seen or entry[0] in found:
+                        continue
+                    seen.add(entry)
+                    c, d = self._segment(*entry)
+                    if seg_intersect(a, b, (c[0], c[1]), (d[0], d[1]), touching):
+                        found.add(entry[0])
+        return found
+
+    def crossing_polyline(self, route: List[List[float]]) -> Set[object]:
+        """Ids of hazards crossed anywhere along a route polyline."""
+        found = set()
+        for i in range(len(route) - 1):
+            found |= self.crossing_segment((route[i][0], route[i][1]), (route[i + 1][0], route[i + 1][1]))
+        return found
+
+    def intersects(self, route: List[List[float]]) -> bool:
+        for i in range(len(route) - 1):
+            if self.crossing_segment((route[i][0], route[i][1]), (route[i + 1][0], route[i + 1][1])):
+                return True
+        return False
+
+    def within(self, lat: float, lon: float, radius_m: float) -> List[Tuple[object, float]]:
+        """(hazard id, distance in metres) for hazards within ``radius_m`` of a point, nearest first."""
+        dlat = radius_m / 110574.0
+        dlon = radius_m / (111320.0 * max(0.01, math.cos(math.radians(lat))))
+        best: Dict[object, float] = {}
+        seen = set()
+        p = (lat, lon)
+        with self._lock:
+            for cell in self._cells_for_box(lat - dlat, lon - dlon, lat + dlat, lon + dlon):
+                for entry in self._cells.get(cell, ()):
+                    if entry in seen:
+                        continue
+                    seen.add(entry)
+                    c, d = self._segment(*entry)
+                    dist = point_segment_dist_m(p, c, d)
+                    if dist <= radius_m and dist < best.get(entry[0], math.inf):
+                        best[entry[0]] = dist
+        return sorted(best.items(), key=lambda kv: kv[1])
@@ -0,0 +1,348 @@
+"""
+Active client routes, repaired incrementally when hazards change.
+
+Each tracked route keeps the state of a Lifelong Planning A* (LPA*) search
+over the road graph: the g / rhs values of the nodes it touched and its open
+queue. When edge penalties change, only the heads of the changed edges are
+re-evaluated and the search resumes from there, so a hazard near a route
+costs a local repair instead of a new search, and a route whose search
+never reached a changed edge is left alone. With the haversine heuristic (a
+lower bound on edge lengths, penalty multipliers are >= 1) LPA* returns the
+same shortest paths as A*.
+
+The searches are bounded in total: the tracker counts the nodes each one
+holds and evicts the least recently tracked routes past MAX_TRACKED_NODES.
+A route planned against penalties that changed before it was tracked is
+caught up right away from the difference between the two penalty sets, so
+a hazard batch that commits mid-request is never missed.
+"""
+
+import heapq
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from geometry import haversine_m
+
+DEFAULT_MAX_ROUTES = 1000
+# Routes a client hasn't refreshed, and hasn't been sent a repaired version of, for this long stop being tracked
+DEFAULT_ROUTE_TTL = 30 * 60
+# Searches that grow past this many nodes are dropped instead of kept for repair
+MAX_SEARCH_NODES = 200000
+# Nodes held by all tracked searches together (a few hundred bytes each)
+MAX_TRACKED_NODES = 500000
+
+INF = math.inf
+
+
+def changed_edges_between(old: Dict[int, float], new: Dict[int, float]) -> Set[int]:
+    """Edges whose penalty differs between two penalty maps."""
+    if old is new:
+        return set()
+    return {e for e in old.keys() | new.keys() if old.get(e) != new.get(e)}
+
+
+class LPAStar:
+    def __init__(self, graph, source: int, target: int, penalties: Optional[Dict[int, float]] = None):
+        self.graph = graph
+        self.source = source
+        self.target = target
+        self.penalties = penalties or {}
+        self.g: Dict[int, float] = {}
+        self.rhs: Dict[int, float] = {source: 0.0}
+        self._open: Dict[int, Tuple[float, float]] = {}
+        self._heap: List[Tuple[float, float, int]] = []
+        self._tlat = graph.lats[target]
+        self._tlon = graph.lons[target]
+        self.expanded = 0
+        self._push(source)
+
+    def _h(self, u: int) -> float:
+        return haversine_m(self.graph.lats[u], self.graph.lons[u], self._tlat, self._tlon)
+
+    def _cost(self, e: int) -> float:
+        mult = self.penalties.get(e)
+        if mult is None:
+            return self.graph.lengths[e]
+        return INF if mult == INF else self.graph.lengths[e] * mult
+
+    def _key(self, u: int) -> Tuple[float, float]:
+        m = min(self.g.get(u, INF), self.rhs.get(u, INF))
+        return m + self._h(u), m
+
+    def _push(self, u: int):
+        k = self._key(u)
+        self._open[u] = k
+        heapq.heappush(self._heap, (k[0], k[1], u))
+        if len(self._heap) > 4 * len(self._open) + 1024:
+            # drop stale entries left behind by key updates
+            self._heap = [(k1, k2, v) for v, (k1, k2) in self._open.items()]
+            heapq.heapify(self._heap)
+
+    def _top_key(self) -> Tuple[float, float]:
+        while self._heap:
+            k1, k2, u = self._heap[0]
+            if self._open.get(u) == (k1, k2):
+                return k1, k2
+            heapq.heappop(self._heap)  # stale entry
+        return INF, INF
+
+    def _update_vertex(self, u: int):
+        if u != self.source:
+            rev_offsets, rev_edges, sources = self.graph._reverse()
+            best = INF
+            for i in range(rev_offsets[u], rev_offsets[u + 1]):
+                e = rev_edges[i]
+                gp = self.g.get(sources[e], INF)
+                if gp < INF:
+                    c = gp + self._cost(e)
+                    if c < best:
+                        best = c
+            self.rhs[u] = best
+        if self.g.get(u, INF) != self.rhs.get(u, INF):
+            self._push(u)
+        else:
+            self._open.pop(u, None)
+
+    def compute(self) -> bool:
+        """Run until the target is locally consistent; False if the search grew too large."""
+        offsets, targets = self.graph.offsets, self.graph.targets
+        t = self.target
+        while True:
+            top = self._top_key()
+            if not (top < self._key(t) or self.rhs.get(t, INF) != self.g.get(t, INF)):
+                return True
+            if top[0] == INF:
+                return True  # target unreachable
+            _, _, u = heapq.heappop(self._heap)
+            del self._open[u]
+            self.expanded += 1
+            if len(self.g) > MAX_SEARCH_NODES:
+                return False
+            gu, ru = self.g.get(u, INF), self.rhs.get(u, INF)
+            if gu > ru:
+                self.g[u] = ru
+                for e in range(offsets[u], offsets[u + 1]):
+                    v = targets[e]
+                    c = ru + self._cost(e)
+                    if c < self.rhs.get(v, INF):
+                        self.rhs[v] = c
+                        self._update_vertex_key(v)
+            else:
+                self.g[u] = INF
+                self._update_vertex(u)
+                for e in range(offsets[u], offsets[u + 1]):
+                    self._update_vertex(targets[e])
+
+    def _update_vertex_key(self, v: int):
+        if self.g.get(v, INF) != self.rhs.get(v, INF):
+            self._push(v)
+        else:
+            self._open.pop(v, None)
+
+    def touches(self, edges: Iterable[int]) -> List[int]:
+        """The changed edges whose tail this search has reached (others can't affect it)."""
+        sources = self.graph._reverse()[2]
+        g = self.g
+        return [e for e in edges if g.get(sources[e], INF) < INF]
+
+    def update(self, penalties: Dict[int, float], changed_edges: Iterable[int]) -> bool:
+        """Apply new edge penalties and repair the search; False if it had to be abandoned."""
+        self.penalties = penalties or {}
+        targets = self.graph.targets
+        for v in {targets[e] for e in changed_edges}:
+            self._update_vertex(v)
+        return self.compute()
+
+    @property
+    def cost(self) -> float:
+        return self.g.get(self.target, INF)
+
+    @property
+    def size(self) -> int:
+        """Nodes this search holds state for."""
+        return len(self.rhs)
+
+    def path(self) -> Optional[List[int]]:
+        if self.cost == INF:
+            return None
+        rev_offsets, rev_edges, sources = self.graph._reverse()
+        path = [self.target]
+        u = self.target
+        while u != self.source:
+            best, best_p = INF, None
+            for i in range(rev_offsets[u], rev_offsets[u + 1]):
+                e = rev_edges[i]
+                p = sources[e]
+                c = self.g.get(p, INF) + self._cost(e)
+                if c < best:
+                    best, best_p = c, p
+            if best_p is None or len(path) > len(self.g):
+                return None
+            path.append(best_p)
+            u = best_p
+        path.reverse()
+        return path
+
+
+class ActiveRoute:
+    __slots__ = ('client_id', 'origin', 'destination', 'search', 'nodes', 'version', 'touched', 'size')
+
+    def __init__(self, client_id: str, origin, destination, search: LPAStar, version: int):
+        self.client_id = client_id
+        self.origin = list(origin)
+        self.destination = list(destination)
+        self.search = search
+        self.nodes = search.path()
+        self.version = version
+        self.touched = time.time()
+        # search.size as last counted against the tracker's node budget
+        self.size = search.size
+
+    def coords(self) -> Optional[List[List[float]]]:
+        if self.nodes is None:
+            return None
+        g = self.search.graph
+        return [self.origin] + [[g.lats[n], g.lons[n]] for n in self.nodes] + [self.destination]
+
+
+class ActiveRouteTracker:
+    """The latest route of each client, kept repairable (LRU, node budget and idle TTL bounded)."""
+
+    def __init__(self, graph, max_routes: int = DEFAULT_MAX_ROUTES, ttl: float = DEFAULT_ROUTE_TTL,
+                 max_nodes: int = MAX_TRACKED_NODES):
+        self.graph = graph
+        self.max_routes = max_routes
+        self.max_nodes = max_nodes
+        self.ttl = ttl
+        self.repairs = 0
+        self.skipped = 0
+        self.updated = 0
+        self.caught_up = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+        # one repair pass at a time: the searches are mutated in place
+        self._repair_lock = threading.Lock()
+        self._routes: "OrderedDict[str, ActiveRoute]" = OrderedDict()
+        self._nodes = 0
+        # penalties of the last repair pass: routes still searching under them only need its changed edges
+        self._penalties: Optional[Dict[int, float]] = None
+
+    def __len__(self) -> int:
+        return len(self._routes)
+
+    def track(self, client_id: str, origin, destination, penalties: Dict[int, float], version: int,
+              current: Optional[Callable[[], Tuple[Dict[int, float], int]]] = None) -> Optional[List[List[float]]]:
+        """Route ``origin`` -> ``destination`` for a client and keep the search for repairs.
+        ``current()`` returns the live (penalties, version): when a hazard batch committed
+        while this route was planned, it is repaired before being returned."""
+        src = self.graph.nearest_node(origin[0], origin[1])
+        dst = self.graph.nearest_node(destination[0], destination[1])
+        if src is None or dst is None:
+            return None
+        search = LPAStar(self.graph, src, dst, penalties)
+        if not search.compute():
+            return None
+        route = ActiveRoute(client_id, origin, destination, search, version)
+        with self._lock:
+            old = self._routes.pop(client_id, None)
+            if old is not None:
+                self._nodes -= old.size
+            self._routes[client_id] = route
+            self._nodes += route.size
+            self._trim()
+        if current is not None:
+            penalties, latest = current()
+            if latest != version:
+                with self._repair_lock:
+                    if not self._catch_up(route, penalties, latest):
+                        return None
+        return route.coords()
+
+    def forget(self, client_id: str):
+        with self._lock:
+            route = self._routes.pop(client_id, None)
+            if route is not None:
+                self._nodes -= route.size
+
+    def _trim(self):
+        """Evict least recently tracked routes past the route count and node budget (self._lock held)."""
+        while self._routes and (len(self._routes) > self.max_routes or self._nodes > self.max_nodes):
+            _, route = self._routes.popitem(last=False)
+            self._nodes -= route.size
+            self.evicted += 1
+
+    def _resize(self, route: ActiveRoute):
+        with self._lock:
+            if self._routes.get(route.client_id) is route:
+                self._nodes += route.search.size - route.size
+            route.size = route.search.size
+            self._trim()
+
+    def _catch_up(self, route: ActiveRoute, penalties: Dict[int, float], version: int) -> bool:
+        """Bring a route planned under older penalties to ``version`` (self._repair_lock held).
+        False if its search had to be abandoned."""
+        if route.version >= version:
+            return True
+        relevant = route.search.touches(changed_edges_between(route.search.penalties, penalties or {}))
+        route.version = version
+        self.caught_up += 1
+        if not relevant:
+            route.search.penalties = penalties or {}
+            return True
+        if not route.search.update(penalties, relevant):
+            self.forget(route.client_id)
+            return False
+        route.nodes = route.search.path()
+        self._resize(route)
+        return True
+
+    def repair(self, penalties: Dict[int, float], changed_edges: Iterable[int],
+               version: int) -> List[Tuple[str, Optional[List[List[float]]]]]:
+        """Re-route the tracked routes a penalty change can affect. Returns (client id,
+        new route or None if now unreachable) for every route whose path changed."""
+        changed_edges = list(changed_edges)
+        now = time.time()
+        with self._lock:
+            for client_id in [c for c, r in self._routes.items() if now - r.touched > self.ttl]:
+                self._nodes -= self._routes.pop(client_id).size
+            routes = list(self._routes.values())
+        updates = []
+        with self._repair_lock:
+            self._repair_routes(routes, penalties, changed_edges, version, updates)
+            self._penalties = penalties
+        return updates
+
+    def _repair_routes(self, routes, penalties, changed_edges, version, updates):
+        for route in routes:
+            if route.version >= version:
+                continue  # caught up by track() already
+            edges = changed_edges
+            if route.search.penalties is not self._penalties:
+                # planned under older penalties than the previous pass: diff against its own
+                edges = changed_edges_between(route.search.penalties, penalties or {})
+            relevant = route.search.touches(edges)
+            route.version = version
+            if not relevant:
+                route.search.penalties = penalties or {}
+                self.skipped += 1
+                continue
+            self.repairs += 1
+            if not route.search.update(penalties, relevant):
+                self.forget(route.client_id)
+                continue
+            self._resize(route)
+            nodes = route.search.path()
+            if nodes != route.nodes:
+                route.nodes = nodes
+                # pushed to the client, which follows it instead of asking again: still in use
+                route.touched = time.time()
+                self.updated += 1
+                updates.append((route.client_id, route.coords()))
+
+    def stats(self) -> dict:
+        return {'tracked': len(self._routes), 'nodes': self._nodes, 'repaired': self.repairs,
+                'skipped': self.skipped, 'updated': self.updated, 'caught_up': self.caught_up,
+                'evicted': self.evicted}
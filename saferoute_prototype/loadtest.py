@@ -0,0 +1,478 @@
+"""
+Offline replay and load-test harness for the SafeRoute API.
+
+Starts local stub servers standing in for Nominatim, Overpass and OSRM, runs
+the app under uvicorn pointed at them (SAFEROUTE_*_URL, with a scratch
+SAFEROUTE_DB), then drives a seeded mix of /find_safe_zone, /compute_route,
+POST /sos and responder polling (GET /sos with the last cursor) at a fixed
+concurrency and reports throughput and p50/p95/p99 latency per endpoint.
+
+The stubs replay responses recorded with ``record``. Requests that were never
+recorded are answered with deterministic synthetic data (geocodes hashed into
+the region, schools hashed per Overpass bbox, straight-line OSRM routes), so a
+run is reproducible without network access.
+
+    python loadtest.py run [--requests 2000] [--concurrency 20] [--mix find_safe_zone=1,compute_route=3,sos=2,responders=4]
+                           [--recordings loadtest_recordings.json] [--upstream-delay-ms 50] [--seed 1]
+                           [--json result.json] [--baseline result.json --max-regression 0.25] [--url http://host:port]
+    python loadtest.py record [loadtest_recordings.json] [--port 8089]
+        proxies the real services on --port and saves their responses; run the app with
+        SAFEROUTE_{NOMINATIM,OVERPASS,OSRM}_URL pointed at it and exercise it
+    python loadtest.py stubs [--port 8089]
+        serve the stubs only
+
+With --baseline the run exits non-zero when an endpoint's p95 is more than
+--max-regression worse than in the baseline result, or throughput dropped as much.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+REAL_NOMINATIM_URL = 'https://nominatim.openstreetmap.org/search'
+REAL_OVERPASS_URL = 'https://overpass-api.de/api/interpreter'
+REAL_OSRM_URL = 'https://router.project-osrm.org/route/v1/driving'
+
+DEFAULT_RECORDINGS = 'loadtest_recordings.json'
+# Kalispell, MT (the demo scenario's area): south, west, north, east
+DEFAULT_REGION = (48.17, -114.35, 48.23, -114.27)
+DEFAULT_MIX = 'find_safe_zone=1,compute_route=3,sos=2,responders=4'
+ENDPOINTS = ('find_safe_zone', 'compute_route', 'sos', 'responders')
+# Distinct addresses the virtual users look up (repeats exercise the geocode / route caches)
+ADDRESS_POOL = 50
+PERCENTILES = (50, 95, 99)
+
+
+def _unit(*parts) -> float:
+    """Deterministic value in [0, 1) from the given parts."""
+    digest = hashlib.sha1('|'.join(map(str, parts)).encode()).digest()
+    return int.from_bytes(digest[:8], 'big') / 2.0 ** 64
+
+
+def _query_key(query: str) -> str:
+    return hashlib.sha1(' '.join(query.split()).encode()).hexdigest()
+
+
+# --- stub upstreams ---
+class Recordings:
+    """Recorded upstream responses: {'nominatim': {...}, 'overpass': {...}, 'osrm': {...}}."""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.data: Dict[str, Dict[str, object]] = {'nominatim': {}, 'overpass': {}, 'osrm': {}}
+        self.replayed = 0
+        self.synthesized = 0
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for service, entries in json.load(f).items():
+                    self.data.setdefault(service, {}).update(entries)
+
+    def get(self, service: str, key: str):
+        with self._lock:
+            found = self.data[service].get(key)
+            if found is not None:
+                self.replayed += 1
+            return found
+
+    def put(self, service: str, key: str, response):
+        with self._lock:
+            self.data[service][key] = response
+
+    def save(self):
+        with self._lock:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.data, f)
+            os.replace(tmp, self.path)
+
+
+def synth_nominatim(query: str, limit: int, region) -> list:
+    s, w, n, e = region
+    count = limit if 'school' in query.lower() else 1
+    return [{'lat': str(round(s + (n - s) * _unit(query, i, 'lat'), 6)),
+             'lon': str(round(w + (e - w) * _unit(query, i, 'lon'), 6)),
+             'display_name': f"{query} ({i})"} for i in range(count)]
+
+
+def synth_overpass(query: str) -> dict:
+    """Schools hashed into the query's bbox; other layers come back empty."""
+    m = re.search(r'\(\s*(-?[\d.]+)\s*,\s*(-?[\d.]+)\s*,\s*(-?[\d.]+)\s*,\s*(-?[\d.]+)\s*\)', query)
+    if not m or 'school' not in query:
+        return {'elements': []}
+    s, w, n, e = (float(v) for v in m.groups())
+    key = m.group(0)
+    elements = []
+    for i in range(int(_unit(key, 'count') * 3)):
+        elements.append({'type': 'node', 'id': int(_unit(key, i) * 1e9),
+                         'lat': s + (n - s) * _unit(key, i, 'lat'), 'lon': w + (e - w) * _unit(key, i, 'lon'),
+                         'tags': {'amenity': 'school', 'name': f"School {int(_unit(key, i) * 1e4)}",
+                                  'capacity': str(100 + int(_unit(key, i, 'cap') * 400))}})
+    return {'elements': elements}
+
+
+def synth_osrm(coords: str, steps: int = 20) -> dict:
+    (lon1, lat1), (lon2, lat2) = [tuple(float(v) for v in p.split(',')) for p in coords.split(';')[:2]]
+    line = [[lon1 + (lon2 - lon1) * i / steps, lat1 + (lat2 - lat1) * i / steps] for i in range(steps + 1)]
+    return {'code': 'Ok', 'routes': [{'geometry': {'type': 'LineString', 'coordinates': line}}]}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: 'StubServer'
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, body, status: int = 200):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        try:
+            self.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the app gave up on this call (e.g. cancelled an OSRM task it no longer needed)
+
+    def _respond(self, service: str, key: str, synth, forward):
+        srv = self.server
+        if srv.delay:
+            time.sleep(srv.delay)
+        if srv.error_rate and _unit(srv.seed, service, key, srv.count(service, key)) < srv.error_rate:
+            return self._reply({'error': 'stub failure'}, 503)
+        found = srv.recordings.get(service, key)
+        if found is None and srv.record:
+            try:
+                found = forward()
+            except Exception as e:
+                return self._reply({'error': str(e)}, 502)
+            srv.recordings.put(service, key, found)
+        if found is None:
+            with srv.recordings._lock:
+                srv.recordings.synthesized += 1
+            found = synth()
+        self._reply(found)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        if url.path == '/search':
+            q, limit = params.get('q', ''), int(params.get('limit', 1))
+            return self._respond('nominatim', f"{q}|{limit}", lambda: synth_nominatim(q, limit, self.server.region),
+                                 lambda: _fetch(REAL_NOMINATIM_URL + '?' + url.query))
+        if url.path.startswith('/route/v1/driving/'):
+            coords = url.path[len('/route/v1/driving/'):]
+            return self._respond('osrm', coords, lambda: synth_osrm(coords),
+                                 lambda: _fetch(f"{REAL_OSRM_URL}/{coords}?{url.query}"))
+        self._reply({'error': 'not found'}, 404)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode()
+        if urllib.parse.urlsplit(self.path).path == '/api/interpreter':
+            query = urllib.parse.parse_qs(body).get('data', [''])[0]
+            return self._respond('overpass', _query_key(query), lambda: synth_overpass(query),
+                                 lambda: _fetch(REAL_OVERPASS_URL, urllib.parse.urlencode({'data': query}).encode()))
+        self._reply({'error': 'not found'}, 404)
+
+
+def _fetch(url: str, data: Optional[bytes] = None):
+    req = urllib.request.Request(url, data=data, headers={'User-Agent': 'SafeRoutePrototype/1.0'})
+    with urllib.request.urlopen(req, timeout=60) as r:
+        return json.loads(r.read())
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int, recordings: Recordings, region=DEFAULT_REGION, delay_ms: float = 0.0,
+                 error_rate: float = 0.0, seed: int = 1, record: bool = False):
+        super().__init__(('127.0.0.1', port), StubHandler)
+        self.recordings = recordings
+        self.region = region
+        self.delay = delay_ms / 1000.0
+        self.error_rate = error_rate
+        self.seed = seed
+        self.record = record
+        self._counts: Dict[Tuple[str, str], int] = {}
+        self._lock = threading.Lock()
+
+    def count(self, service: str, key: str) -> int:
+        """How often this request has been seen (keeps injected failures deterministic)."""
+        with self._lock:
+            n = self._counts.get((service, key), 0)
+            self._counts[(service, key)] = n + 1
+            return n
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def env(self) -> Dict[str, str]:
+        return {'SAFEROUTE_NOMINATIM_URL': self.base_url + '/search',
+                'SAFEROUTE_OVERPASS_URL': self.base_url + '/api/interpreter',
+                'SAFEROUTE_OSRM_URL': self.base_url + '/route/v1/driving'}
+
+    def start(self) -> 'StubServer':
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+# --- workload ---
+def parse_mix(text: str) -> Dict[str, float]:
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise ValueError(f"unknown endpoint in mix: {name!r} (expected one of {', '.join(ENDPOINTS)})")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def plan_requests(count: int, mix: Dict[str, float], seed: int, region) -> List[Tuple[str, dict]]:
+    """The same seed, mix and region always yield the same request sequence."""
+    rng = random.Random(seed)
+    s, w, n, e = region
+    names, weights = list(mix), list(mix.values())
+    plan = []
+    for i in range(count):
+        op = rng.choices(names, weights)[0]
+        if op == 'find_safe_zone':
+            params = {'address': f"{rng.randrange(1, ADDRESS_POOL + 1)} Main St, Kalispell, MT"}
+        elif op == 'compute_route':
+            params = {'start_lat': round(rng.uniform(s, n), 5), 'start_lon': round(rng.uniform(w, e), 5),
+                      'dest_lat': round(rng.uniform(s, n), 5), 'dest_lon': round(rng.uniform(w, e), 5)}
+        elif op == 'sos':
+            params = {'lat': round(rng.uniform(s, n), 6), 'lon': round(rng.uniform(w, e), 6),
+                      'message': f"loadtest {seed}-{i}", 'survivors': rng.randint(1, 6)}
+        else:
+            params = {}
+        plan.append((op, params))
+    return plan
+
+
+async def _send(client: httpx.AsyncClient, op: str, params: dict, state: dict, seed: int, i: int) -> int:
+    if op == 'find_safe_zone':
+        r = await client.get('/find_safe_zone', params=params)
+    elif op == 'compute_route':
+        r = await client.get('/compute_route', params=params)
+    elif op == 'sos':
+        r = await client.post('/sos', json=params, headers={'Idempotency-Key': f"loadtest-{seed}-{i}"})
+    else:
+        query = {'limit': 500}
+        if state.get('cursor'):
+            query['since'] = state['cursor']
+        r = await client.get('/sos', params=query)
+        if r.status_code == 200:
+            state['cursor'] = r.json().get('cursor') or state.get('cursor')
+    return r.status_code
+
+
+async def drive(url: str, plan: List[Tuple[str, dict]], concurrency: int, seed: int,
+                warmup: int = 0, timeout: float = 60.0) -> dict:
+    """Run the plan with ``concurrency`` virtual users; the first ``warmup`` requests aren't measured."""
+    latencies: Dict[str, List[float]] = {op: [] for op in ENDPOINTS}
+    errors: Dict[str, int] = {op: 0 for op in ENDPOINTS}
+    queue = iter(enumerate(plan))
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, timeout=timeout, limits=limits) as client:
+        async def user():
+            state = {}
+            for i, (op, params) in queue:
+                t0 = time.perf_counter()
+                try:
+                    status = await _send(client, op, params, state, seed, i)
+                except Exception:
+                    status = 0
+                elapsed = (time.perf_counter() - t0) * 1000
+                if i < warmup:
+                    continue
+                latencies[op].append(elapsed)
+                if status >= 400 or status == 0:
+                    errors[op] += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(user() for _ in range(concurrency)))
+        wall = time.perf_counter() - started
+    return summarize(latencies, errors, wall)
+
+
+def percentile(sorted_values: List[float], pct: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+def summarize(latencies: Dict[str, List[float]], errors: Dict[str, int], wall: float) -> dict:
+    endpoints = {}
+    for op, values in latencies.items():
+        if not values:
+            continue
+        values = sorted(values)
+        stats = {'requests': len(values), 'errors': errors[op], 'rps': round(len(values) / wall, 1),
+                 'mean_ms': round(sum(values) / len(values), 2), 'max_ms': round(values[-1], 2)}
+        for pct in PERCENTILES:
+            stats[f"p{pct}_ms"] = round(percentile(values, pct), 2)
+        endpoints[op] = stats
+    total = sum(len(v) for v in latencies.values())
+    return {'wall_s': round(wall, 3), 'requests': total, 'errors': sum(errors.values()),
+            'rps': round(total / wall, 1) if wall else None, 'endpoints': endpoints}
+
+
+def compare(result: dict, baseline: dict, max_regression: float) -> List[str]:
+    """Regressions of ``result`` against ``baseline`` beyond the allowed fraction."""
+    problems = []
+    for op, base in baseline.get('endpoints', {}).items():
+        cur = result['endpoints'].get(op)
+        if cur is None or not base.get('p95_ms'):
+            continue
+        if cur['p95_ms'] > base['p95_ms'] * (1 + max_regression):
+            problems.append(f"{op}: p95 {cur['p95_ms']} ms vs baseline {base['p95_ms']} ms")
+    if baseline.get('rps') and result['rps'] < baseline['rps'] * (1 - max_regression):
+        problems.append(f"throughput {result['rps']} req/s vs baseline {baseline['rps']} req/s")
+    return problems
+
+
+def print_report(result: dict):
+    cols = ['requests', 'errors', 'rps'] + [f"p{p}_ms" for p in PERCENTILES] + ['max_ms']
+    print(f"{'endpoint':<16}" + ''.join(f"{c:>10}" for c in cols))
+    for op, stats in result['endpoints'].items():
+        print(f"{op:<16}" + ''.join(f"{stats[c]:>10}" for c in cols))
+    print(f"{'total':<16}{result['requests']:>10}{result['errors']:>10}{result['rps']:>10}"
+          f"   ({result['wall_s']} s)")
+
+
+# --- app under test ---
+def start_app(port: int, env: Dict[str, str], workdir: str, workers: int = 1) -> subprocess.Popen:
+    """uvicorn saferoute_api:app on ``port`` with the given extra environment; waits until it answers.
+    With several ``workers`` they share hazard / SOS state through a hub socket in ``workdir``."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    full_env = dict(os.environ, **env)
+    full_env['PYTHONPATH'] = here + os.pathsep + full_env.get('PYTHONPATH', '')
+    cmd = [sys.executable, '-m', 'uvicorn', 'saferoute_api:app', '--port', str(port), '--log-level', 'warning']
+    if workers > 1:
+        cmd += ['--workers', str(workers)]
+        full_env['SAFEROUTE_HUB'] = os.path.join(workdir, 'hub.sock')
+    log = open(os.path.join(workdir, 'uvicorn.log'), 'w')
+    proc = subprocess.Popen(cmd, cwd=here, env=full_env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"app exited with {proc.returncode}, see {log.name}")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/status", timeout=2).status_code == 200:
+                return proc
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError('app did not start within 60 s')
+
+
+def run(args) -> int:
+    region = tuple(float(v) for v in args.region.split(',')) if args.region else DEFAULT_REGION
+    mix = parse_mix(args.mix)
+    plan = plan_requests(args.requests + args.warmup, mix, args.seed, region)
+    stubs = proc = None
+    workdir = tempfile.mkdtemp(prefix='saferoute-loadtest-')
+    url = args.url
+    try:
+        if url is None:
+            stubs = StubServer(args.stub_port, Recordings(args.recordings), region, args.upstream_delay_ms,
+                               args.upstream_error_rate, args.seed).start()
+            env = dict(stubs.env(), SAFEROUTE_DB=os.path.join(workdir, 'saferoute.db'))
+            proc = start_app(args.port, env, workdir, args.workers)
+            url = f"http://127.0.0.1:{args.port}"
+        result = asyncio.run(drive(url, plan, args.concurrency, args.seed, args.warmup))
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait(10)
+        if stubs is not None:
+            stubs.shutdown()
+    result['config'] = {'requests': args.requests, 'warmup': args.warmup, 'concurrency': args.concurrency,
+                        'mix': mix, 'seed': args.seed, 'upstream_delay_ms': args.upstream_delay_ms}
+    if stubs is not None:
+        result['upstream'] = {'replayed': stubs.recordings.replayed, 'synthesized': stubs.recordings.synthesized}
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems = compare(result, json.load(f), args.max_regression)
+        for p in problems:
+            print(f"REGRESSION {p}")
+        return 1 if problems else 0
+    return 0
+
+
+def serve(args, record: bool) -> int:
+    recordings = Recordings(args.recordings)
+    stubs = StubServer(args.stub_port, recordings, record=record)
+    print(f"stub upstreams on {stubs.base_url}; point the app at them with:")
+    for k, v in stubs.env().items():
+        print(f"  export {k}={v}")
+    try:
+        stubs.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if record:
+            recordings.save()
+            print(f"saved {sum(len(v) for v in recordings.data.values())} responses to {args.recordings}")
+    return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command')
+    p_run = sub.add_parser('run')
+    p_run.add_argument('--url', help='test an already running app instead of starting one against the stubs')
+    p_run.add_argument('--requests', type=int, default=2000)
+    p_run.add_argument('--warmup', type=int, default=100)
+    p_run.add_argument('--concurrency', type=int, default=20)
+    p_run.add_argument('--mix', default=DEFAULT_MIX)
+    p_run.add_argument('--seed', type=int, default=1)
+    p_run.add_argument('--region', help='south,west,north,east of the generated points')
+    p_run.add_argument('--recordings', default=DEFAULT_RECORDINGS)
+    p_run.add_argument('--upstream-delay-ms', type=float, default=0.0)
+    p_run.add_argument('--upstream-error-rate', type=float, default=0.0)
+    p_run.add_argument('--port', type=int, default=8765)
+    p_run.add_argument('--workers', type=int, default=1, help='uvicorn worker processes (multi-worker mode)')
+    p_run.add_argument('--stub-port', type=int, default=8089)
+    p_run.add_argument('--json')
+    p_run.add_argument('--baseline')
+    p_run.add_argument('--max-regression', type=float, default=0.25)
+    for name in ('record', 'stubs'):
+        p = sub.add_parser(name)
+        p.add_argument('recordings', nargs='?', default=DEFAULT_RECORDINGS)
+        p.add_argument('--port', dest='stub_port', type=int, default=8089)
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        return run(args)
+    if args.command in ('record', 'stubs'):
+        return serve(args, args.command == 'record')
+    parser.print_help()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,331 @@
+"""
+Process metrics in the Prometheus text exposition format (GET /metrics).
+
+Counters and histograms are small in-process objects (no prometheus_client
+dependency); each label combination is one series guarded by the metric's
+lock. Existing ``stats()`` dicts (caches, event bus, hazard feed, ...) are
+exported as gauges by collectors evaluated at scrape time, so they are not
+duplicated here.
+
+Request profiling: with SAFEROUTE_PROFILE_SAMPLE > 0 that fraction of
+requests runs under cProfile, and a sampled request slower than
+SAFEROUTE_PROFILE_MIN_MS is dumped as a .prof file into
+SAFEROUTE_PROFILE_DIR (newest SAFEROUTE_PROFILE_KEEP kept; open with
+``python -m pstats`` or snakeviz). Only one request is profiled at a time, and
+the profile covers everything the event-loop thread ran meanwhile, other
+requests' coroutines included.
+"""
+
+import asyncio
+import bisect
+import cProfile
+import functools
+import math
+import os
+import random
+import re
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Seconds; spans cache hits (sub-ms) to slow upstream calls
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Seconds a streaming response (SSE) stays open; kept apart from request latency
+STREAM_BUCKETS = (1.0, 10.0, 60.0, 300.0, 900.0, 1800.0, 3600.0, 7200.0, 21600.0)
+STREAMING_CONTENT_TYPES = (b'text/event-stream',)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names: Tuple[str, ...], values: Tuple, extra: str = '') -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(n, '') for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(labels.get(n, '') for n in self.labelnames), 0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_labels(self.labelnames, k)} {_number(v)}" for k, v in items]
+        return lines
+
+
+def outcome(exc_type) -> str:
+    if exc_type is None:
+        return 'ok'
+    if issubclass(exc_type, asyncio.CancelledError):
+        return 'cancelled'
+    if getattr(exc_type, 'outcome', None):
+        # e.g. resilience.CircuitOpenError: refused locally, never sent
+        return exc_type.outcome
+    return 'timeout' if 'Timeout' in exc_type.__name__ else 'error'
+
+
+class _Timer:
+    """Times a block (``with``) or every call of a sync / async function (decorator)."""
+
+    def __init__(self, histogram: 'Histogram', labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        labels = self.labels
+        if 'outcome' in self.histogram.labelnames and 'outcome' not in labels:
+            labels = dict(labels, outcome=outcome(exc_type))
+        self.histogram.observe(time.perf_counter() - self._start, **labels)
+        return False
+
+    def __call__(self, fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def timed_async(*args, **kwargs):
+                with _Timer(self.histogram, self.labels):
+                    return await fn(*args, **kwargs)
+            return timed_async
+
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            with _Timer(self.histogram, self.labels):
+                return fn(*args, **kwargs)
+        return timed
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = (), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # label values -> [per-bucket counts..., sum, count]
+        self._series: Dict[Tuple, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(n, '') for n in self.labelnames)
+        i = bisect.bisect_left(self.buckets, value)  # first bucket with value <= bound (or +Inf)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def time(self, **labels) -> _Timer:
+        return _Timer(self, labels)
+
+    def count(self, **labels) -> int:
+        series = self._series.get(tuple(labels.get(n, '') for n in self.labelnames))
+        return series[-1] if series else 0
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, series in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (math.inf,), series):
+                cumulative += n
+                le = 'le="%s"' % _number(bound)
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(series[-2])}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {series[-1]}")
+        return lines
+
+
+def _metric_name(text: str) -> str:
+    return re.sub(r'[^a-zA-Z0-9_]', '_', text)
+
+
+def stats_gauges(prefix: str, help: str, stats: Callable[[], Optional[dict]]) -> Callable[[], List[str]]:
+    """Collector exporting every numeric value of a ``stats()`` dict as gauge ``<prefix>_<key>``."""
+    def collect() -> List[str]:
+        values = stats() or {}
+        lines = []
+        for key, value in values.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            name = _metric_name(f"{prefix}_{key}")
+            lines += [f"# HELP {name} {help} ({key})", f"# TYPE {name} gauge", f"{name} {_number(value)}"]
+        return lines
+    return collect
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[object] = []
+        self._collectors: List[Callable[[], List[str]]] = []
+
+    def counter(self, name: str, help: str, labelnames: Iterable[str] = ()) -> Counter:
+        metric = Counter(name, help, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, labelnames: Iterable[str] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, collect: Callable[[], List[str]]):
+        self._collectors.append(collect)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render()
+        for collect in self._collectors:
+            try:
+                lines += collect()
+            except Exception:
+                COLLECTOR_ERRORS.inc()
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+HTTP_SECONDS = REGISTRY.histogram('saferoute_http_request_duration_seconds',
+                                  'API request latency by route template', ('route', 'method', 'status'))
+STREAM_SECONDS = REGISTRY.histogram('saferoute_http_stream_duration_seconds',
+                                    'How long streaming (server-sent event) responses stay connected',
+                                    ('route', 'method', 'status'), buckets=STREAM_BUCKETS)
+UPSTREAM_SECONDS = REGISTRY.histogram('saferoute_upstream_request_duration_seconds',
+                                      'Outbound call latency by service', ('service', 'outcome'))
+STAGE_SECONDS = REGISTRY.histogram('saferoute_stage_duration_seconds',
+                                   'Time spent in each stage of an endpoint', ('endpoint', 'stage'))
+SQLITE_SECONDS = REGISTRY.histogram('saferoute_sqlite_duration_seconds',
+                                    'SQLite statement / transaction latency', ('db', 'op'))
+FALLBACKS = REGISTRY.counter('saferoute_fallbacks_total',
+                             'Times a degraded path was taken instead of the primary one', ('kind',))
+ERRORS = REGISTRY.counter('saferoute_errors_total', 'Exceptions absorbed by a fallback path', ('where', 'error'))
+PROFILES = REGISTRY.counter('saferoute_profiles_total', 'Sampled request profiles', ('result',))
+COLLECTOR_ERRORS = REGISTRY.counter('saferoute_metrics_collector_errors_total', 'Collectors that failed a scrape')
+
+
+def count_error(where: str, exc: BaseException):
+    ERRORS.inc(where=where, error=type(exc).__name__)
+
+
+# --- sampled request profiling ---
+class RequestProfiler:
+    def __init__(self, sample: float = 0.0, min_ms: float = 0.0, directory: Optional[str] = None, keep: int = 50):
+        self.sample = sample
+        self.min_ms = min_ms
+        self.directory = directory
+        self.keep = keep
+        self._busy = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> 'RequestProfiler':
+        return cls(float(os.environ.get('SAFEROUTE_PROFILE_SAMPLE', 0) or 0),
+                   float(os.environ.get('SAFEROUTE_PROFILE_MIN_MS', 250)),
+                   os.environ.get('SAFEROUTE_PROFILE_DIR', 'profiles'),
+                   int(os.environ.get('SAFEROUTE_PROFILE_KEEP', 50)))
+
+    def start(self) -> Optional[cProfile.Profile]:
+        if self.sample <= 0 or random.random() >= self.sample or not self._busy.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler (e.g. a debugger) is active
+            self._busy.release()
+            return None
+        return profile
+
+    def cancel(self, profile: cProfile.Profile):
+        """Stop a profile without dumping it (e.g. the request turned out to be a long-lived stream)."""
+        profile.disable()
+        PROFILES.inc(result='discarded')
+        self._busy.release()
+
+    def finish(self, profile: cProfile.Profile, route: str, elapsed_ms: float):
+        try:
+            profile.disable()
+            if elapsed_ms < self.min_ms:
+                PROFILES.inc(result='discarded')
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            name = f"{int(time.time() * 1000)}-{_metric_name(route.strip('/') or 'root')}-{int(elapsed_ms)}ms.prof"
+            profile.dump_stats(os.path.join(self.directory, name))
+            PROFILES.inc(result='dumped')
+            dumps = sorted(f for f in os.listdir(self.directory) if f.endswith('.prof'))
+            for old in dumps[:-self.keep] if self.keep > 0 else []:
+                os.remove(os.path.join(self.directory, old))
+        finally:
+            self._busy.release()
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing every HTTP request by route template (and sampling profiles).
+    Streaming responses are timed into STREAM_SECONDS instead: an SSE connection lasts
+    minutes and would swamp the request latency percentiles."""
+
+    def __init__(self, app, profiler: Optional[RequestProfiler] = None):
+        self.app = app
+        self.profiler = profiler or RequestProfiler()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status = [500]
+        streaming = [False]
+        profile = [self.profiler.start()]
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+                content_type = dict(message.get('headers', ())).get(b'content-type', b'')
+                if content_type.startswith(STREAMING_CONTENT_TYPES):
+                    streaming[0] = True
+                    # don't hold the profiler for the whole life of a stream
+                    if profile[0] is not None:
+                        self.profiler.cancel(profile[0])
+                        profile[0] = None
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            route = scope.get('route')
+            template = getattr(route, 'path', None) or 'unmatched'
+            histogram = STREAM_SECONDS if streaming[0] else HTTP_SECONDS
+            histogram.observe(elapsed, route=template, method=scope.get('method', ''), status=status[0])
+            if profile[0] is not None:
+                self.profiler.finish(profile[0], template, elapsed * 1000)
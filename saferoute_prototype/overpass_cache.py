@@ -0,0 +1,281 @@
+"""
+Tile-keyed cache for Overpass results.
+
+Results are stored per z14 slippy-map tile and layer ("streets": named
+highway ways with geometry, "schools": amenity=school centres) in a SQLite
+file shared by every worker. A query for a bbox only downloads the tiles not
+cached yet (in one Overpass request covering them) and answers the rest from
+disk, so nearby addresses reuse ways and POIs that were already fetched.
+
+Tiles older than the TTL are still served (stale-while-revalidate) and
+re-downloaded in the background, so an expired tile never makes a request
+wait on Overpass, nor fail when Overpass is down.
+
+The SQLite reads and writes and the JSON decoding of tiles run in the
+threadpool, so a busy cache file never stalls the event loop.
+
+Warm the tiles covering a deployment region ahead of time with:
+    python overpass_cache.py prefetch <south> <west> <north> <east>
+"""
+
+import asyncio
+import json
+import math
+import sqlite3
+import sys
+import threading
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+from metrics import SQLITE_SECONDS
+from resilience import revalidate
+
+DEFAULT_ZOOM = 14
+DEFAULT_TTL = 7 * 24 * 3600
+# Largest tile block fetched by one Overpass request while prefetching
+PREFETCH_BLOCK = 4
+# Most tiles one query may cover (~16 x 16 z14 tiles); bigger regions go through prefetch
+MAX_QUERY_TILES = 256
+
+LAYER_QUERIES = {
+    'streets': """
+        [out:json][timeout:25];
+        way({s},{w},{n},{e})["highway"]["name"];
+        out geom;
+        """,
+    'schools': """
+        [out:json][timeout:25];
+        (
+          node({s},{w},{n},{e})["amenity"="school"];
+          way({s},{w},{n},{e})["amenity"="school"];
+          relation({s},{w},{n},{e})["amenity"="school"];
+        );
+        out center;
+        """,
+}
+
+Tile = Tuple[int, int]
+Fetch = Callable[[str], Awaitable[dict]]
+
+
+class TooManyTiles(ValueError):
+    pass
+
+
+def tile_xy(lat: float, lon: float, zoom: int = DEFAULT_ZOOM) -> Tile:
+    n = 2 ** zoom
+    lat = max(-85.0511, min(85.0511, lat))
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tile_bbox(x: int, y: int, zoom: int = DEFAULT_ZOOM) -> Tuple[float, float, float, float]:
+    """(south, west, north, east) of a tile."""
+    n = 2 ** zoom
+    west = x / n * 360.0 - 180.0
+    east = (x + 1) / n * 360.0 - 180.0
+    north = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    south = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return south, west, north, east
+
+
+def tiles_for_bbox(south: float, west: float, north: float, east: float, zoom: int = DEFAULT_ZOOM) -> List[Tile]:
+    x0, y0 = tile_xy(north, west, zoom)
+    x1, y1 = tile_xy(south, east, zoom)
+    return [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+
+def element_points(el: dict) -> List[Tuple[float, float]]:
+    if 'geometry' in el:
+        return [(pt['lat'], pt['lon']) for pt in el['geometry'] if pt]
+    if 'lat' in el and 'lon' in el:
+        return [(el['lat'], el['lon'])]
+    center = el.get('center')
+    if center:
+        return [(center['lat'], center['lon'])]
+    return []
+
+
+def _slim(layer: str, el: dict) -> dict:
+    """Keep only what the app reads from an element."""
+    out = {'type': el.get('type'), 'id': el.get('id')}
+    tags = el.get('tags', {})
+    if layer == 'streets':
+        out['tags'] = {k: tags[k] for k in ('name', 'highway') if k in tags}
+        out['geometry'] = [{'lat': pt['lat'], 'lon': pt['lon']} for pt in el.get('geometry', []) if pt]
+    else:
+        out['tags'] = {k: tags[k] for k in ('name', 'amenity', 'capacity') if k in tags}
+        for k in ('lat', 'lon', 'center'):
+            if k in el:
+                out[k] = el[k]
+    return out
+
+
+class OverpassTileCache:
+    def __init__(self, path: str, zoom: int = DEFAULT_ZOOM, ttl: float = DEFAULT_TTL,
+                 max_tiles: int = MAX_QUERY_TILES):
+        self.path = path
+        self.zoom = zoom
+        self.ttl = ttl
+        self.max_tiles = max_tiles
+        self.tile_hits = 0
+        self.stale_tile_hits = 0
+        self.tile_misses = 0
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        conn = self._conn()
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS overpass_tiles (
+            layer TEXT,
+            x INTEGER,
+            y INTEGER,
+            fetched REAL,
+            elements TEXT,
+            PRIMARY KEY (layer, x, y)
+        )
+        ''')
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @SQLITE_SECONDS.time(db='overpass', op='lookup')
+    def _cached(self, layer: str, tiles: List[Tile]) -> Dict[Tile, Tuple[float, str]]:
+        """tile -> (fetched, elements) for every cached tile, expired or not."""
+        conn = self._conn()
+        found = {}
+        for x, y in tiles:
+            row = conn.execute('SELECT fetched, elements FROM overpass_tiles WHERE layer = ? AND x = ? AND y = ?',
+                               (layer, x, y)).fetchone()
+            if row is not None:
+                found[(x, y)] = row
+        return found
+
+    def missing(self, layer: str, south: float, west: float, north: float, east: float) -> List[Tile]:
+        """Tiles not cached or expired."""
+        tiles = tiles_for_bbox(south, west, north, east, self.zoom)
+        cached = self._cached(layer, tiles)
+        cutoff = time.time() - self.ttl
+        return [t for t in tiles if t not in cached or cached[t][0] < cutoff]
+
+    @SQLITE_SECONDS.time(db='overpass', op='store')
+    def store(self, layer: str, tiles: List[Tile], elements: List[dict]):
+        """Record ``elements`` (the Overpass answer covering ``tiles``) under every tile they touch."""
+        per_tile: Dict[Tile, List[dict]] = {t: [] for t in tiles}
+        for el in elements:
+            slim = _slim(layer, el)
+            touched = {tile_xy(lat, lon, self.zoom) for lat, lon in element_points(el)}
+            for t in touched:
+                if t in per_tile:
+                    per_tile[t].append(slim)
+        now = time.time()
+        conn = self._conn()
+        conn.executemany('INSERT OR REPLACE INTO overpass_tiles (layer, x, y, fetched, elements) VALUES (?, ?, ?, ?, ?)',
+                         [(layer, x, y, now, json.dumps(els)) for (x, y), els in per_tile.items()])
+        conn.commit()
+
+    async def fetch_tiles(self, layer: str, tiles: List[Tile], fetch: Fetch):
+        """Download ``tiles`` with a single Overpass query over their combined bbox."""
+        boxes = [tile_bbox(x, y, self.zoom) for x, y in tiles]
+        s = min(b[0] for b in boxes)
+        w = min(b[1] for b in boxes)
+        n = max(b[2] for b in boxes)
+        e = max(b[3] for b in boxes)
+        data = await fetch(LAYER_QUERIES[layer].format(s=s, w=w, n=n, e=e))
+        await run_in_threadpool(self.store, layer, tiles, data.get('elements', []))
+
+    async def query(self, layer: str, south: float, west: float, north: float, east: float,
+                    fetch: Optional[Fetch] = None) -> Optional[List[dict]]:
+        """Elements of ``layer`` touching the bbox. Missing tiles are downloaded with the
+        async ``fetch``; without one, returns None unless every tile is already cached.
+        Expired tiles are answered from disk and refreshed with ``fetch`` in the background.
+        Raises TooManyTiles when the bbox covers more than ``max_tiles`` tiles."""
+        tiles = tiles_for_bbox(south, west, north, east, self.zoom)
+        if len(tiles) > self.max_tiles:
+            raise TooManyTiles(f"bbox covers {len(tiles)} tiles, at most {self.max_tiles} per query")
+        cached = await run_in_threadpool(self._cached, layer, tiles)
+        missing = [t for t in tiles if t not in cached]
+        cutoff = time.time() - self.ttl
+        stale = sorted(t for t, (fetched, _) in cached.items() if fetched < cutoff)
+        with self._stats_lock:
+            self.tile_hits += len(cached) - len(stale)
+            self.stale_tile_hits += len(stale)
+            self.tile_misses += len(missing)
+        if missing:
+            if fetch is None:
+                return None
+            await self.fetch_tiles(layer, missing, fetch)
+            cached.update(await run_in_threadpool(self._cached, layer, missing))
+        if stale and fetch is not None:
+            revalidate('overpass', (self.path, layer, tuple(stale)), lambda: self.fetch_tiles(layer, stale, fetch))
+        return await run_in_threadpool(self._elements, cached, south, west, north, east)
+
+    @staticmethod
+    def _elements(cached: Dict[Tile, Tuple[float, str]], south: float, west: float, north: float,
+                  east: float) -> List[dict]:
+        """Decode the tile blobs, keeping each element touching the bbox once."""
+        seen = set()
+        result = []
+        for _, blob in cached.values():
+            for el in json.loads(blob):
+                key = (el.get('type'), el.get('id'))
+                if key in seen:
+                    continue
+                seen.add(key)
+                pts = element_points(el)
+                if any(south <= lat <= north and west <= lon <= east for lat, lon in pts):
+                    result.append(el)
+        return result
+
+    async def prefetch(self, south: float, west: float, north: float, east: float, fetch: Fetch,
+                       layers=('streets', 'schools'), pause: float = 1.0):
+        """Warm every tile covering a region, PREFETCH_BLOCK x PREFETCH_BLOCK tiles per request."""
+        done = 0
+        for layer in layers:
+            missing = set(await run_in_threadpool(self.missing, layer, south, west, north, east))
+            blocks: Dict[Tile, List[Tile]] = {}
+            for x, y in missing:
+                blocks.setdefault((x // PREFETCH_BLOCK, y // PREFETCH_BLOCK), []).append((x, y))
+            for block in blocks.values():
+                await self.fetch_tiles(layer, block, fetch)
+                done += len(block)
+                print(f"[prefetch] {layer}: {done} tiles")
+                await asyncio.sleep(pause)  # stay within Overpass usage policy
+        return done
+
+    def stats(self) -> dict:
+        lookups = self.tile_hits + self.stale_tile_hits + self.tile_misses
+        return {
+            'tile_hits': self.tile_hits,
+            'stale_tile_hits': self.stale_tile_hits,
+            'tile_misses': self.tile_misses,
+            'hit_ratio': round((self.tile_hits + self.stale_tile_hits) / lookups, 3) if lookups else None,
+        }
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 6 and sys.argv[1] == 'prefetch':
+        import os
+        default_path = os.environ.get('SAFEROUTE_OVERPASS_CACHE', 'overpass_cache.db')
+        path = sys.argv[6] if len(sys.argv) > 6 else default_path
+        s, w, n, e = (float(v) for v in sys.argv[2:6])
+        import upstream
+
+        async def prefetch_region():
+            try:
+                return await OverpassTileCache(path).prefetch(s, w, n, e, lambda q: upstream.overpass(q, timeout=90))
+            finally:
+                await upstream.close_client()
+        count = asyncio.run(prefetch_region())
+        print(f"Prefetched {count} tiles into {path}")
+    else:
+        print(__doc__)
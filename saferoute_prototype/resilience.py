@@ -0,0 +1,310 @@
+"""
+Resilience policies for the upstream map services.
+
+  * CircuitBreaker (one per upstream host): after ``failure_threshold``
+    consecutive failures (timeouts, connection errors, 429 / 5xx) the host is
+    considered down and calls fail immediately with CircuitOpenError instead
+    of waiting out their timeout. After ``reset_timeout`` (or the host's
+    Retry-After) one probe call is let through; success closes the circuit,
+    failure re-opens it with a doubled timeout (capped at max_reset_timeout).
+  * TokenBucket (one per service): client-side rate limit, e.g. Nominatim's
+    1 request/second usage policy. A caller that would have to wait longer
+    than its ``max_wait`` gets RateLimitedError right away.
+  * revalidate(): single-flight background refresh for the caches'
+    stale-while-revalidate paths (serve the expired entry now, refresh it
+    behind the response).
+  * Hedging: when a call hasn't answered within the host's recent p95
+    latency, a second identical request is sent and the first answer wins
+    (the other is cancelled). Only used for idempotent, cheap calls (OSRM).
+
+Rejected calls raise exceptions whose ``outcome`` is "rejected", so the
+metrics and the callers' fallbacks treat them like any other failure, just
+milliseconds later instead of seconds.
+"""
+
+import asyncio
+import threading
+import time
+import urllib.parse
+from collections import deque
+from typing import Awaitable, Callable, Dict, Hashable, Optional, TypeVar
+
+import httpx
+
+from metrics import REGISTRY
+
+DEFAULT_FAILURE_THRESHOLD = 3
+DEFAULT_RESET_TIMEOUT = 5.0
+MAX_RESET_TIMEOUT = 120.0
+# Hedge delay before enough latencies were seen, and its floor
+DEFAULT_HEDGE_DELAY = 1.0
+MIN_HEDGE_DELAY = 0.05
+HEDGE_QUANTILE = 0.95
+LATENCY_WINDOW = 200
+
+T = TypeVar('T')
+
+REJECTED = REGISTRY.counter('saferoute_upstream_rejected_total',
+                            'Upstream calls refused locally instead of being sent', ('service', 'reason'))
+HEDGES = REGISTRY.counter('saferoute_upstream_hedges_total', 'Hedged upstream requests', ('service', 'result'))
+REVALIDATIONS = REGISTRY.counter('saferoute_cache_revalidations_total',
+                                 'Background refreshes of stale cache entries', ('cache', 'result'))
+
+
+class CircuitOpenError(Exception):
+    outcome = 'rejected'
+
+
+class RateLimitedError(Exception):
+    outcome = 'rejected'
+
+
+def is_host_failure(exc: BaseException) -> bool:
+    """Errors that say the host is unhealthy (as opposed to a bad request)."""
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code == 429 or exc.response.status_code >= 500
+    return isinstance(exc, (httpx.TransportError, asyncio.TimeoutError, OSError))
+
+
+def retry_after(exc: BaseException) -> Optional[float]:
+    if isinstance(exc, httpx.HTTPStatusError):
+        value = exc.response.headers.get('Retry-After')
+        try:
+            return float(value) if value is not None else None
+        except ValueError:
+            return None
+    return None
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, name: str, failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout: float = DEFAULT_RESET_TIMEOUT, max_reset_timeout: float = MAX_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.base_reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = 0
+        self.rejected = 0
+        self._state = self.CLOSED
+        self._open_until = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() >= self._open_until:
+                return self.HALF_OPEN
+            return self._state
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may go out now."""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return
+            if self._state == self.OPEN and time.monotonic() < self._open_until:
+                self.rejected += 1
+                raise CircuitOpenError(f"{self.name} circuit open")
+            # reset timeout elapsed: one probe at a time
+            if self._probing:
+                self.rejected += 1
+                raise CircuitOpenError(f"{self.name} circuit half-open, probe in flight")
+            self._state = self.HALF_OPEN
+            self._probing = True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self._probing = False
+            self._state = self.CLOSED
+            self.reset_timeout = self.base_reset_timeout
+
+    def failure(self, retry_after_s: Optional[float] = None):
+        with self._lock:
+            self.failures += 1
+            probing, self._probing = self._probing, False
+            if probing:
+                # the probe failed: back off further
+                self.reset_timeout = min(self.reset_timeout * 2, self.max_reset_timeout)
+            if probing or self.failures >= self.failure_threshold or retry_after_s is not None:
+                timeout = max(self.reset_timeout, min(retry_after_s or 0.0, self.max_reset_timeout))
+                self._state = self.OPEN
+                self._open_until = time.monotonic() + timeout
+                self.opened += 1
+
+    def release(self):
+        """A call ended without a verdict on the host (e.g. cancelled)."""
+        with self._lock:
+            self._probing = False
+
+    def stats(self) -> dict:
+        return {'state': self.state, 'consecutive_failures': self.failures, 'opened': self.opened,
+                'rejected': self.rejected}
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float = 1.0):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, max_wait: Optional[float]) -> Optional[float]:
+        """Take a token (possibly one that is only available ``wait`` seconds from now)."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            wait = 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+            if max_wait is not None and wait > max_wait:
+                return None
+            self._tokens -= 1
+            return wait
+
+    def try_acquire(self) -> bool:
+        return self._reserve(0.0) is not None
+
+    async def acquire(self, max_wait: Optional[float] = None):
+        wait = self._reserve(max_wait)
+        if wait is None:
+            raise RateLimitedError(f"rate limit ({self.rate}/s) would delay this call past {max_wait}s")
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class LatencyTracker:
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self._samples: deque = deque(maxlen=window)
+
+    def add(self, seconds: float):
+        self._samples.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        samples = sorted(self._samples)
+        if len(samples) < 20:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker_for(url: str) -> CircuitBreaker:
+    """The circuit breaker shared by every service on ``url``'s host."""
+    host = urllib.parse.urlsplit(url).netloc
+    with _breakers_lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = _breakers[host] = CircuitBreaker(host)
+        return breaker
+
+
+def breaker_stats() -> Dict[str, dict]:
+    with _breakers_lock:
+        return {host: b.stats() for host, b in _breakers.items()}
+
+
+class Upstream:
+    """Call policy of one upstream service: host breaker, optional rate limit and hedging."""
+
+    def __init__(self, name: str, url: str, bucket: Optional[TokenBucket] = None, max_wait: float = 1.0,
+                 hedge: bool = False):
+        self.name = name
+        self.url = url
+        self.breaker = breaker_for(url)
+        self.bucket = bucket
+        self.max_wait = max_wait
+        self.hedge = hedge
+        self.latency = LatencyTracker()
+
+    def hedge_delay(self) -> float:
+        q = self.latency.quantile(HEDGE_QUANTILE)
+        return DEFAULT_HEDGE_DELAY if q is None else max(MIN_HEDGE_DELAY, q)
+
+    async def _attempt(self, request: Callable[[], Awaitable[T]]) -> T:
+        start = time.monotonic()
+        try:
+            result = await request()
+        except asyncio.CancelledError:
+            self.breaker.release()
+            raise
+        except Exception as e:
+            if is_host_failure(e):
+                self.breaker.failure(retry_after(e))
+            else:
+                # a 4xx or a bad body says nothing about the host's health: keep the failure count
+                self.breaker.release()
+            raise
+        self.breaker.success()
+        self.latency.add(time.monotonic() - start)
+        return result
+
+    async def call(self, request: Callable[[], Awaitable[T]]) -> T:
+        """Run ``request`` (a factory, so it can be sent twice when hedging) under the policy."""
+        try:
+            self.breaker.before_call()
+        except CircuitOpenError:
+            REJECTED.inc(service=self.name, reason='circuit_open')
+            raise
+        if self.bucket is not None:
+            try:
+                await self.bucket.acquire(self.max_wait)
+            except BaseException as e:
+                self.breaker.release()
+                if isinstance(e, RateLimitedError):
+                    REJECTED.inc(service=self.name, reason='rate_limited')
+                raise
+        if not self.hedge or self.breaker.state != CircuitBreaker.CLOSED:
+            return await self._attempt(request)
+        return await self._hedged(request)
+
+    async def _hedged(self, request: Callable[[], Awaitable[T]]) -> T:
+        first = asyncio.ensure_future(self._attempt(request))
+        done, _ = await asyncio.wait({first}, timeout=self.hedge_delay())
+        if done:
+            return first.result()
+        if self.bucket is not None and not self.bucket.try_acquire():
+            return await first
+        HEDGES.inc(service=self.name, result='sent')
+        second = asyncio.ensure_future(self._attempt(request))
+        pending = {first, second}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            HEDGES.inc(service=self.name, result='won')
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+_revalidating: Dict[Hashable, asyncio.Task] = {}
+
+
+def revalidate(cache: str, key: Hashable, refresh: Callable[[], Awaitable[object]]) -> bool:
+    """Run ``refresh()`` in the background unless a refresh of ``key`` is already running."""
+    if key in _revalidating:
+        return False
+
+    async def run():
+        try:
+            await refresh()
+            REVALIDATIONS.inc(cache=cache, result='ok')
+        except Exception:
+            REVALIDATIONS.inc(cache=cache, result='error')
+        finally:
+            _revalidating.pop(key, None)
+    _revalidating[key] = asyncio.get_running_loop().create_task(run())
+    return True
@@ -0,0 +1,519 @@
+"""
+Local road network for in-process routing.
+
+Loads an OSM extract (.osm XML) or a cached Overpass ``highway`` dump (JSON)
+once into a compact CSR adjacency graph and answers shortest-path queries with
+A*, so routing does not depend on a round trip to OSRM.
+
+Fetch a dump covering a deployment region with:
+    python road_graph.py fetch <south> <west> <north> <east> [road_network.json]
+"""
+
+import array
+import bisect
+import heapq
+import json
+import math
+import os
+import sys
+import xml.etree.ElementTree as ET
+from typing import Dict, List, Optional, Tuple
+
+from geometry import haversine_m
+from hazard_index import HazardIndex
+
+# Highway classes we route over (the driving network the OSRM demo profile used)
+HIGHWAY_CLASSES = [
+    'motorway', 'motorway_link', 'trunk', 'trunk_link', 'primary', 'primary_link',
+    'secondary', 'secondary_link', 'tertiary', 'tertiary_link', 'unclassified',
+    'residential', 'living_street', 'service', 'road', 'track',
+]
+HIGHWAY_CLASS_ID = {name: i for i, name in enumerate(HIGHWAY_CLASSES)}
+# Typical driving speed (km/h) per highway class, for travel-time estimates
+HIGHWAY_SPEEDS_KMH = {
+    'motorway': 100, 'motorway_link': 60, 'trunk': 80, 'trunk_link': 50, 'primary': 65, 'primary_link': 45,
+    'secondary': 55, 'secondary_link': 40, 'tertiary': 45, 'tertiary_link': 35, 'unclassified': 40,
+    'residential': 30, 'living_street': 10, 'service': 15, 'road': 30, 'track': 15,
+}
+# metres per second, indexed by highway class id
+CLASS_SPEED_MS = [HIGHWAY_SPEEDS_KMH[name] / 3.6 for name in HIGHWAY_CLASSES]
+# Speed used for the leg between an off-network point and its snapped node
+CONNECTOR_SPEED_MS = HIGHWAY_SPEEDS_KMH['residential'] / 3.6
+
+# Grid cell size (degrees) of the nearest-node index
+CELL_DEG = 0.005
+# Points further than this from every graph node are outside the extract
+MAX_SNAP_M = 1000.0
+
+# Edge cost multiplier per hazard type; math.inf makes the edge impassable
+HAZARD_PENALTIES = {
+    'flooded': math.inf,
+    'fire': math.inf,
+    'blocked': math.inf,
+    'powerline': 10.0,
+}
+# Edge endpoints this close to a hazard polyline are treated as part of it
+HAZARD_MATCH_M = 15.0
+
+_NAME_ABBREVIATIONS = {
+    'st': 'street', 'ave': 'avenue', 'av': 'avenue', 'blvd': 'boulevard', 'rd': 'road',
+    'dr': 'drive', 'ln': 'lane', 'hwy': 'highway', 'ct': 'court', 'pl': 'place',
+    'n': 'north', 's': 'south', 'e': 'east', 'w': 'west',
+}
+
+
+def normalize_street_name(name: str) -> str:
+    """Lower-case and expand common abbreviations so '5th Ave W' matches '5th Avenue West'."""
+    words = name.lower().replace('.', '').split()
+    return ' '.join(_NAME_ABBREVIATIONS.get(w, w) for w in words)
+
+
+def cell_key(lat: float, lon: float) -> int:
+    iy = int(math.floor(lat / CELL_DEG)) + 20000
+    ix = int(math.floor(lon / CELL_DEG)) + 40000
+    return iy * 100000 + ix
+
+
+class RoadGraph:
+    """Road network in CSR form.
+
+    Node ``u`` has outgoing edges ``offsets[u] .. offsets[u+1]-1``; every
+    per-edge attribute (target node, length in metres, highway class, way
+    name) lives in a flat array indexed by that edge number.
+    """
+
+    def __init__(self, lats, lons, offsets, targets, lengths, edge_class, edge_name,
+                 names: List[str], cell_keys, cell_nodes):
+        self.lats = lats
+        self.lons = lons
+        self.offsets = offsets
+        self.targets = targets
+        self.lengths = lengths
+        self.edge_class = edge_class
+        self.edge_name = edge_name
+        self.names = names
+        # nearest-node index: node ids sorted by grid cell, with their cell keys
+        self.cell_keys = cell_keys
+        self.cell_nodes = cell_nodes
+        # reverse adjacency (built on first many-to-many query): incoming edge ids per node
+        self._rev_offsets = None
+        self._rev_edges = None
+        self._edge_sources = None
+
+    @property
+    def num_nodes(self) -> int:
+        return len(self.lats)
+
+    @property
+    def num_edges(self) -> int:
+        return len(self.targets)
+
+    def nearest_node(self, lat: float, lon: float, max_dist_m: float = MAX_SNAP_M) -> Optional[int]:
+        """Return the id of the closest node within ``max_dist_m``, or None."""
+        base_y = int(math.floor(lat / CELL_DEG))
+        base_x = int(math.floor(lon / CELL_DEG))
+        # narrowest side of a cell in metres (longitude shrinks with latitude)
+        cell_m = CELL_DEG * 111320.0 * max(0.01, math.cos(math.radians(lat)))
+        max_ring = int(max_dist_m / cell_m) + 1
+        best = None
+        best_d = max_dist_m
+        for ring in range(max_ring + 1):
+            # every node outside this ring is at least (ring - 1) cells away
+            if best is not None and (ring - 1) * cell_m > best_d:
+                break
+            for dy in range(-ring, ring + 1):
+                for dx in range(-ring, ring + 1):
+                    if max(abs(dy), abs(dx)) != ring:
+                        continue
+                    key = (base_y + dy + 20000) * 100000 + (base_x + dx + 40000)
+                    i = bisect.bisect_left(self.cell_keys, key)
+                    while i < len(self.cell_keys) and self.cell_keys[i] == key:
+                        n = self.cell_nodes[i]
+                        d = haversine_m(lat, lon, self.lats[n], self.lons[n])
+                        if d <= best_d:
+                            best = n
+                            best_d = d
+                        i += 1
+        return best
+
+    def _nodes_in_bbox(self, south: float, west: float, north: float, east: float):
+        for iy in range(int(math.floor(south / CELL_DEG)), int(math.floor(north / CELL_DEG)) + 1):
+            lo = (iy + 20000) * 100000 + int(math.floor(west / CELL_DEG)) + 40000
+            hi = (iy + 20000) * 100000 + int(math.floor(east / CELL_DEG)) + 40000
+            i = bisect.bisect_left(self.cell_keys, lo)
+            while i < len(self.cell_keys) and self.cell_keys[i] <= hi:
+                yield self.cell_nodes[i]
+                i += 1
+
+    def _edge_reach(self) -> Tuple[float, float]:
+        """Largest latitude / longitude span of any single edge (degrees)."""
+        reach = getattr(self, '_reach', None)
+        if reach is None:
+            lats, lons, targets = self.lats, self.lons, self.targets
+            dlat = dlon = 0.0
+            for u in range(self.num_nodes):
+                for e in range(self.offsets[u], self.offsets[u + 1]):
+                    v = targets[e]
+                    dlat = max(dlat, abs(lats[u] - lats[v]))
+                    dlon = max(dlon, abs(lons[u] - lons[v]))
+            self._reach = reach = (dlat, dlon)
+        return reach
+
+    def _edges_named(self, name: str) -> List[int]:
+        index = getattr(self, '_name_edges', None)
+        if index is None:
+            index = {}
+            for e, name_id in enumerate(self.edge_name):
+                if name_id:
+                    index.setdefault(normalize_street_name(self.names[name_id]), []).append(e)
+            self._name_edges = index
+        return index.get(normalize_street_name(name), [])
+
+    def edges_for_hazard(self, name: Optional[str], geometry: Optional[List[List[float]]]) -> List[int]:
+        """Edges covered by a hazard street: same-named edges along its geometry,
+        edges with an endpoint on the polyline, and edges the polyline cuts across or
+        touches. An endpoint on the polyline is usually an intersection node of the
+        hazard street, so the cross streets' edges into it are covered too: a route
+        can't slip across a flooded street at the junction."""
+        if not geometry:
+            return list(self._edges_named(name)) if name else []
+        named = set(self._edges_named(name)) if name else ()
+        lats = [p[0] for p in geometry]
+        lons = [p[1] for p in geometry]
+        pad = HAZARD_MATCH_M / 111320.0
+        south, north = min(lats) - pad, max(lats) + pad
+        west, east = min(lons) - pad, max(lons) + pad
+        # grid-index the hazard's segments so each edge only tests the ones sharing its cells
+        index = HazardIndex()
+        index.insert(0, geometry)
+        found = []
+        # nodes further from the hazard than the longest edge can't have an edge touching it
+        rlat, rlon = self._edge_reach()
+        # one extra cell of margin so long edges crossing the hazard are still seen
+        for u in self._nodes_in_bbox(south - CELL_DEG, west - CELL_DEG, north + CELL_DEG, east + CELL_DEG):
+            a = (self.lats[u], self.lons[u])
+            if not (south - rlat <= a[0] <= north + rlat and west - rlon <= a[1] <= east + rlon):
+                continue
+            for e in range(self.offsets[u], self.offsets[u + 1]):
+                v = self.targets[e]
+                b = (self.lats[v], self.lons[v])
+                inside = (south <= a[0] <= north and west <= a[1] <= east
+                          and south <= b[0] <= north and west <= b[1] <= east)
+                if inside and e in named:
+                    found.append(e)
+                elif index.within(a[0], a[1], HAZARD_MATCH_M) or index.within(b[0], b[1], HAZARD_MATCH_M):
+                    found.append(e)
+                elif max(a[0], b[0]) >= south and min(a[0], b[0]) <= north and \
+                        max(a[1], b[1]) >= west and min(a[1], b[1]) <= east and \
+                        index.crossing_segment(a, b, touching=True):
+                    # (an edge whose bbox misses the hazard's can't cross it: skip the grid test)
+                    found.append(e)
+        return found
+
+    def hazard_penalties(self, hazard_streets: List[dict]) -> Dict[int, float]:
+        """Map edge id -> cost multiplier for every edge covered by a hazard street.
+
+        Computed once per hazard set, so route queries only pay a dict lookup per
+        edge instead of re-running geometric intersection for every candidate path.
+        """
+        penalties: Dict[int, float] = {}
+        for hz in hazard_streets:
+            mult = HAZARD_PENALTIES.get(hz.get('hazard_type'), math.inf)
+            for e in self.edges_for_hazard(hz.get('name'), hz.get('geometry')):
+                if mult > penalties.get(e, 1.0):
+                    penalties[e] = mult
+        return penalties
+
+    def shortest_path(self, source: int, target: int,
+                      penalties: Optional[Dict[int, float]] = None) -> Optional[Tuple[List[int], float]]:
+        """A* from ``source`` to ``target``; returns (node path, cost) or None.
+
+        ``penalties`` maps edge id -> cost multiplier (see hazard_penalties);
+        edges with an infinite multiplier are skipped.
+        """
+        if source == target:
+            return [source], 0.0
+        lats, lons = self.lats, self.lons
+        offsets, targets, lengths = self.offsets, self.targets, self.lengths
+        tlat, tlon = lats[target], lons[target]
+        dist = {source: 0.0}
+        prev: Dict[int, int] = {}
+        heap = [(haversine_m(lats[source], lons[source], tlat, tlon), 0.0, source)]
+        while heap:
+            _, g, u = heapq.heappop(heap)
+            if u == target:
+                break
+            if g > dist[u]:
+                continue
+            for e in range(offsets[u], offsets[u + 1]):
+                v = targets[e]
+                w = lengths[e]
+                if penalties:
+                    mult = penalties.get(e)
+                    if mult is not None:
+                        if mult == math.inf:
+                            continue
+                        w *= mult
+                ng = g + w
+                if ng < dist.get(v, math.inf):
+                    dist[v] = ng
+                    prev[v] = u
+                    heapq.heappush(heap, (ng + haversine_m(lats[v], lons[v], tlat, tlon), ng, v))
+        else:
+            return None
+        path = [target]
+        while path[-1] != source:
+            path.append(prev[path[-1]])
+        path.reverse()
+        return path, dist[target]
+
+    def _reverse(self):
+        """Incoming-edge CSR: node v's incoming edge ids are rev_edges[rev_offsets[v]:rev_offsets[v+1]]."""
+        if self._rev_offsets is None:
+            n, m = self.num_nodes, self.num_edges
+            sources = array.array('i', [0] * m)
+            counts = [0] * (n + 1)
+            for u in range(n):
+                for e in range(self.offsets[u], self.offsets[u + 1]):
+                    sources[e] = u
+                    counts[self.targets[e] + 1] += 1
+            rev_offsets = array.array('i', [0] * (n + 1))
+            for v in range(n):
+                rev_offsets[v + 1] = rev_offsets[v] + counts[v + 1]
+            fill = list(rev_offsets[:-1])
+            rev_edges = array.array('i', [0] * m)
+            for e in range(m):
+                v = self.targets[e]
+                rev_edges[fill[v]] = e
+                fill[v] += 1
+            self._edge_sources, self._rev_edges, self._rev_offsets = sources, rev_edges, rev_offsets
+        return self._rev_offsets, self._rev_edges, self._edge_sources
+
+    def tree(self, root: int, goals, penalties: Optional[Dict[int, float]] = None,
+             reverse: bool = False) -> Dict[int, Tuple[float, float]]:
+        """One-to-many Dijkstra from ``root`` (towards it when ``reverse``), stopping once
+        every node in ``goals`` is settled. Returns goal -> (metres, seconds) along the
+        least-cost path; unreachable goals are missing."""
+        pending = set(goals)
+        found: Dict[int, Tuple[float, float]] = {}
+        if reverse:
+            adj_offsets, adj_edges, ends = self._reverse()
+        else:
+            adj_offsets, adj_edges, ends = self.offsets, None, self.targets
+        lengths, edge_class = self.lengths, self.edge_class
+        cost = {root: 0.0}
+        heap = [(0.0, 0.0, 0.0, root)]
+        while heap and pending:
+            c, metres, secs, u = heapq.heappop(heap)
+            if c > cost[u]:
+                continue
+            if u in pending:
+                pending.discard(u)
+                found[u] = (metres, secs)
+            for i in range(adj_offsets[u], adj_offsets[u + 1]):
+                e = adj_edges[i] if reverse else i
+                w = lengths[e]
+                nc = c + w
+                if penalties:
+                    mult = penalties.get(e)
+                    if mult is not None:
+                        if mult == math.inf:
+                            continue
+                        nc = c + w * mult
+                v = ends[e]
+                if nc < cost.get(v, math.inf):
+                    cost[v] = nc
+                    heapq.heappush(heap, (nc, metres + w, secs + w / CLASS_SPEED_MS[edge_class[e]], v))
+        return found
+
+    def matrix(self, sources: List[int], targets: List[int],
+               penalties: Optional[Dict[int, float]] = None) -> List[List[Optional[Tuple[float, float]]]]:
+        """(metres, seconds) from every source node to every target node (None if unreachable).
+        Runs one tree per node on the smaller side: forward trees from the sources, or
+        trees over the reverse graph from the targets."""
+        if len(targets) <= len(sources):
+            rows = [[None] * len(targets) for _ in sources]
+            goals = set(sources)
+            for j, t in enumerate(targets):
+                found = self.tree(t, goals, penalties, reverse=True)
+                for i, src in enumerate(sources):
+                    rows[i][j] = found.get(src)
+            return rows
+        goals = set(targets)
+        rows = []
+        for src in sources:
+            found = self.tree(src, goals, penalties)
+            rows.append([found.get(t) for t in targets])
+        return rows
+
+    def route(self, origin: List[float], destination: List[float],
+              penalties: Optional[Dict[int, float]] = None) -> Optional[List[List[float]]]:
+        """Street-following route between two [lat, lon] points, or None if
+        either point is outside the extract or no hazard-free path exists."""
+        src = self.nearest_node(origin[0], origin[1])
+        dst = self.nearest_node(destination[0], destination[1])
+        if src is None or dst is None:
+            return None
+        coords = self.route_between(src, dst, penalties)
+        if coords is None:
+            return None
+        return [list(origin)] + coords + [list(destination)]
+
+    def route_between(self, src: int, dst: int,
+                      penalties: Optional[Dict[int, float]] = None) -> Optional[List[List[float]]]:
+        """[lat, lon] of the nodes on the best path between two snapped nodes."""
+        found = self.shortest_path(src, dst, penalties)
+        if found is None:
+            return None
+        path, _ = found
+        return [[self.lats[n], self.lons[n]] for n in path]
+
+
+class _GraphBuilder:
+    """Accumulates ways, then packs them into a RoadGraph."""
+
+    def __init__(self):
+        self.node_ids: Dict[object, int] = {}
+        self.lats = array.array('d')
+        self.lons = array.array('d')
+        self.edges: List[Tuple[int, int, float, int, int]] = []
+        self.names = ['']
+        self.name_ids = {'': 0}
+
+    def _node(self, key, lat: float, lon: float) -> int:
+        n = self.node_ids.get(key)
+        if n is None:
+            n = len(self.lats)
+            self.node_ids[key] = n
+            self.lats.append(lat)
+            self.lons.append(lon)
+        return n
+
+    def add_way(self, points: List[Tuple[object, float, float]], tags: dict):
+        cls = HIGHWAY_CLASS_ID.get(tags.get('highway'))
+        if cls is None or len(points) < 2:
+            return
+        name = tags.get('name', '')
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            name_id = len(self.names)
+            self.name_ids[name] = name_id
+            self.names.append(name)
+        oneway = tags.get('oneway', '')
+        forward = oneway != '-1'
+        backward = not (oneway in ('yes', '1', 'true') or tags.get('junction') == 'roundabout') or oneway == '-1'
+        nodes = [self._node(key, lat, lon) for key, lat, lon in points]
+        for a, b in zip(nodes, nodes[1:]):
+            if a == b:
+                continue
+            d = haversine_m(self.lats[a], self.lons[a], self.lats[b], self.lons[b])
+            if forward:
+                self.edges.append((a, b, d, cls, name_id))
+            if backward:
+                self.edges.append((b, a, d, cls, name_id))
+
+    def build(self) -> RoadGraph:
+        n = len(self.lats)
+        offsets = array.array('q', [0] * (n + 1))
+        for u, _, _, _, _ in self.edges:
+            offsets[u + 1] += 1
+        for i in range(n):
+            offsets[i + 1] += offsets[i]
+        m = len(self.edges)
+        targets = array.array('q', [0] * m)
+        lengths = array.array('d', [0.0] * m)
+        edge_class = array.array('B', [0] * m)
+        edge_name = array.array('l', [0] * m)
+        fill = array.array('q', offsets[:n])
+        for u, v, d, cls, name_id in self.edges:
+            e = fill[u]
+            fill[u] += 1
+            targets[e] = v
+            lengths[e] = d
+            edge_class[e] = cls
+            edge_name[e] = name_id
+        order = sorted(range(n), key=lambda i: cell_key(self.lats[i], self.lons[i]))
+        cell_keys = array.array('q', (cell_key(self.lats[i], self.lons[i]) for i in order))
+        cell_nodes = array.array('q', order)
+        return RoadGraph(self.lats, self.lons, offsets, targets, lengths, edge_class,
+                         edge_name, self.names, cell_keys, cell_nodes)
+
+
+def load_overpass_json(data: dict) -> RoadGraph:
+    """Build a graph from an Overpass JSON response (``out geom`` or ``out body; >; out skel``)."""
+    builder = _GraphBuilder()
+    node_coords = {}
+    for el in data.get('elements', []):
+        if el.get('type') == 'node' and 'lat' in el:
+            node_coords[el['id']] = (el['lat'], el['lon'])
+    for el in data.get('elements', []):
+        if el.get('type') != 'way':
+            continue
+        tags = el.get('tags', {})
+        geom = el.get('geometry')
+        refs = el.get('nodes')
+        if geom and refs and len(refs) == len(geom):
+            points = [(ref, pt['lat'], pt['lon']) for ref, pt in zip(refs, geom) if pt]
+        elif geom:
+            # no node ids: join ways that share an exact coordinate
+            points = [((round(pt['lat'], 7), round(pt['lon'], 7)), pt['lat'], pt['lon']) for pt in geom if pt]
+        elif refs:
+            points = [(ref,) + node_coords[ref] for ref in refs if ref in node_coords]
+        else:
+            continue
+        builder.add_way(points, tags)
+    return builder.build()
+
+
+def load_osm_xml(path: str) -> RoadGraph:
+    """Build a graph from an .osm XML extract."""
+    builder = _GraphBuilder()
+    node_coords = {}
+    for _, elem in ET.iterparse(path, events=('end',)):
+        if elem.tag == 'node':
+            node_coords[int(elem.get('id'))] = (float(elem.get('lat')), float(elem.get('lon')))
+            elem.clear()
+        elif elem.tag == 'way':
+            tags = {t.get('k'): t.get('v') for t in elem.iter('tag')}
+            if tags.get('highway') in HIGHWAY_CLASS_ID:
+                refs = [int(nd.get('ref')) for nd in elem.iter('nd')]
+                points = [(ref,) + node_coords[ref] for ref in refs if ref in node_coords]
+                builder.add_way(points, tags)
+            elem.clear()
+    return builder.build()
+
+
+def load_road_graph(path: str) -> Optional[RoadGraph]:
+    """Load the road network at ``path``; returns None when no extract is present."""
+    if not path or not os.path.exists(path):
+        return None
+    if path.endswith('.osm'):
+        return load_osm_xml(path)
+    with open(path) as f:
+        return load_overpass_json(json.load(f))
+
+
+def fetch_overpass_dump(south: float, west: float, north: float, east: float, out_path: str):
+    """Download every highway way in the bbox from Overpass and save it for load_road_graph."""
+    import httpx
+    import upstream
+    query = f"""
+    [out:json][timeout:180];
+    way({south},{west},{north},{east})["highway"];
+    out geom;
+    """
+    r = httpx.post(upstream.OVERPASS_URL, data={'data': query}, headers=upstream.HEADERS, timeout=200)
+    r.raise_for_status()
+    with open(out_path, 'w') as f:
+        f.write(r.text)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 6 and sys.argv[1] == 'fetch':
+        s, w, n, e = (float(x) for x in sys.argv[2:6])
+        out = sys.argv[6] if len(sys.argv) > 6 else 'road_network.json'
+        fetch_overpass_dump(s, w, n, e, out)
+        g = load_road_graph(out)
+        print(f"Saved {out}: {g.num_nodes} nodes, {g.num_edges} edges")
+    else:
+        print(__doc__)
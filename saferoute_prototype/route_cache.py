@@ -0,0 +1,111 @@
+"""
+Route result cache shared by /compute_route and /find_safe_zone.
+
+Entries are keyed by (snapped origin, destination id) and tagged with the
+hazard_version they were computed under; a lookup only hits an entry of the
+current version. When the hazard set changes, the cache is advanced to the new
+version: entries whose corridor (the route's bbox padded by CORRIDOR_PAD_M)
+overlaps a changed hazard street are dropped, every other entry is carried
+forward, so a hazard on one side of town doesn't flush routes on the other.
+Size is bounded with least-recently-used eviction.
+"""
+
+import math
+import threading
+from collections import OrderedDict
+from typing import Hashable, Iterable, List, Optional, Tuple
+
+DEFAULT_MAX_ENTRIES = 4096
+# Margin around a cached route inside which a hazard change invalidates it
+CORRIDOR_PAD_M = 250
+
+BBox = Tuple[float, float, float, float]
+
+
+def polyline_bbox(coords, pad_m: float = 0.0) -> BBox:
+    """(south, west, north, east) of a polyline, grown by ``pad_m`` metres."""
+    lats = [p[0] for p in coords]
+    lons = [p[1] for p in coords]
+    dlat = pad_m / 111320.0
+    # longitude degrees shrink with latitude; use the widest point of the box
+    coslat = max(0.01, math.cos(math.radians(max(abs(min(lats)), abs(max(lats))))))
+    dlon = pad_m / (111320.0 * coslat)
+    return min(lats) - dlat, min(lons) - dlon, max(lats) + dlat, max(lons) + dlon
+
+
+def bboxes_overlap(a: BBox, b: BBox) -> bool:
+    return not (a[2] < b[0] or b[2] < a[0] or a[3] < b[1] or b[3] < a[1])
+
+
+class RouteCache:
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, corridor_pad_m: float = CORRIDOR_PAD_M,
+                 version: int = 0):
+        self.max_entries = max_entries
+        self.corridor_pad_m = corridor_pad_m
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+        self.carried = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+        # key -> (version, coords, corridor bbox)
+        self._entries: "OrderedDict[Hashable, Tuple[int, List[List[float]], BBox]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, version: int) -> Optional[List[List[float]]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, version: int, coords: List[List[float]]):
+        """Store a route computed under ``version``; ignored if the hazards moved on meanwhile."""
+        if not coords:
+            return
+        corridor = polyline_bbox(coords, self.corridor_pad_m)
+        with self._lock:
+            if version != self.version:
+                return
+            self._entries[key] = (version, coords, corridor)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+
+    def advance(self, version: int, changed: Iterable[BBox]):
+        """Move to hazard ``version``: drop entries whose corridor overlaps a changed
+        hazard bbox and carry the rest forward."""
+        changed = list(changed)
+        with self._lock:
+            previous, self.version = self.version, version
+            for key in list(self._entries):
+                entry_version, coords, corridor = self._entries[key]
+                if entry_version != previous or any(bboxes_overlap(corridor, box) for box in changed):
+                    del self._entries[key]
+                    self.invalidated += 1
+                else:
+                    self._entries[key] = (version, coords, corridor)
+                    self.carried += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / lookups, 3) if lookups else None,
+            'invalidated': self.invalidated,
+            'carried_forward': self.carried,
+            'evicted': self.evicted,
+        }
@@ -0,0 +1,174 @@
+"""
+Safe-zone registry: shelters, schools and named safe areas with real coordinates.
+
+Zones are indexed in a KD-tree over 3D unit vectors, where straight-line
+(chord) distance is monotonic with great-circle distance, so k-nearest
+queries are exact under the haversine metric and cost O(log n). Zones can be
+added and removed live: new zones sit in a small side list and removed ones
+are tombstoned until enough changes pile up to justify a rebuild.
+"""
+
+import heapq
+import math
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from geometry import EARTH_RADIUS_M
+
+# Rebuild the tree once pending adds/removes exceed this share of its size
+_REBUILD_FRACTION = 0.1
+_REBUILD_MIN = 32
+
+
+def _unit_vector(lat: float, lon: float) -> Tuple[float, float, float]:
+    p = math.radians(lat)
+    l = math.radians(lon)
+    return math.cos(p) * math.cos(l), math.cos(p) * math.sin(l), math.sin(p)
+
+
+def chord_to_m(chord: float) -> float:
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, chord / 2))
+
+
+def m_to_chord(metres: float) -> float:
+    return 2 * math.sin(min(math.pi, metres / EARTH_RADIUS_M) / 2)
+
+
+class _KDTree:
+    """Static 3-d tree; node i is (point index, split axis, left node, right node)."""
+
+    def __init__(self, points: List[Tuple[float, float, float]]):
+        self.points = points
+        self.nodes: List[Tuple[int, int, int, int]] = []
+        self.root = self._build(list(range(len(points))), 0)
+
+    def _build(self, idx: List[int], depth: int) -> int:
+        if not idx:
+            return -1
+        axis = depth % 3
+        idx.sort(key=lambda i: self.points[i][axis])
+        mid = len(idx) // 2
+        slot = len(self.nodes)
+        self.nodes.append((idx[mid], axis, -1, -1))
+        left = self._build(idx[:mid], depth + 1)
+        right = self._build(idx[mid + 1:], depth + 1)
+        self.nodes[slot] = (idx[mid], axis, left, right)
+        return slot
+
+    def nearest(self, q: Tuple[float, float, float], k: int, max_chord: float, accept) -> List[Tuple[float, int]]:
+        """k closest accepted points within max_chord, as (chord distance, point index) nearest first."""
+        best: List[Tuple[float, int]] = []  # max-heap of (-dist, idx)
+        stack = [self.root] if self.root >= 0 else []
+        while stack:
+            node = stack.pop()
+            i, axis, left, right = self.nodes[node]
+            p = self.points[i]
+            d = math.sqrt((p[0] - q[0]) ** 2 + (p[1] - q[1]) ** 2 + (p[2] - q[2]) ** 2)
+            bound = -best[0][0] if len(best) == k else max_chord
+            if d <= bound and accept(i):
+                heapq.heappush(best, (-d, i))
+                if len(best) > k:
+                    heapq.heappop(best)
+            diff = q[axis] - p[axis]
+            near, far = (left, right) if diff < 0 else (right, left)
+            bound = -best[0][0] if len(best) == k else max_chord
+            if far >= 0 and abs(diff) <= bound:
+                stack.append(far)
+            if near >= 0:
+                stack.append(near)
+        return sorted((-nd, i) for nd, i in best)
+
+
+class SafeZoneRegistry:
+    def __init__(self):
+        self._zones: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._tree: Optional[_KDTree] = None
+        self._tree_ids: List[str] = []
+        self._pending: Dict[str, Tuple[float, float, float]] = {}
+        self._removed = set()
+
+    def __len__(self) -> int:
+        return len(self._zones)
+
+    def __contains__(self, zone_id: str) -> bool:
+        return zone_id in self._zones
+
+    def get(self, zone_id: str) -> Optional[dict]:
+        return self._zones.get(zone_id)
+
+    def all(self) -> List[dict]:
+        with self._lock:
+            return list(self._zones.values())
+
+    def add(self, zone_id: str, name: str, lat: float, lon: float, capacity: Optional[int] = None,
+            kind: str = 'shelter') -> dict:
+        """Add or replace a safe zone."""
+        zone = {'id': zone_id, 'name': name, 'lat': float(lat), 'lon': float(lon),
+                'capacity': capacity, 'kind': kind}
+        with self._lock:
+            if zone_id in self._zones:
+                self._removed.add(zone_id)
+            self._zones[zone_id] = zone
+            self._pending[zone_id] = _unit_vector(zone['lat'], zone['lon'])
+            self._maybe_rebuild()
+        return zone
+
+    def remove(self, zone_id: str) -> bool:
+        with self._lock:
+            if self._zones.pop(zone_id, None) is None:
+                return False
+            self._pending.pop(zone_id, None)
+            self._removed.add(zone_id)
+            self._maybe_rebuild()
+        return True
+
+    def set_capacity(self, zone_id: str, capacity: Optional[int]) -> bool:
+        with self._lock:
+            zone = self._zones.get(zone_id)
+            if zone is None:
+                return False
+            zone['capacity'] = capacity
+        return True
+
+    def _maybe_rebuild(self):
+        changes = len(self._pending) + len(self._removed)
+        if changes > max(_REBUILD_MIN, _REBUILD_FRACTION * len(self._tree_ids)):
+            self._rebuild()
+
+    def _rebuild(self):
+        ids = list(self._zones)
+        self._tree = _KDTree([_unit_vector(self._zones[z]['lat'], self._zones[z]['lon']) for z in ids])
+        self._tree_ids = ids
+        self._pending = {}
+        self._removed = set()
+
+    def nearest(self, lat: float, lon: float, k: int = 1, max_dist_m: Optional[float] = None,
+                min_capacity: Optional[int] = None) -> List[Tuple[dict, float]]:
+        """Up to k zones nearest to lat/lon as (zone, distance in metres), nearest first.
+        ``min_capacity`` skips zones with a known capacity below it."""
+        q = _unit_vector(lat, lon)
+        max_chord = m_to_chord(max_dist_m) if max_dist_m is not None else 2.0
+        with self._lock:
+            tree, tree_ids = self._tree, self._tree_ids
+            pending = dict(self._pending)
+            removed = set(self._removed)
+            zones = self._zones
+
+            def accept_id(zone_id):
+                zone = zones.get(zone_id)
+                if zone is None:
+                    return False
+                cap = zone.get('capacity')
+                return min_capacity is None or cap is None or cap >= min_capacity
+
+            found = []
+            if tree is not None:
+                accept = lambda i: tree_ids[i] not in removed and tree_ids[i] not in pending and accept_id(tree_ids[i])
+                found = [(d, tree_ids[i]) for d, i in tree.nearest(q, k, max_chord, accept)]
+            for zone_id, p in pending.items():
+                d = math.sqrt((p[0] - q[0]) ** 2 + (p[1] - q[1]) ** 2 + (p[2] - q[2]) ** 2)
+                if d <= max_chord and accept_id(zone_id):
+                    found.append((d, zone_id))
+            found.sort()
+            return [(zones[zone_id], chord_to_m(d)) for d, zone_id in found[:k]]
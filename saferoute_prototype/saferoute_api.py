@@ -6,23 +6,73 @@ Local functional prototype demonstrating SafeRoute AI logic
 with a lightweight FastAPI web UI for offline simulation.
 """
 
-from fastapi import FastAPI
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import FastAPI, Header, Request
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from contextlib import asynccontextmanager
 import random, json, time
-import requests
-import sqlite3
+import asyncio
 import threading
 import math
+import os
+import re
+import sqlite3
+from collections import OrderedDict
 from typing import List, Tuple, Optional
 
+import contraction
+from event_bus import TOPICS, EventBus, client_topic
+from geocode_cache import GeocodeCache, normalize_address
+from geometry import haversine_m, nearest_index, polyline_length_m, polylines_crossed, seg_intersect
+from hazard_feed import HazardFeed, HazardSet, HazardUpdate
+from hazard_index import HazardIndex
+from incremental_route import ActiveRouteTracker
+from metrics import (CONTENT_TYPE, FALLBACKS, REGISTRY, STAGE_SECONDS, MetricsMiddleware, RequestProfiler,
+                     count_error, stats_gauges)
+from overpass_cache import OverpassTileCache, TooManyTiles, element_points
+from resilience import revalidate
+from road_graph import CONNECTOR_SPEED_MS, load_road_graph
+from route_cache import RouteCache, polyline_bbox
+from safe_zones import SafeZoneRegistry
+from shelter_assignment import Group, ShelterAssigner
+import snapshot
+from sos_store import DEFAULT_COMMIT_TIMEOUT, DEFAULT_PAGE_LIMIT, SOSStore, make_cursor, new_sos_id, sos_id_ms
+from state_hub import StateHub
+from state_store import DEFAULT_MAX_RECENT_SOS, HAZARD_TYPE_KINDS, StateStore
+import upstream
+
 # Overpass helper: fetch way geometry by name near a point
-def fetch_way_geometry(way_name, around_lat=None, around_lon=None, radius=2000):
+# A candidate whose centroid is this close to the query point ends the search early
+WAY_MATCH_THRESHOLD_M = 300
+# Memoized fetch_way_geometry results keyed by (name, bbox), least recently used evicted first
+WAY_GEOMETRY_MEMO_SIZE = 1024
+way_geometry_memo = OrderedDict()
+
+def _way_candidates(data):
+    coords_list = []
+    for el in data.get('elements', []):
+        if el.get('type') == 'way' and 'geometry' in el:
+            coords_list.append([[pt['lat'], pt['lon']] for pt in el['geometry']])
+    return coords_list
+
+def _closest_candidate(candidates, around_lat, around_lon):
+    """(geometry, centroid distance in metres) of the candidate nearest the point."""
+    if around_lat is None or around_lon is None:
+        return candidates[0], 0.0
+    # compute centroid distances in one batch
+    centroids = [[sum(p[0] for p in coords)/len(coords), sum(p[1] for p in coords)/len(coords)]
+                 for coords in candidates]
+    best, dist = nearest_index(centroids, around_lat, around_lon)
+    return candidates[best], dist
+
+async def fetch_way_geometry(way_name, around_lat=None, around_lon=None, radius=2000):
     """Query Overpass API to find a way with a given name near the provided lat/lon.
     Returns an array of [lat, lon] pairs if found, otherwise None.
     """
     try:
         # Build a bounding area around the point if provided
         bbox_clause = ''
+        bbox = None
         if around_lat is not None and around_lon is not None:
             # small bbox in degrees (~radius meters) — approximate
             delta = radius / 111320.0
@@ -31,153 +81,351 @@ def fetch_way_geometry(way_name, around_lat=None, around_lon=None, radius=2000):
             west = around_lon - delta
             east = around_lon + delta
             bbox_clause = f'({south},{west},{north},{east})'
+            bbox = tuple(round(v, 5) for v in (south, west, north, east))
+
+        memo_key = (way_name.lower(), bbox)
+        if memo_key in way_geometry_memo:
+            way_geometry_memo.move_to_end(memo_key)
+            return way_geometry_memo[memo_key]
 
-        # Overpass QL: try several name variants (exact, contains) and return the closest way
+        # Overpass QL: try several name variants (exact, contains, first word) and return the closest way
         candidates = []
-        # exact match
-        queries = [f"way{bbox_clause}[\"highway\"][\"name\"~\"^{way_name}$\", i]; out geom;",
-                   f"way{bbox_clause}[\"highway\"][\"name\"~\"{way_name}\", i]; out geom;",
-                   f"way{bbox_clause}[\"highway\"][\"name\"~\"{way_name.split()[0]}\", i]; out geom;"]
-        url = 'https://overpass-api.de/api/interpreter'
-        headers = {'User-Agent': 'SafeRoutePrototype/1.0'}
-        for q in queries:
-            query = f"""
+        patterns = [f"^{way_name}$", way_name, way_name.split()[0]]
+        complete = True
+        # Match the same name variants locally when the tile cache already holds the whole bbox
+        cached = await overpass_tiles.query('streets', south, west, north, east) if bbox_clause else None
+        if cached is not None:
+            for el in cached:
+                name = el.get('tags', {}).get('name', '')
+                try:
+                    matched = any(re.search(p, name, re.I) for p in patterns)
+                except re.error:
+                    matched = way_name.lower() in name.lower()
+                if matched and el.get('geometry'):
+                    candidates.append([[pt['lat'], pt['lon']] for pt in el['geometry']])
+        else:
+            # Run the variants concurrently, merging results as they arrive; once a
+            # candidate is within WAY_MATCH_THRESHOLD_M the remaining queries are cancelled
+            queries = [f"""
             [out:json][timeout:25];
-            {q}
-            """
+            way{bbox_clause}["highway"]["name"~"{p}", i]; out geom;
+            """ for p in patterns]
+            tasks = [asyncio.create_task(upstream.overpass(q)) for q in queries]
             try:
-                r = requests.post(url, data={'data': query}, headers=headers, timeout=15)
-                r.raise_for_status()
-                data = r.json()
-                if 'elements' in data and len(data['elements'])>0:
-                    for el in data['elements']:
-                        if el.get('type') == 'way' and 'geometry' in el:
-                            geom = el['geometry']
-                            coords = [[pt['lat'], pt['lon']] for pt in geom]
-                            candidates.append(coords)
-            except Exception:
-                continue
-
-        # If we have multiple candidates, pick the one closest to around_lat/lon
-        if candidates:
-            if around_lat is None or around_lon is None:
-                return candidates[0]
-            best = None
-            best_d = None
-            for coords in candidates:
-                # compute centroid distance
-                cx = sum(p[0] for p in coords)/len(coords)
-                cy = sum(p[1] for p in coords)/len(coords)
-                d = math.hypot(cx-around_lat, cy-around_lon)
-                if best is None or d < best_d:
-                    best = coords
-                    best_d = d
-            return best
-        return None
-    except Exception:
-        pass
+                for next_done in asyncio.as_completed(tasks):
+                    try:
+                        candidates.extend(_way_candidates(await next_done))
+                    except Exception as e:
+                        count_error('way_geometry', e)
+                        complete = False
+                        continue
+                    if candidates and _closest_candidate(candidates, around_lat, around_lon)[1] <= WAY_MATCH_THRESHOLD_M:
+                        break
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+        result = _closest_candidate(candidates, around_lat, around_lon)[0] if candidates else None
+        # Don't remember a miss caused by a failed query
+        if result is not None or complete:
+            way_geometry_memo[memo_key] = result
+            if len(way_geometry_memo) > WAY_GEOMETRY_MEMO_SIZE:
+                way_geometry_memo.popitem(last=False)
+        return result
+    except Exception as e:
+        count_error('way_geometry', e)
     return None
 
-app = FastAPI(title="SafeRoute Prototype")
-
-# --- SQLite setup for persistent SOS pings ---
-DB_PATH = '/workspaces/SafeRouteApp/saferoute_prototype/saferoute.db'
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''
-    CREATE TABLE IF NOT EXISTS sos_pings (
-        id TEXT PRIMARY KEY,
-        lat REAL,
-        lon REAL,
-        message TEXT,
-        survivors INTEGER,
-        timestamp TEXT
-    )
-    ''')
-    conn.commit()
-    conn.close()
-
-init_db()
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    # stop the hazard feed, snapshot its state, close the pooled upstream connections and flush queued SOS writes
+    hazard_feed.stop()
+    if state_hub.is_authority:
+        await run_in_threadpool(save_snapshot)
+    state_hub.stop()
+    await upstream.close_client()
+    sos_store.close()
+
+app = FastAPI(title="SafeRoute Prototype", lifespan=lifespan)
+# Per-route latency histograms for /metrics, plus sampled cProfile dumps (SAFEROUTE_PROFILE_*)
+app.add_middleware(MetricsMiddleware, profiler=RequestProfiler.from_env())
+
+# --- Local road network (in-process routing, OSRM is only a fallback) ---
+ROAD_GRAPH_PATH = os.environ.get('SAFEROUTE_ROAD_GRAPH',
+                                 os.path.join(os.path.dirname(os.path.abspath(__file__)), 'road_network.json'))
+# Memory-mapped snapshot of the graph, safe zones and hazards (snapshot.py): workers map the graph
+# instead of parsing the extract; rewritten when it is stale and on shutdown
+SNAPSHOT_PATH = os.environ.get('SAFEROUTE_SNAPSHOT', os.path.splitext(ROAD_GRAPH_PATH)[0] + '.snap')
+startup_snapshot = snapshot.load(SNAPSHOT_PATH)
+if startup_snapshot is not None and startup_snapshot.matches(ROAD_GRAPH_PATH):
+    road_graph = startup_snapshot.graph
+else:
+    road_graph = load_road_graph(ROAD_GRAPH_PATH)
+# Contraction hierarchy + hub labels built offline (python contraction.py build); A* without one
+CH_INDEX_PATH = os.environ.get('SAFEROUTE_CH_INDEX', os.path.splitext(ROAD_GRAPH_PATH)[0] + '.ch')
+ch_index = contraction.load(CH_INDEX_PATH, road_graph)
+
+# --- SQLite setup for persistent SOS pings (WAL, pooled readers, batched writes) ---
+DB_PATH = os.environ.get('SAFEROUTE_DB', '/workspaces/SafeRouteApp/saferoute_prototype/saferoute.db')
+sos_store = SOSStore(DB_PATH)
+# POST /sos answers 503 when its batch has not committed within this long (e.g. database locked)
+SOS_COMMIT_TIMEOUT = float(os.environ.get('SAFEROUTE_SOS_COMMIT_TIMEOUT', DEFAULT_COMMIT_TIMEOUT))
 
 def save_sos_to_db(ping: dict):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('INSERT INTO sos_pings (id, lat, lon, message, survivors, timestamp) VALUES (?, ?, ?, ?, ?, ?)',
-              (ping['id'], ping['location']['lat'], ping['location']['lon'], ping['message'], ping['survivors'], ping['timestamp']))
-    conn.commit()
-    conn.close()
+    sos_store.save(ping, timeout=SOS_COMMIT_TIMEOUT)
 
 def load_all_sos_from_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('SELECT id, lat, lon, message, survivors, timestamp FROM sos_pings ORDER BY timestamp DESC')
-    rows = c.fetchall()
-    conn.close()
-    result = []
-    for r in rows:
-        result.append({'id': r[0], 'location': {'lat': r[1], 'lon': r[2]}, 'message': r[3], 'survivors': r[4], 'timestamp': r[5]})
-    return result
+    return sos_store.load_all()
 
-# --- Geometry helpers ---
-def seg_intersect(a: Tuple[float,float], b: Tuple[float,float], c: Tuple[float,float], d: Tuple[float,float]) -> bool:
-    # Check if segment AB intersects CD using orientation tests
-    def orient(p, q, r):
-        return (q[1]-p[1])*(r[0]-q[0]) - (q[0]-p[0])*(r[1]-q[1])
-    def on_seg(p,q,r):
-        return min(p[0],r[0]) <= q[0] <= max(p[0],r[0]) and min(p[1],r[1]) <= q[1] <= max(p[1],r[1])
-    p, q, r, s = a, b, c, d
-    o1 = orient(p,q,r)
-    o2 = orient(p,q,s)
-    o3 = orient(r,s,p)
-    o4 = orient(r,s,q)
-    if o1*o2 < 0 and o3*o4 < 0:
-        return True
-    return False
+# Snapping grid (degrees, ~100 m) for route cache keys when the road graph can't snap a point
+ROUTE_CELL_DEG = 0.001
+
+def route_cell(point):
+    return (round(point[0] / ROUTE_CELL_DEG), round(point[1] / ROUTE_CELL_DEG))
+
+def local_route(origin, destination, penalties=None, version=None, dest_id=None):
+    """Route over the local road graph (avoiding hazard-penalised edges), or None.
+    With the ``version`` of ``penalties`` the node path is served from / stored in the
+    route cache under (origin node, ``dest_id`` or destination node)."""
+    if road_graph is None:
+        return None
+    src = road_graph.nearest_node(origin[0], origin[1])
+    dst = road_graph.nearest_node(destination[0], destination[1])
+    if src is None or dst is None:
+        return None
+    key = ('graph', src, dest_id if dest_id is not None else dst)
+    coords = route_cache.get(key, version) if version is not None else None
+    if coords is None:
+        coords = (ch_index or road_graph).route_between(src, dst, penalties)
+        if coords is None:
+            return None
+        if version is not None:
+            route_cache.put(key, version, coords)
+    return [list(origin)] + coords + [list(destination)]
+
+def local_graph_covers(origin, destination):
+    return (road_graph is not None and road_graph.nearest_node(*origin) is not None
+            and road_graph.nearest_node(*destination) is not None)
+
+def evacuation_matrix(origins, zones, penalties=None):
+    """Road distance (m) and travel time (s) from every [lat, lon] origin to every safe zone,
+    computed from one-to-many trees over the road graph rather than N x M searches.
+    Cells are None when either end is off the graph or no hazard-free path exists."""
+    def snap(lat, lon):
+        node = road_graph.nearest_node(lat, lon)
+        if node is None:
+            return None, 0.0
+        return node, haversine_m(lat, lon, road_graph.lats[node], road_graph.lons[node])
+    src = [snap(o[0], o[1]) for o in origins]
+    dst = [snap(z['lat'], z['lon']) for z in zones]
+    src_nodes = list({n for n, _ in src if n is not None})
+    dst_nodes = list({n for n, _ in dst if n is not None})
+    cells = road_graph.matrix(src_nodes, dst_nodes, penalties) if src_nodes and dst_nodes else []
+    src_pos = {n: i for i, n in enumerate(src_nodes)}
+    dst_pos = {n: j for j, n in enumerate(dst_nodes)}
+    distance, duration = [], []
+    for s_node, s_leg in src:
+        drow, trow = [], []
+        for d_node, d_leg in dst:
+            cell = None
+            if s_node is not None and d_node is not None:
+                cell = cells[src_pos[s_node]][dst_pos[d_node]]
+            if cell is None:
+                drow.append(None)
+                trow.append(None)
+            else:
+                legs = s_leg + d_leg  # off-network legs to / from the snapped nodes
+                drow.append(cell[0] + legs)
+                trow.append(cell[1] + legs / CONNECTOR_SPEED_MS)
+        distance.append(drow)
+        duration.append(trow)
+    return distance, duration
+
+async def plan_route(origin, destination, penalties=None, osrm_task=None, version=None, dest_id=None):
+    """Local road graph first, then OSRM (optionally already in flight), then a direct line.
+    Graph search is CPU-bound, so it runs in the threadpool to keep the event loop free.
+    Graph and OSRM routes are cached per hazard ``version`` (see local_route)."""
+    route = await run_in_threadpool(local_route, origin, destination, penalties, version, dest_id)
+    if route is not None:
+        if osrm_task is not None:
+            osrm_task.cancel()
+        return route
+    FALLBACKS.inc(kind='route_graph_miss_osrm')
+    key = ('osrm', route_cell(origin), dest_id if dest_id is not None else route_cell(destination))
+    cached = route_cache.get(key, version) if version is not None else None
+    if cached is not None:
+        if osrm_task is not None:
+            osrm_task.cancel()
+        return [list(origin)] + cached + [list(destination)]
+    route = await (osrm_task if osrm_task is not None else upstream.osrm_route(origin, destination))
+    if route is None:
+        FALLBACKS.inc(kind='osrm_failed_straight_line')
+        return [origin, destination]
+    if version is not None and len(route) > 2:
+        route_cache.put(key, version, route[1:-1])
+    return route
+
+# --- Overpass tile cache (shared by all workers, warmed by `python overpass_cache.py prefetch`) ---
+OVERPASS_CACHE_PATH = os.environ.get('SAFEROUTE_OVERPASS_CACHE',
+                                     os.path.join(os.path.dirname(DB_PATH), 'overpass_cache.db'))
+overpass_tiles = OverpassTileCache(OVERPASS_CACHE_PATH)
+
+# --- Geocoding (Nominatim behind a persistent cache shared by all workers) ---
+GEOCODE_CACHE_PATH = os.environ.get('SAFEROUTE_GEOCODE_CACHE',
+                                    os.path.join(os.path.dirname(DB_PATH), 'geocode_cache.db'))
+geocode_cache = GeocodeCache(GEOCODE_CACHE_PATH)
+
+async def fetch_geocode(address):
+    items = await upstream.nominatim_search(address, limit=1)
+    coords = [float(items[0]['lat']), float(items[0]['lon'])] if items else None
+    await run_in_threadpool(geocode_cache.put, address, coords)
+    return coords
+
+async def geocode(address):
+    """Resolve an address to [lat, lon] via the cache, then Nominatim; None if not found.
+    An expired entry is answered right away and refreshed in the background."""
+    state, coords = await run_in_threadpool(geocode_cache.lookup, address)
+    if state == 'fresh':
+        return coords
+    if state == 'stale':
+        revalidate('geocode', normalize_address(address), lambda: fetch_geocode(address))
+        return coords
+    try:
+        return await fetch_geocode(address)
+    except Exception as e:
+        # transient failure: don't cache, try Nominatim again next time
+        count_error('geocode', e)
+        return None
 
+# --- Geometry helpers ---
 def polyline_intersects(poly: List[List[float]], a: Tuple[float,float], b: Tuple[float,float]) -> bool:
     for i in range(len(poly)-1):
         if seg_intersect((poly[i][0], poly[i][1]), (poly[i+1][0], poly[i+1][1]), a, b):
             return True
     return False
 
-# --- Hazard simulation / auto-reroute ---
+# --- Live hazards (hazard feed) / auto-reroute ---
 hazard_lock = threading.Lock()
 hazard_version = 0
+# Road-graph edge penalties implied by the active hazards; replaced, never mutated, on each change
+active_hazard_penalties = {}
+# Grid index over the active hazard street segments for crossing / proximity queries
+hazard_index = HazardIndex()
+# Server-sent events for SOS pings, hazard changes and route invalidations (GET /events)
+event_bus = EventBus()
+# Routes per (origin, destination) at the current hazard_version, advanced on every change
+route_cache = RouteCache(version=hazard_version)
+# Latest route of each client that passed a client_id, repaired in place (LPA*) on hazard changes
+route_tracker = ActiveRouteTracker(road_graph) if road_graph is not None else None
+
+def live_hazard_penalties():
+    """(edge penalties, hazard_version) as of now."""
+    with hazard_lock:
+        return active_hazard_penalties, hazard_version
+
+async def track_route(client_id, origin, destination, penalties, version):
+    """Route for a client and keep it for repairs; caught up at once if a hazard batch
+    committed after ``penalties`` were read (its repair pass may have run before it was tracked)."""
+    return await run_in_threadpool(route_tracker.track, client_id, origin, destination, penalties, version,
+                                   live_hazard_penalties)
+
+async def repair_active_routes(penalties, changed_edges, version):
+    """Repair the tracked routes a penalty change reaches and push each new route to its client only."""
+    updates = await run_in_threadpool(route_tracker.repair, penalties, changed_edges, version)
+    for client_id, route in updates:
+        event_bus.publish('route_update', {'hazard_version': version, 'route': route}, topic=client_topic(client_id))
+
+def schedule_route_repair(penalties, changed_edges, version):
+    if route_tracker is None or not changed_edges or not len(route_tracker):
+        return
+    try:
+        asyncio.get_running_loop().create_task(repair_active_routes(penalties, changed_edges, version))
+    except RuntimeError:
+        # not on the event loop (e.g. a feed thread): repair inline
+        for client_id, route in route_tracker.repair(penalties, changed_edges, version):
+            event_bus.publish('route_update', {'hazard_version': version, 'route': route}, topic=client_topic(client_id))
+
+def publish_hazard_change(version, bbox=None):
+    """Tell subscribers the hazard state moved to ``version``; ``bbox`` (south, west, north, east)
+    bounds the streets that changed, None means routes anywhere may be affected."""
+    event_bus.publish('hazard', {'hazard_version': version, 'flood_zones': state_store.hazards('flood_zones')})
+    event_bus.publish('route_invalidated', {'hazard_version': version, 'bbox': bbox})
+
+def apply_hazard_delta(delta, version=None):
+    """Commit one hazard feed batch: the spatial index, the named hazard areas and the edge
+    penalties move together under a single hazard_version bump (or to the authority's
+    ``version`` on a replica). Returns that version."""
+    global active_hazard_penalties, hazard_version
+    with hazard_lock:
+        for hz in delta.removed:
+            for i in range(len(hz.parts)):
+                hazard_index.remove((hz.id, i))
+        for hz in delta.upserted:
+            for i, part in enumerate(hz.parts):
+                hazard_index.insert((hz.id, i), part, hz.hazard_type, hz.name or hz.id)
+        for hazard_type, name in delta.names_removed:
+            if hazard_type in HAZARD_TYPE_KINDS:
+                state_store.set_hazard(HAZARD_TYPE_KINDS[hazard_type], name, False)
+        for hazard_type, name in delta.names_added:
+            if hazard_type in HAZARD_TYPE_KINDS:
+                state_store.set_hazard(HAZARD_TYPE_KINDS[hazard_type], name, True)
+        active_hazard_penalties = delta.penalties
+        hazard_version = version if version is not None else hazard_version + 1
+        changed = delta.changed_geometries()
+        # only cached routes whose corridor touches a changed hazard are dropped
+        route_cache.advance(hazard_version, [polyline_bbox(g) for g in changed])
+        version = hazard_version
+    pts = [p for geometry in changed for p in geometry]
+    bbox = [min(p[0] for p in pts), min(p[1] for p in pts), max(p[0] for p in pts), max(p[1] for p in pts)] if pts else None
+    publish_hazard_change(version, bbox)
+    schedule_route_repair(delta.penalties, delta.changed_edges, version)
+    return version
 
-def hazard_simulator():
-    global hazard_version
-    toggle = True
-    while True:
-        time.sleep(10)
-        with hazard_lock:
-            # flip a simulated flooded street presence
-            try:
-                if toggle:
-                    if 'Downtown Riverfront' not in hazard_data['flood_zones']:
-                        hazard_data['flood_zones'].append('Downtown Riverfront')
-                else:
-                    if 'Downtown Riverfront' in hazard_data['flood_zones']:
-                        hazard_data['flood_zones'].remove('Downtown Riverfront')
-                hazard_version += 1
-                toggle = not toggle
-            except NameError:
-                # hazard_data not yet initialized, skip until next iteration
-                continue
-
-# Note: start simulator after hazard_data is defined (below)
+# Hazard updates stream in from SAFEROUTE_HAZARD_FEED: comma-separated files (followed like
+# tail -f), tcp://host:port or unix:/path listeners, carrying GeoJSON lines or CAP alerts
+HAZARD_FEED_SOURCES = [s.strip() for s in os.environ.get('SAFEROUTE_HAZARD_FEED', '').split(',') if s.strip()]
+hazard_feed = HazardFeed(HAZARD_FEED_SOURCES, HazardSet(road_graph), lambda delta: commit_hazard_delta(delta))
+
+# Note: the feed is started after state_store is defined (below)
 
 # ---- Mock environment ----
 OFFLINE_MODE = False
 ACTIVE_MODEL = "LMStudio-Edge-AI-v1"
 SAFE_AREAS = ["North Ridge Shelter", "East High Gym", "City Hall", "Hilltop Church"]
+# Demo coordinates (Kalispell, MT) and capacities of the named safe areas
+SAFE_AREA_LOCATIONS = {
+    "North Ridge Shelter": (48.2203, -114.3109, 250),
+    "East High Gym": (48.2011, -114.2893, 400),
+    "City Hall": (48.1968, -114.3118, 150),
+    "Hilltop Church": (48.1857, -114.3329, 120),
+}
+
+# ---- Safe-zone registry (KD-tree over shelters and schools seen via Overpass) ----
+safe_zones = SafeZoneRegistry()
+for _name, (_lat, _lon, _cap) in SAFE_AREA_LOCATIONS.items():
+    safe_zones.add(f"area:{_name}", _name, _lat, _lon, _cap, 'shelter')
+
+def register_schools(elements):
+    """Add Overpass school elements to the safe-zone registry (once per OSM id)."""
+    for el in elements:
+        pts = element_points(el)
+        zone_id = f"osm:{el.get('type')}/{el.get('id')}"
+        if not pts or zone_id in safe_zones:
+            continue
+        tags = el.get('tags', {})
+        try:
+            capacity = int(tags['capacity'])
+        except (KeyError, ValueError):
+            capacity = None
+        safe_zones.add(zone_id, tags.get('name', 'School'), pts[0][0], pts[0][1], capacity, 'school')
 
-hazard_data = {
+# ---- Live hazard areas and recent SOS pings (bounded ring, O(1) counters) ----
+state_store = StateStore({
     "flood_zones": ["Downtown Riverfront", "Harbor District"],
     "closed_roads": ["Main St", "Bridge Ave", "Riverside Blvd"],
     "power_outages": ["Industrial Park", "West Valley"],
-    "sos_pings": []
-}
+}, max_recent_sos=int(os.environ.get('SAFEROUTE_RECENT_SOS', DEFAULT_MAX_RECENT_SOS)))
 
 # ---- Core AI logic ----
 class SafeRouteAI:
@@ -188,12 +436,20 @@ class SafeRouteAI:
         return {
             "mode": "Offline" if self.offline else "Edge Connected",
             "active_model": ACTIVE_MODEL,
-            "hazard_summary": {
-                "flood_zones": len(hazard_data["flood_zones"]),
-                "closed_roads": len(hazard_data["closed_roads"]),
-                "power_outages": len(hazard_data["power_outages"]),
-                "active_sos": len(hazard_data["sos_pings"])
-            }
+            "routing_engine": ("hub_labels" if ch_index is not None else "local") if road_graph is not None else "osrm",
+            "routing_index": ch_index.stats() if ch_index is not None else None,
+            "snapshot": dict(startup_snapshot.stats(), graph_mapped=startup_snapshot.graph is road_graph)
+                        if startup_snapshot is not None else None,
+            "geocode_cache": geocode_cache.stats(),
+            "overpass_cache": overpass_tiles.stats(),
+            "events": event_bus.stats(),
+            "route_cache": route_cache.stats(),
+            "active_routes": route_tracker.stats() if route_tracker is not None else None,
+            "hazard_feed": hazard_feed.stats(),
+            "workers": state_hub.stats(),
+            "hazard_version": hazard_version,
+            "upstreams": upstream.stats(),
+            "hazard_summary": state_store.summary()
         }
 
     def generate_route(self, start="User Location"):
@@ -202,18 +458,21 @@ class SafeRouteAI:
             "start": start,
             "destination": destination,
             "path": ["User Location", "Hill St", "Maple Ave", destination],
-            "hazards_nearby": [hz for hz, zones in hazard_data.items() if "Downtown" in str(zones)]
+            "hazards_nearby": state_store.hazards_matching("Downtown")
         }
         return route
 
     def send_sos(self, survivors=1, location="User Location"):
-        sos_id = f"SOS-{random.randint(1000,9999)}"
-        hazard_data["sos_pings"].append({
+        sos_id = new_sos_id()
+        ping = {
             "id": sos_id,
             "location": location,
             "survivors": survivors,
-            "timestamp": time.ctime()
-        })
+            "timestamp": time.ctime(),
+            "ts": sos_id_ms(sos_id)
+        }
+        state_store.add_sos(ping)
+        state_hub.send({'op': 'sos', 'ping': ping, 'publish': False})
         return {"status": "SOS Sent", "id": sos_id}
 
 ai = SafeRouteAI()
@@ -342,15 +601,21 @@ def home():
                 let scenarioData = null;
                 let autoRouteInterval = null;
                 let lastHazardVersion = null;
+                let lastRoute = null;
+                // identifies this tab's tracked route: repaired routes arrive as route_update events
+                const clientId = (window.crypto && crypto.randomUUID) ? crypto.randomUUID() : Date.now() + '-' + Math.random().toString(36).slice(2);
+                let safeLine = null;
 
                 async function fetchAndDrawRoute(origin, destination){
                     try{
-                        const params = new URLSearchParams({ start_lat: origin[0], start_lon: origin[1], dest_lat: destination[0], dest_lon: destination[1] });
+                        lastRoute = [origin, destination];
+                        const params = new URLSearchParams({ start_lat: origin[0], start_lon: origin[1], dest_lat: destination[0], dest_lon: destination[1], client_id: clientId });
                         const res = await fetch('/compute_route?'+params.toString());
                         const data = await res.json();
                         if(!data || !data.route) return;
                         clearRoute();
                         const poly = L.polyline(data.route, {color:'#00AFFF', weight:5}).addTo(routes);
+                        safeLine = poly;
                         // draw destination marker
                         const dest = data.route[data.route.length-1];
                         L.marker(dest).addTo(routes).bindPopup('Destination').openPopup();
@@ -367,9 +632,22 @@ def home():
                         const survivors = parseInt(prompt('Number of survivors (1-10):', '1')) || 1;
                         const message = prompt('Message (optional):', 'Need assistance');
                         const body = { lat: userLatLng[0], lon: userLatLng[1], message, survivors };
-                        const res = await fetch('/sos', { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(body) });
-                        const data = await res.json();
-                        if(!data || !data.id){ alert('SOS failed'); return; }
+                        // one key per SOS: retries over a flaky link resolve to the same stored ping
+                        const key = (window.crypto && crypto.randomUUID) ? crypto.randomUUID() : Date.now() + '-' + Math.random().toString(36).slice(2);
+                        let data = null, lastError = null;
+                        for(let attempt = 0; attempt < 3; attempt++){
+                            if(attempt > 0) await new Promise(r => setTimeout(r, 1000 * attempt));
+                            let res;
+                            try{
+                                res = await fetch('/sos', { method: 'POST', headers: { 'Content-Type': 'application/json', 'Idempotency-Key': key }, body: JSON.stringify(body) });
+                            }catch(e){ lastError = e; continue; }
+                            const reply = await res.json().catch(() => null);
+                            if(res.ok && reply && reply.id){ data = reply; break; }
+                            lastError = (reply && reply.detail) || ('HTTP ' + res.status);
+                            // 5xx (e.g. 503 store busy) is worth retrying with the same key; a rejected body is not
+                            if(res.status < 500) break;
+                        }
+                        if(!data){ alert('SOS failed: ' + lastError); return; }
                         // place SOS marker at user location with returned id
                         const sosMarker = L.circleMarker(userLatLng, {color:'#FF4040', radius:10}).addTo(routes).bindPopup('SOS Sent: '+data.id + '<br/>Survivors: '+survivors + '<br/>' + (message||'')).openPopup();
                         document.getElementById('statusSummary').textContent = `SOS sent (${data.id})`;
@@ -377,12 +655,12 @@ def home():
                     }catch(e){ alert('Failed to send SOS: '+e); }
                 });
 
-                // Find Safe Zone: geocode address, find nearest safe zone (school), show random hazards
+                // Find Safe Zone: geocode address, find nearest safe zone (school), show live hazards nearby
                 document.getElementById('findSafeZone').addEventListener('click', async ()=>{
                     try{
                         const address = document.getElementById('addressInput').value.trim();
                         if(!address){ alert('Please enter an address'); return; }
-                        const params = new URLSearchParams({ address });
+                        const params = new URLSearchParams({ address, client_id: clientId });
                         const res = await fetch('/find_safe_zone?'+params.toString());
                         const s = await res.json();
                         if(s.error){ alert('Error: '+s.error); return; }
@@ -413,6 +691,7 @@ def home():
                         }
                         // draw safe route
                         const safe = L.polyline(s.safe_route, {color:'#00FF6A', weight:5, dashArray:'6,4'}).addTo(routes);
+                        safeLine = safe;
                         const originMarker = L.marker(s.origin).addTo(markers).bindPopup('Your Location').openPopup();
                         const destMarker = L.marker(s.destination).addTo(markers).bindPopup('Safe Zone');
                         map.fitBounds(L.featureGroup([safe, originMarker, destMarker]).getBounds(), {padding:[40,40]});
@@ -442,7 +721,26 @@ def home():
                     }catch(e){ document.getElementById('statusSummary').textContent = 'Status unavailable'; }
                 }
                 fetchStatus();
-                setInterval(fetchStatus, 5000);
+                // Hazard changes are pushed over /events instead of polled; the server repairs this
+                // tab's tracked route and sends it back only when the route actually changed
+                if(window.EventSource){
+                    const events = new EventSource('/events?topics=hazard&client_id=' + encodeURIComponent(clientId));
+                    events.addEventListener('hazard', () => fetchStatus());
+                    events.addEventListener('resync', () => {
+                        fetchStatus();
+                        if(lastRoute) fetchAndDrawRoute(lastRoute[0], lastRoute[1]);
+                    });
+                    events.addEventListener('route_update', (e) => {
+                        const d = JSON.parse(e.data);
+                        if(!d.route || !safeLine) return;
+                        safeLine.setLatLngs(d.route);
+                        lastHazardVersion = d.hazard_version;
+                        document.getElementById('statusSummary').textContent = `Route updated (hazard v:${d.hazard_version})`;
+                        speak('Route updated');
+                    });
+                } else {
+                    setInterval(fetchStatus, 5000);
+                }
             </script>
         </body>
         </html>
@@ -456,46 +754,65 @@ def get_route():
 
 
 @app.get('/compute_route')
-def compute_route(start_lat: Optional[float]=None, start_lon: Optional[float]=None, dest_lat: Optional[float]=None, dest_lon: Optional[float]=None):
-    """Compute a simple safe route that avoids known flooded street geometry when possible."""
+async def compute_route(start_lat: Optional[float]=None, start_lon: Optional[float]=None, dest_lat: Optional[float]=None, dest_lon: Optional[float]=None,
+                        client_id: Optional[str]=None):
+    """Compute a simple safe route that avoids known flooded street geometry when possible.
+    With a client_id the route is tracked and repaired updates are pushed to that client's /events."""
     # Determine origin/destination
     if start_lat is None or start_lon is None or dest_lat is None or dest_lon is None:
         # fallback to random route
+        FALLBACKS.inc(kind='compute_route_random')
         return JSONResponse(content=ai.generate_route())
     origin = [float(start_lat), float(start_lon)]
     destination = [float(dest_lat), float(dest_lon)]
 
+    # Prefer the local road graph: follows real streets with no network round trip
+    # and routes around every active hazard street via precomputed edge penalties
+    route = None
+    if road_graph is not None:
+        with hazard_lock:
+            penalties = active_hazard_penalties
+            version = hazard_version
+        if client_id and route_tracker is not None:
+            route = await track_route(client_id, origin, destination, penalties, version)
+        else:
+            route = await run_in_threadpool(local_route, origin, destination, penalties, version)
+    if route is not None:
+        with hazard_lock:
+            hz = state_store.hazards('flood_zones')
+            version = hazard_version
+        return JSONResponse(content={'route': route, 'hazards': hz, 'hazard_version': version})
+
     # Attempt to get flooded geometry via Overpass near midpoint
+    FALLBACKS.inc(kind='compute_route_detour')
     mid_lat = (origin[0] + destination[0]) / 2
     mid_lon = (origin[1] + destination[1]) / 2
-    flooded = fetch_way_geometry('5th Ave W', around_lat=mid_lat, around_lon=mid_lon)
-    # Basic direct route
-    direct = [origin, destination]
-    # If flooded exists and intersects the direct segment, compute detour
-    if flooded and polyline_intersects(flooded, (origin[0], origin[1]), (destination[0], destination[1])):
-        # compute bounding box of flooded
-        lats = [p[0] for p in flooded]
-        lons = [p[1] for p in flooded]
+    flooded = await fetch_way_geometry('5th Ave W', around_lat=mid_lat, around_lon=mid_lon)
+    # Hazards crossing the direct segment: active hazard streets via the spatial index,
+    # plus the flooded street if it intersects
+    a, b = (origin[0], origin[1]), (destination[0], destination[1])
+    blocking = [hazard_index.get(hid)['geometry'] for hid in hazard_index.crossing_segment(a, b)]
+    if flooded and polylines_crossed([origin, destination], [flooded])[0]:
+        blocking.append(flooded)
+    if blocking:
+        # compute bounding box of the blocking hazards
+        lats = [p[0] for poly in blocking for p in poly]
+        lons = [p[1] for poly in blocking for p in poly]
         min_lat, max_lat = min(lats), max(lats)
         min_lon, max_lon = min(lons), max(lons)
         # choose detour north or south depending which side is closer
         north_waypoint = [max_lat + 0.0015, (min_lon+max_lon)/2]
         south_waypoint = [min_lat - 0.0015, (min_lon+max_lon)/2]
         # pick waypoint with shorter total distance
-        def path_len(path):
-            s = 0.0
-            for i in range(len(path)-1):
-                s += math.hypot(path[i+1][0]-path[i][0], path[i+1][1]-path[i][1])
-            return s
         north_path = [origin, north_waypoint, destination]
         south_path = [origin, south_waypoint, destination]
-        route = north_path if path_len(north_path) < path_len(south_path) else south_path
+        route = north_path if polyline_length_m(north_path) < polyline_length_m(south_path) else south_path
     else:
         route = [origin, destination]
 
     # Include hazards nearby
     with hazard_lock:
-        hz = list(hazard_data['flood_zones'])
+        hz = state_store.hazards('flood_zones')
         version = hazard_version
 
     resp = {
@@ -507,41 +824,19 @@ def compute_route(start_lat: Optional[float]=None, start_lon: Optional[float]=No
 
 
 @app.get("/scenario")
-def get_scenario():
+async def get_scenario():
     """Return a canned Kalispell flash-flood scenario with coordinates for the prototype UI."""
-    # Try to geocode addresses for precise coordinates using Nominatim (OpenStreetMap)
-    geocode_cache = getattr(app.state, 'geocode_cache', {})
-    if not geocode_cache:
-        app.state.geocode_cache = geocode_cache
-
-    def geocode(address):
-        if address in geocode_cache:
-            return geocode_cache[address]
-        try:
-            url = 'https://nominatim.openstreetmap.org/search'
-            params = {'q': address, 'format': 'json', 'limit': 1}
-            headers = {'User-Agent': 'SafeRoutePrototype/1.0 (+https://example.com)'}
-            r = requests.get(url, params=params, headers=headers, timeout=5)
-            r.raise_for_status()
-            items = r.json()
-            if items:
-                lat = float(items[0]['lat'])
-                lon = float(items[0]['lon'])
-                geocode_cache[address] = [lat, lon]
-                return [lat, lon]
-        except Exception:
-            pass
-        return None
-
+    # Geocode addresses for precise coordinates using Nominatim (OpenStreetMap), via the shared cache
     origin_addr = '2150 U.S. 93 S, Kalispell, MT 59901'
     dest_addr = 'Flathead High School, 644 4th Ave W, Kalispell, MT 59901'
     flooded_street_addr = '5th Ave W, Kalispell, MT'
 
-    origin = geocode(origin_addr)
-    destination = geocode(dest_addr)
-    flooded_pt = geocode(flooded_street_addr)
+    origin, destination, flooded_pt = await asyncio.gather(
+        geocode(origin_addr), geocode(dest_addr), geocode(flooded_street_addr))
 
     # Fallback to previous approximate values if geocoding fails
+    if None in (origin, destination, flooded_pt):
+        FALLBACKS.inc(kind='scenario_default_coords')
     if origin is None:
         origin = [48.1935, -114.3128]
     if destination is None:
@@ -552,10 +847,11 @@ def get_scenario():
     # Try to fetch exact way geometry for the flooded street using Overpass
     flooded_street = None
     try:
-        flooded_way = fetch_way_geometry('5th Ave W', around_lat=flooded_pt[0], around_lon=flooded_pt[1])
+        flooded_way = await fetch_way_geometry('5th Ave W', around_lat=flooded_pt[0], around_lon=flooded_pt[1])
         if flooded_way:
             flooded_street = flooded_way
-    except Exception:
+    except Exception as e:
+        count_error('scenario', e)
         flooded_street = None
 
     # Fallback to a short polyline for the flooded street centered on flooded_pt
@@ -589,47 +885,445 @@ def get_scenario():
     return JSONResponse(content=scenario)
 
 
-# start background simulator thread (after hazard_data is defined)
-try:
-    sim_thread = threading.Thread(target=hazard_simulator, daemon=True)
-    sim_thread.start()
-except Exception:
-    pass
+def save_snapshot():
+    if not SNAPSHOT_PATH:
+        return
+    with hazard_lock:
+        hazards = hazard_feed.hazard_set.snapshot()
+        version = hazard_version
+    try:
+        snapshot.save(SNAPSHOT_PATH, road_graph, safe_zones.all(), hazards, version, ROAD_GRAPH_PATH)
+    except OSError as e:
+        count_error('snapshot', e)
 
+def restore_snapshot(snap):
+    """Re-add the safe zones and active hazards of a previous run; hazard_version carries on from it."""
+    global hazard_version
+    for zone in snap.zones():
+        safe_zones.add(**zone)
+    with hazard_lock:
+        hazard_version = max(hazard_version, snap.hazard_version)
+        route_cache.advance(hazard_version, [])
+    restored = snap.hazards()
+    # edges snapped on the graph we are serving from are reused, otherwise hazards are snapped again
+    snapped = {u.id: edges for u, edges in restored} if snap.graph is road_graph else None
+    delta = hazard_feed.hazard_set.apply([u for u, _ in restored], snapped=snapped)
+    if delta:
+        apply_hazard_delta(delta)
+
+if startup_snapshot is not None:
+    restore_snapshot(startup_snapshot)
+if road_graph is not None and (startup_snapshot is None or startup_snapshot.graph is not road_graph):
+    # the graph was built from the extract: save it so the next worker maps it instead
+    save_snapshot()
+
+# --- Multi-worker mode: one hazard authority, the other workers mirror it (state_hub.py) ---
+def hazard_record(hz):
+    return {'id': hz.id, 'hazard_type': hz.hazard_type, 'name': hz.name, 'parts': hz.parts,
+            'updated': hz.updated, 'expires': hz.expires, 'edges': sorted(hz.edges)}
+
+def commit_hazard_delta(delta):
+    """Hazard feed batches (authority only): commit them here, then mirror them to the replicas."""
+    version = apply_hazard_delta(delta)
+    upserted = {hz.id for hz in delta.upserted}
+    state_hub.send(lambda: {
+        'op': 'hazards', 'version': version,
+        'upserted': [hazard_record(hz) for hz in delta.upserted],
+        'removed': [[hz.id, hz.hazard_type, hazard_feed.hazard_set.last_update(hz.id)]
+                    for hz in delta.removed if hz.id not in upserted],
+    })
+    return version
+
+def mirror_hazards(version, upserted, removed, sync=False):
+    """Apply the authority's hazard changes at its ``version`` (replica only), reusing its edge matches."""
+    global hazard_version
+    with hazard_lock:
+        if version <= hazard_version and not sync:
+            return
+    updates = [HazardUpdate.from_dict(record) for record in upserted]
+    updates += [HazardUpdate(hazard_id, hazard_type, [], active=False, updated=updated)
+                for hazard_id, hazard_type, updated in removed]
+    snapped = {record['id']: frozenset(record['edges']) for record in upserted}
+    delta = hazard_feed.hazard_set.apply(updates, snapped=snapped, expire=False)
+    if delta:
+        apply_hazard_delta(delta, version)
+        return
+    with hazard_lock:
+        hazard_version = version
+        route_cache.advance(version, [])
+
+def hub_sync():
+    with hazard_lock:
+        version = hazard_version
+        hazards = [hazard_record(hz) for hz in hazard_feed.hazard_set.snapshot()]
+    return {'op': 'sync', 'version': version, 'hazards': hazards, 'sos': state_store.export_sos(),
+            'zones': safe_zones.all()}
+
+def handle_hub_message(message):
+    """Apply a change made by another worker; True when the authority should relay it to the others."""
+    op = message.get('op')
+    if op == 'hazards':
+        mirror_hazards(message['version'], message['upserted'], message['removed'])
+    elif op == 'sync':
+        synced = {record['id'] for record in message['hazards']}
+        local = [[hz.id, hz.hazard_type, hz.updated] for hz in hazard_feed.hazard_set.snapshot()
+                 if hz.id not in synced]
+        mirror_hazards(message['version'], message['hazards'], local, sync=True)
+        state_store.load_sos(message['sos'])
+        for zone in message['zones']:
+            safe_zones.add(zone['id'], zone['name'], zone['lat'], zone['lon'], zone.get('capacity'), zone.get('kind'))
+    elif op == 'sos':
+        state_store.add_sos(message['ping'])
+        if message.get('publish', True):
+            event_bus.publish('sos', message['ping'])
+        return True
+    elif op == 'zone_add':
+        zone = message['zone']
+        safe_zones.add(zone['id'], zone['name'], zone['lat'], zone['lon'], zone.get('capacity'), zone.get('kind'))
+        return True
+    elif op == 'zone_remove':
+        safe_zones.remove(message['id'])
+        return True
+    elif op == 'hazard_updates':
+        hazard_feed.enqueue([HazardUpdate.from_dict(record) for record in message['updates']])
+    return False
+
+def become_hazard_authority(pending):
+    """Run the hazard feed here: at startup, or when the previous authority worker exited."""
+    hazard_feed.relay = None
+    hazard_feed.hazard_set.resume_expiry()
+    for message in pending:
+        if message.get('op') == 'hazard_updates':
+            hazard_feed.enqueue([HazardUpdate.from_dict(record) for record in message['updates']])
+    hazard_feed.start()
+
+# SAFEROUTE_HUB: Unix socket path shared by the workers of `uvicorn --workers N`; unset for one process
+state_hub = StateHub(os.environ.get('SAFEROUTE_HUB') or None, handle_hub_message, hub_sync, become_hazard_authority)
+# until it is elected authority, a worker's feed hands POST /admin/hazards updates to the authority
+hazard_feed.relay = lambda updates: state_hub.send({'op': 'hazard_updates', 'updates': [u.to_dict() for u in updates]})
+# elect the authority (it starts the hazard feed readers and batch applier, after state_store is defined)
+state_hub.start()
+
+# --- /metrics: existing stats() dicts exported as gauges at scrape time ---
+REGISTRY.collector(stats_gauges('saferoute_geocode_cache', 'Geocode cache', geocode_cache.stats))
+REGISTRY.collector(stats_gauges('saferoute_overpass_cache', 'Overpass tile cache', overpass_tiles.stats))
+REGISTRY.collector(stats_gauges('saferoute_route_cache', 'Route cache', route_cache.stats))
+REGISTRY.collector(stats_gauges('saferoute_events', 'Event bus', event_bus.stats))
+REGISTRY.collector(stats_gauges('saferoute_hazard_feed', 'Hazard feed', hazard_feed.stats))
+REGISTRY.collector(stats_gauges('saferoute_state', 'In-memory hazard / SOS state', state_store.summary))
+REGISTRY.collector(stats_gauges('saferoute_hazard', 'Hazard state', lambda: {'version': hazard_version}))
+REGISTRY.collector(stats_gauges('saferoute_state_hub', 'Multi-worker state hub', state_hub.stats))
+REGISTRY.collector(stats_gauges('saferoute_upstream_circuit_open', 'Upstream circuit breaker open (1) or half-open (0.5)',
+                                lambda: {u.name: {'closed': 0, 'half_open': 0.5, 'open': 1}[u.breaker.state]
+                                         for u in upstream.UPSTREAMS}))
+if ch_index is not None:
+    REGISTRY.collector(stats_gauges('saferoute_routing_index', 'Contraction hierarchy / hub label index', ch_index.stats))
+if route_tracker is not None:
+    REGISTRY.collector(stats_gauges('saferoute_active_routes', 'Tracked client routes', route_tracker.stats))
+
+@app.get('/metrics')
+def get_metrics():
+    """Prometheus text format: request / upstream / stage / SQLite latency histograms,
+    fallback and error counters, cache and queue gauges."""
+    return Response(content=REGISTRY.render(), media_type=CONTENT_TYPE)
+
+
+MAX_IDEMPOTENCY_KEY_LEN = 128
+
+def sos_duplicate(existing):
+    return JSONResponse(content={'status': 'ok', 'id': existing['id'], 'ping': existing, 'duplicate': True})
 
 @app.post('/sos')
-def post_sos(payload: dict):
-    """Accept an SOS POST with JSON body: {lat, lon, message, survivors} and store it."""
+async def post_sos(payload: dict, idempotency_key: Optional[str] = Header(None)):
+    """Accept an SOS POST with JSON body: {lat, lon, message, survivors} and store it.
+    A retry carrying the same Idempotency-Key header (or `idempotency_key` field) returns
+    the ping stored by the first attempt instead of creating another."""
     try:
+        key = idempotency_key or payload.get('idempotency_key')
+        if key is not None:
+            key = str(key)
+            if len(key) > MAX_IDEMPOTENCY_KEY_LEN:
+                raise ValueError('idempotency key too long')
+            existing = await run_in_threadpool(sos_store.find_by_key, key)
+            if existing:
+                return sos_duplicate(existing)
         lat = payload.get('lat')
         lon = payload.get('lon')
         message = payload.get('message', '')
         survivors = int(payload.get('survivors', 1))
-        sos_id = f"SOS-{random.randint(1000,9999)}"
+        sos_id = new_sos_id()
+        ts = sos_id_ms(sos_id)
         ping = {
             'id': sos_id,
             'location': {'lat': lat, 'lon': lon},
             'message': message,
             'survivors': survivors,
-            'timestamp': time.ctime()
+            'timestamp': time.ctime(ts / 1000),
+            'ts': ts
         }
-        hazard_data['sos_pings'].append(ping)
-        # persist to sqlite
-        save_sos_to_db(ping)
+        # persist to sqlite: batched with concurrent pings, acknowledged once committed
+        try:
+            await asyncio.wait_for(asyncio.wrap_future(sos_store.submit(ping, key)), SOS_COMMIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            # withdrawn unless the writer already took it; a retry with the same key is safe either way
+            return JSONResponse(content={'status': 'error', 'detail': 'SOS store busy, retry'}, status_code=503)
+        except sqlite3.IntegrityError:
+            # a concurrent retry with the same key committed first
+            existing = await run_in_threadpool(sos_store.find_by_key, key) if key else None
+            if existing is None:
+                raise
+            return sos_duplicate(existing)
+        state_store.add_sos(ping)
+        event_bus.publish('sos', ping)
+        state_hub.send({'op': 'sos', 'ping': ping})
+        schedule_shelter_refresh()
         return JSONResponse(content={'status': 'ok', 'id': sos_id, 'ping': ping})
     except Exception as e:
         return JSONResponse(content={'status': 'error', 'detail': str(e)}, status_code=400)
 
+# Largest page GET /sos returns
+MAX_SOS_PAGE = 5000
+
 @app.get("/sos")
-def send_sos():
-    # Return persisted SOS pings
-    rows = load_all_sos_from_db()
-    return JSONResponse(content={'sos': rows})
+def send_sos(since: Optional[str]=None, limit: int=DEFAULT_PAGE_LIMIT, bbox: Optional[str]=None):
+    """Persisted SOS pings. Without `since` the newest `limit` pings (newest first); with the
+    `cursor` of a previous response (the last SOS id seen) only the pings after it (oldest first). `bbox` is
+    "south,west,north,east"."""
+    try:
+        box = None
+        if bbox:
+            box = tuple(float(v) for v in bbox.split(','))
+            if len(box) != 4:
+                raise ValueError('bbox must be south,west,north,east')
+        limit = max(1, min(limit, MAX_SOS_PAGE))
+        rows, cursor = sos_store.query(since=since, limit=limit, bbox=box)
+    except ValueError as e:
+        return JSONResponse(content={'status': 'error', 'detail': str(e)}, status_code=400)
+    return JSONResponse(content={'sos': rows, 'cursor': cursor, 'more': len(rows) == limit})
+
+@app.get('/events')
+async def events(topics: Optional[str]=None, client_id: Optional[str]=None, last_event_id: Optional[str] = Header(None)):
+    """Server-sent event stream replacing client polling. `topics` is a comma list of
+    sos, hazard, route (default all); events: sos, hazard, route_invalidated, resync, and
+    route_update (only to the `client_id` whose tracked route was repaired)."""
+    wanted = [t for t in (topics or '').split(',') if t in TOPICS] or None
+    sub = event_bus.subscribe(wanted, last_event_id, client_id)
+    return StreamingResponse(event_bus.stream(sub), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.get("/status")
 def get_status():
     return JSONResponse(content=ai.summarize_status())
 
+@app.get('/safe_zones')
+def list_safe_zones(lat: Optional[float]=None, lon: Optional[float]=None, k: int=5, min_capacity: Optional[int]=None):
+    """Nearest safe zones to a point (k-nearest by haversine distance), or all zones without a point."""
+    if lat is None or lon is None:
+        return JSONResponse(content={'safe_zones': safe_zones.all()})
+    found = safe_zones.nearest(lat, lon, k=k, min_capacity=min_capacity)
+    return JSONResponse(content={'safe_zones': [dict(zone, distance_m=round(d, 1)) for zone, d in found]})
+
+# Admin endpoints require X-Admin-Token when SAFEROUTE_ADMIN_TOKEN is set
+ADMIN_TOKEN = os.environ.get('SAFEROUTE_ADMIN_TOKEN')
+
+def admin_denied(token):
+    if ADMIN_TOKEN and token != ADMIN_TOKEN:
+        return JSONResponse(content={'status': 'error', 'detail': 'admin token required'}, status_code=403)
+    return None
+
+@app.post('/admin/safe_zones')
+def add_safe_zone(payload: dict, x_admin_token: Optional[str] = Header(None)):
+    """Add or update a safe zone: {name, lat, lon, capacity?, kind?, id?}."""
+    denied = admin_denied(x_admin_token)
+    if denied:
+        return denied
+    try:
+        name = payload['name']
+        zone_id = payload.get('id') or f"admin:{name}"
+        capacity = payload.get('capacity')
+        zone = safe_zones.add(zone_id, name, float(payload['lat']), float(payload['lon']),
+                              int(capacity) if capacity is not None else None, payload.get('kind', 'shelter'))
+        state_hub.send({'op': 'zone_add', 'zone': zone})
+        return JSONResponse(content={'status': 'ok', 'safe_zone': zone})
+    except Exception as e:
+        return JSONResponse(content={'status': 'error', 'detail': str(e)}, status_code=400)
+
+@app.delete('/admin/safe_zones/{zone_id:path}')
+def remove_safe_zone(zone_id: str, x_admin_token: Optional[str] = Header(None)):
+    denied = admin_denied(x_admin_token)
+    if denied:
+        return denied
+    if not safe_zones.remove(zone_id):
+        return JSONResponse(content={'status': 'error', 'detail': 'unknown safe zone'}, status_code=404)
+    state_hub.send({'op': 'zone_remove', 'id': zone_id})
+    return JSONResponse(content={'status': 'ok', 'id': zone_id})
+
+@app.post('/admin/hazards')
+async def post_hazards(request: Request, x_admin_token: Optional[str] = Header(None)):
+    """Push hazard updates into the hazard feed: GeoJSON lines or CAP alerts, same format as the
+    SAFEROUTE_HAZARD_FEED sources. They go live with the feed's next batch."""
+    denied = admin_denied(x_admin_token)
+    if denied:
+        return denied
+    body = (await request.body()).decode('utf-8', errors='replace')
+    queued, rejected = await run_in_threadpool(hazard_feed.submit_text, body)
+    if not queued and rejected:
+        return JSONResponse(content={'status': 'error', 'detail': hazard_feed.last_error, 'rejected': rejected},
+                            status_code=400)
+    return JSONResponse(content={'status': 'ok', 'queued': queued, 'rejected': rejected}, status_code=202)
+
+# Size limits of one /evacuation_matrix request
+MAX_MATRIX_ORIGINS = 2000
+MAX_MATRIX_ZONES = 50
+
+def matrix_zones(payload, origins):
+    """Safe zones for a matrix request: the listed ids, else the `max_zones` nearest to the
+    origins' centroid within `radius` metres."""
+    if payload.get('safe_zones'):
+        zones = []
+        for zone_id in payload['safe_zones'][:MAX_MATRIX_ZONES]:
+            zone = safe_zones.get(zone_id)
+            if zone is None:
+                raise ValueError(f"unknown safe zone: {zone_id}")
+            zones.append(zone)
+        return zones
+    clat = sum(o[0] for o in origins) / len(origins)
+    clon = sum(o[1] for o in origins) / len(origins)
+    k = min(int(payload.get('max_zones', 10)), MAX_MATRIX_ZONES)
+    found = safe_zones.nearest(clat, clon, k=k, max_dist_m=float(payload.get('radius', 10000)))
+    return [zone for zone, _ in found]
+
+@app.post('/evacuation_matrix')
+async def post_evacuation_matrix(payload: dict):
+    """Batch routing for many origins: {origins: [[lat, lon], ...], safe_zones?: [ids],
+    max_zones?, radius?}. Returns the road distance / travel time matrix under the active
+    hazards and each origin's fastest reachable safe zone."""
+    if road_graph is None:
+        return JSONResponse(content={'status': 'error', 'detail': 'no local road graph loaded'}, status_code=503)
+    try:
+        origins = [[float(o[0]), float(o[1])] for o in payload['origins']]
+        if not origins or len(origins) > MAX_MATRIX_ORIGINS:
+            raise ValueError(f"between 1 and {MAX_MATRIX_ORIGINS} origins required")
+        zones = matrix_zones(payload, origins)
+    except (KeyError, TypeError, IndexError, ValueError) as e:
+        return JSONResponse(content={'status': 'error', 'detail': str(e)}, status_code=400)
+    if not zones:
+        return JSONResponse(content={'status': 'error', 'detail': 'No safe zone found nearby'}, status_code=404)
+    with hazard_lock:
+        penalties = active_hazard_penalties
+        version = hazard_version
+    distance, duration = await run_in_threadpool(evacuation_matrix, origins, zones, penalties)
+    assignments = []
+    for drow, trow in zip(distance, duration):
+        reachable = [j for j, t in enumerate(trow) if t is not None]
+        if not reachable:
+            assignments.append(None)
+            continue
+        best = min(reachable, key=lambda j: trow[j])
+        assignments.append({'safe_zone': zones[best]['id'], 'distance_m': round(drow[best], 1),
+                            'duration_s': round(trow[best], 1)})
+    rnd = lambda rows: [[None if v is None else round(v, 1) for v in row] for row in rows]
+    return JSONResponse(content={
+        'hazard_version': version,
+        'safe_zones': zones,
+        'distance_m': rnd(distance),
+        'duration_s': rnd(duration),
+        'assignments': assignments,
+    })
+
+# --- Capacity-aware shelter assignment of SOS groups (re-solved incrementally) ---
+# Pings newer than this count as people still waiting for a shelter
+ASSIGN_WINDOW_S = 24 * 3600
+# Candidate shelters per SOS group (nearest by haversine) and their search radius
+ASSIGN_CANDIDATES = 8
+ASSIGN_RADIUS_M = 15000
+shelter_assigner = ShelterAssigner()
+shelter_assign_lock = asyncio.Lock()
+shelter_cursor = None
+shelter_refresh_task = None
+
+def shelter_costs(points, penalties):
+    """Travel time (s) from each (lat, lon) to its candidate shelters: road-graph times when
+    the graph is loaded, otherwise straight-line distance at connector speed."""
+    candidates = [[z for z, _ in safe_zones.nearest(lat, lon, k=ASSIGN_CANDIDATES, max_dist_m=ASSIGN_RADIUS_M)]
+                  for lat, lon in points]
+    zones = list({z['id']: z for row in candidates for z in row}.values())
+    col = {z['id']: j for j, z in enumerate(zones)}
+    if road_graph is not None and zones:
+        _, duration = evacuation_matrix([list(p) for p in points], zones, penalties)
+    else:
+        duration = [[haversine_m(lat, lon, z['lat'], z['lon']) / CONNECTOR_SPEED_MS for z in zones]
+                    for lat, lon in points]
+    rows = []
+    for i, row in enumerate(candidates):
+        rows.append({z['id']: duration[i][col[z['id']]] for z in row if duration[i][col[z['id']]] is not None})
+    return rows
+
+async def refresh_shelter_assignment():
+    """Bring the assignment up to date: new SOS pings since the last refresh are inserted,
+    expired ones dropped, and a hazard or capacity change warm-starts from the current plan."""
+    global shelter_cursor
+    async with shelter_assign_lock:
+        with hazard_lock:
+            penalties = active_hazard_penalties
+            version = hazard_version
+        capacity = {z['id']: z['capacity'] for z in safe_zones.all()}
+        if capacity != shelter_assigner.capacity:
+            await run_in_threadpool(shelter_assigner.set_capacities, capacity)
+        cutoff = int((time.time() - ASSIGN_WINDOW_S) * 1000)
+        expired = [gid for gid, g in shelter_assigner.groups.items() if g.ts < cutoff]
+        if expired:
+            await run_in_threadpool(shelter_assigner.remove_groups, expired)
+        if shelter_assigner.version != version and shelter_assigner.groups:
+            groups = list(shelter_assigner.groups.values())
+            rows = await run_in_threadpool(shelter_costs, [(g.lat, g.lon) for g in groups], penalties)
+            await run_in_threadpool(shelter_assigner.update_costs, {g.id: row for g, row in zip(groups, rows)}, version)
+        shelter_assigner.version = version
+        # only the pings after the cursor are read from SQLite
+        cursor = shelter_cursor or make_cursor(cutoff, '')
+        pings = []
+        while True:
+            page, cursor = await run_in_threadpool(sos_store.query, cursor, MAX_SOS_PAGE)
+            pings += page
+            if len(page) < MAX_SOS_PAGE:
+                break
+        shelter_cursor = cursor
+        pings = [p for p in pings if p['ts'] >= cutoff
+                 and p['location'].get('lat') is not None and p['location'].get('lon') is not None]
+        if pings:
+            points = [(p['location']['lat'], p['location']['lon']) for p in pings]
+            rows = await run_in_threadpool(shelter_costs, points, penalties)
+            groups = [Group(p['id'], p['survivors'], lat, lon, p['ts'], row)
+                      for p, (lat, lon), row in zip(pings, points, rows)]
+            await run_in_threadpool(shelter_assigner.add_groups, groups)
+
+def schedule_shelter_refresh():
+    """Re-solve in the background after new pings; bursts coalesce into one refresh."""
+    global shelter_refresh_task
+    if shelter_refresh_task is None or shelter_refresh_task.done():
+        shelter_refresh_task = asyncio.create_task(refresh_shelter_assignment())
+
+@app.get('/shelter_assignments')
+async def get_shelter_assignments():
+    """Capacity-aware shelter for every SOS group of the last ASSIGN_WINDOW_S, minimising
+    total travel time; groups that fit nowhere are listed as unassigned."""
+    await refresh_shelter_assignment()
+    result = shelter_assigner.result()
+    result['hazard_version'] = shelter_assigner.version
+    return JSONResponse(content=result)
+
+@app.get('/hazards_near')
+def hazards_near(lat: float, lon: float, radius: float=500):
+    """Active hazard streets within `radius` metres of a point, nearest first."""
+    hazards = []
+    for hid, dist in hazard_index.within(lat, lon, radius):
+        hz = hazard_index.get(hid)
+        if hz is None:
+            continue
+        hazards.append({'name': hz['name'], 'hazard_type': hz['hazard_type'],
+                        'distance_m': round(dist, 1), 'geometry': hz['geometry']})
+    return JSONResponse(content={'hazards': hazards})
+
 
 @app.get('/responders', response_class=HTMLResponse)
 def responders_view():
@@ -650,18 +1344,60 @@ def responders_view():
             <script>
                 const map = L.map('map').setView([48.1965, -114.3200], 14);
                 L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png',{maxZoom:19}).addTo(map);
-                async function loadSOS(){
-                    const res = await fetch('/sos');
-                    const json = await res.json();
-                    const list = json.sos || [];
+                const pings = L.layerGroup().addTo(map);
+                const shown = new Set();
+                // cursor of the last page: later polls only fetch pings newer than it, inside the view
+                let cursor = null;
+                let first = true;
+                function viewBbox(){
+                    const b = map.getBounds();
+                    return [b.getSouth(), b.getWest(), b.getNorth(), b.getEast()].map(v => v.toFixed(5)).join(',');
+                }
+                function addPings(list){
                     list.forEach(s => {
+                        if(shown.has(s.id)) return;
+                        shown.add(s.id);
                         const lat = s.location.lat; const lon = s.location.lon;
-                        L.marker([lat, lon], {icon: L.icon({iconUrl:'https://unpkg.com/leaflet@1.9.4/dist/images/marker-icon.png'})}).addTo(map).bindPopup(`<b>${s.id}</b><br/>Survivors: ${s.survivors}<br/>${s.message}`);
+                        L.marker([lat, lon], {icon: L.icon({iconUrl:'https://unpkg.com/leaflet@1.9.4/dist/images/marker-icon.png'})}).addTo(pings).bindPopup(`<b>${s.id}</b><br/>Survivors: ${s.survivors}<br/>${s.message}`);
                     });
-                    if(list.length) map.fitBounds(list.map(s => [s.location.lat, s.location.lon]));
                 }
+                async function loadSOS(){
+                    const params = new URLSearchParams();
+                    if(cursor) params.set('since', cursor);
+                    if(!first) params.set('bbox', viewBbox());
+                    const res = await fetch('/sos?' + params.toString());
+                    const json = await res.json();
+                    const list = json.sos || [];
+                    addPings(list);
+                    if(json.cursor) cursor = json.cursor;
+                    if(first && list.length) map.fitBounds(list.map(s => [s.location.lat, s.location.lon]));
+                    first = false;
+                    // keep paging while a backlog of new pings remains
+                    if(json.more && list.length && params.has('since')) loadSOS();
+                }
+                async function reloadView(){
+                    // the view moved: fetch the newest pings inside it, keep the cursor for later polls
+                    const res = await fetch('/sos?bbox=' + viewBbox());
+                    const json = await res.json();
+                    addPings(json.sos || []);
+                    if(!cursor && json.cursor) cursor = json.cursor;
+                }
+                map.on('moveend', () => { if(!first) reloadView(); });
                 loadSOS();
-                setInterval(loadSOS, 8000);
+                // New pings are pushed over /events; the cursor fetch only catches up after a
+                // reconnect or when the server asks for a resync
+                if(window.EventSource){
+                    const events = new EventSource('/events?topics=sos');
+                    events.addEventListener('sos', (e) => {
+                        const s = JSON.parse(e.data);
+                        cursor = s.id;
+                        if(map.getBounds().contains([s.location.lat, s.location.lon])) addPings([s]);
+                    });
+                    events.addEventListener('resync', () => loadSOS());
+                    events.onopen = () => { if(!first) loadSOS(); };
+                } else {
+                    setInterval(loadSOS, 8000);
+                }
             </script>
         </body>
         </html>
@@ -669,166 +1405,106 @@ def responders_view():
         return HTMLResponse(content=html)
 
 
+# Hazards within this distance (3 miles) of the address are returned with the /find_safe_zone route
+HAZARD_DISPLAY_RADIUS_M = 4828
+# Largest shelter search radius /find_safe_zone accepts (bounds the tiles one request may download)
+MAX_SAFE_ZONE_RADIUS_M = 10000
+
 @app.get('/find_safe_zone')
-def find_safe_zone(address: str, radius: int=3000):
-    """Geocode address, find nearest safe zone (school), generate random flooded streets for demo."""
+async def find_safe_zone(address: str, radius: int=3000, capacity_aware: bool=False, client_id: Optional[str]=None):
+    """Geocode address, find nearest safe zone (school) and route there around the live hazards nearby.
+    With capacity_aware=true, skip zones the shelter assignment has already filled."""
+    if not 0 < radius <= MAX_SAFE_ZONE_RADIUS_M:
+        return JSONResponse(content={'error': f'radius must be between 1 and {MAX_SAFE_ZONE_RADIUS_M} metres'},
+                            status_code=400)
     try:
-        # Geocode address using Nominatim
-        geocode_cache = getattr(app.state, 'geocode_cache', {})
-        if not geocode_cache:
-            app.state.geocode_cache = geocode_cache
-        
-        def geocode(addr):
-            if addr in geocode_cache:
-                return geocode_cache[addr]
-            try:
-                url = 'https://nominatim.openstreetmap.org/search'
-                params = {'q': addr, 'format': 'json', 'limit': 1}
-                headers = {'User-Agent': 'SafeRoutePrototype/1.0'}
-                r = requests.get(url, params=params, headers=headers, timeout=5)
-                r.raise_for_status()
-                items = r.json()
-                if items:
-                    lat = float(items[0]['lat'])
-                    lon = float(items[0]['lon'])
-                    geocode_cache[addr] = [lat, lon]
-                    return [lat, lon]
-            except Exception:
-                pass
-            return None
-        
-        origin_coords = geocode(address)
+        # Geocode address using Nominatim (cached across requests and workers)
+        with STAGE_SECONDS.time(endpoint='find_safe_zone', stage='geocode'):
+            origin_coords = await geocode(address)
         if not origin_coords:
             return JSONResponse(content={'error': 'Could not geocode address'}, status_code=400)
         
         lat, lon = origin_coords
+        origin = [float(lat), float(lon)]
         
-        # Find nearest school (safe zone)
-        url = 'https://overpass-api.de/api/interpreter'
-        q = f"""
-        [out:json][timeout:25];
-        (
-          node(around:{radius},{lat},{lon})["amenity"="school"];
-          way(around:{radius},{lat},{lon})["amenity"="school"];
-          relation(around:{radius},{lat},{lon})["amenity"="school"];
-        );
-        out center;
-        """
-        headers = {'User-Agent': 'SafeRoutePrototype/1.0'}
+        # Find nearest safe zone: schools from the tile cache (downloading only uncached tiles)
+        # join the shelters in the safe-zone KD-tree, which answers by haversine distance
+        dlat = radius / 110574.0
+        dlon = radius / (111320.0 * math.cos(math.radians(lat)))
         try:
-            r = requests.post(url, data={'data': q}, headers=headers, timeout=15)
-            r.raise_for_status()
-            data = r.json()
-        except Exception:
-            # Overpass may be rate-limited; fallback to Nominatim search for 'school'
+            with STAGE_SECONDS.time(endpoint='find_safe_zone', stage='schools'):
+                register_schools(await overpass_tiles.query('schools', lat - dlat, lon - dlon, lat + dlat, lon + dlon,
+                                                            fetch=upstream.overpass))
+            overpass_ok = True
+        except TooManyTiles as e:
+            return JSONResponse(content={'error': str(e)}, status_code=400)
+        except Exception as e:
+            count_error('schools', e)
+            overpass_ok = False
+        if capacity_aware:
+            found = [(z, d) for z, d in safe_zones.nearest(lat, lon, k=ASSIGN_CANDIDATES, max_dist_m=radius)
+                     if shelter_assigner.room(z['id'], z['capacity']) >= 1][:1]
+        else:
+            found = safe_zones.nearest(lat, lon, k=1, max_dist_m=radius)
+        safe_zone = found[0][0] if found else None
+        dest = [safe_zone['lat'], safe_zone['lon']] if safe_zone else None
+        if dest is None and not overpass_ok:
+            # Overpass may be rate-limited; fallback to Nominatim search for 'school' within the radius
+            FALLBACKS.inc(kind='schools_nominatim')
             try:
-                nm_url = 'https://nominatim.openstreetmap.org/search'
-                nm_params = {'q': 'school', 'format': 'json', 'limit': 20}
-                nm_h = {'User-Agent': 'SafeRoutePrototype/1.0'}
-                nr = requests.get(nm_url, params=nm_params, headers=nm_h, timeout=10)
-                nr.raise_for_status()
-                nm_data = nr.json()
-                data = {'elements': []}
-                for item in nm_data:
-                    if 'lat' in item and 'lon' in item:
-                        data['elements'].append({'type': 'node', 'lat': float(item['lat']), 'lon': float(item['lon'])})
-            except Exception:
+                with STAGE_SECONDS.time(endpoint='find_safe_zone', stage='schools_nominatim'):
+                    nm_data = await upstream.nominatim_search('school', limit=20, timeout=5,
+                                                              viewbox=[lat - dlat, lon - dlon, lat + dlat, lon + dlon])
+                schools = [[float(item['lat']), float(item['lon'])] for item in nm_data if 'lat' in item and 'lon' in item]
+            except Exception as e:
+                count_error('schools_nominatim', e)
                 return JSONResponse(content={'error': 'Failed to find safe zones'}, status_code=502)
-        
-        dest = None
-        best_d = None
-        for el in data.get('elements', []):
-            if el.get('type') == 'node' and 'lat' in el and 'lon' in el:
-                cx, cy = el['lat'], el['lon']
-            else:
-                center = el.get('center')
-                if center:
-                    cx, cy = center.get('lat'), center.get('lon')
-                else:
-                    continue
-            d = math.hypot(cx - lat, cy - lon)
-            if best_d is None or d < best_d:
-                best_d = d
-                dest = [cx, cy]
+            best, _ = nearest_index(schools, lat, lon)
+            dest = schools[best] if best >= 0 else None
         
         if dest is None:
             return JSONResponse(content={'error': 'No safe zone found nearby'}, status_code=404)
+        destination = dest
         
-        # Generate 3-6 random hazard streets within 3 miles of the entered address
-        # 3 miles = 4828 meters
-        hazard_radius = 4828
+        # If the local road graph can't cover this trip, start the OSRM call now so it
+        # overlaps the hazard lookup instead of running after it
+        osrm_task = None
+        if not local_graph_covers(origin, destination):
+            osrm_task = asyncio.create_task(upstream.osrm_route(origin, destination))
         
-        # Query Overpass for nearby streets (within 3 miles of entered address)
-        bbox_delta = hazard_radius / 111320.0
-        q_streets = f"""
-        [out:json][timeout:25];
-        way({lat-bbox_delta},{lon-bbox_delta},{lat+bbox_delta},{lon+bbox_delta})["highway"]["name"];
-        out geom;
-        """
+        # Live hazards (from the hazard feed) near the entered address
+        with hazard_lock:
+            penalties = active_hazard_penalties
+            version = hazard_version
         hazard_streets = []
-        hazard_types = ['flooded', 'fire', 'powerline', 'blocked']
-        try:
-            rs = requests.post(url, data={'data': q_streets}, headers=headers, timeout=15)
-            rs.raise_for_status()
-            streets_data = rs.json()
-            candidates = []
-            for el in streets_data.get('elements', []):
-                if el.get('type') == 'way' and 'tags' in el and 'name' in el['tags'] and 'geometry' in el:
-                    name = el['tags']['name']
-                    geom = [[pt['lat'], pt['lon']] for pt in el['geometry']]
-                    candidates.append({'name': name, 'geometry': geom})
-            # Pick 3-6 random streets with random hazard types
-            import random as rand
-            num_hazards = min(rand.randint(3, 6), len(candidates))
-            if num_hazards > 0:
-                selected = rand.sample(candidates, num_hazards)
-                for street in selected:
-                    hazard_type = rand.choice(hazard_types)
-                    hazard_streets.append({
-                        'name': street['name'],
-                        'geometry': street['geometry'],
-                        'hazard_type': hazard_type
-                    })
-        except Exception:
-            # If Overpass fails, generate synthetic hazard streets around entered address
-            hazard_streets = [
-                {'name': 'Main St (simulated)', 'geometry': [[lat+0.001, lon-0.002], [lat-0.001, lon+0.002]], 'hazard_type': 'flooded'},
-                {'name': '5th Ave (simulated)', 'geometry': [[lat+0.002, lon], [lat-0.002, lon]], 'hazard_type': 'fire'},
-                {'name': 'Oak Street (simulated)', 'geometry': [[lat-0.001, lon-0.001], [lat+0.001, lon+0.001]], 'hazard_type': 'powerline'}
-            ]
-        
-        # Compute safe route using OSRM routing service (follows actual roads)
-        origin = [float(lat), float(lon)]
-        destination = dest
+        for hid, _ in hazard_index.within(lat, lon, HAZARD_DISPLAY_RADIUS_M):
+            hz = hazard_index.get(hid)
+            if hz is not None:
+                hazard_streets.append({'name': hz['name'], 'geometry': hz['geometry'], 'hazard_type': hz['hazard_type']})
         
-        # Use OSRM demo server for street-level routing
-        try:
-            osrm_url = f'https://router.project-osrm.org/route/v1/driving/{origin[1]},{origin[0]};{destination[1]},{destination[0]}'
-            osrm_params = {'overview': 'full', 'geometries': 'geojson'}
-            osrm_headers = {'User-Agent': 'SafeRoutePrototype/1.0'}
-            osrm_resp = requests.get(osrm_url, params=osrm_params, headers=osrm_headers, timeout=10)
-            osrm_resp.raise_for_status()
-            osrm_data = osrm_resp.json()
-            
-            if osrm_data.get('code') == 'Ok' and 'routes' in osrm_data and len(osrm_data['routes']) > 0:
-                # Extract route geometry (OSRM returns [lon, lat] pairs, we need [lat, lon])
-                coords = osrm_data['routes'][0]['geometry']['coordinates']
-                route = [[pt[1], pt[0]] for pt in coords]  # swap to [lat, lon]
-            else:
-                # Fallback to direct line if OSRM fails
-                route = [origin, destination]
-        except Exception:
-            # If OSRM is unavailable, fall back to direct line
-            route = [origin, destination]
+        # Compute safe route over the local road graph (follows actual roads) around the
+        # active hazards; the OSRM demo server is only used when the graph can't answer
+        route = None
+        with STAGE_SECONDS.time(endpoint='find_safe_zone', stage='route'):
+            if client_id and route_tracker is not None:
+                # tracked: later hazard changes repair this route and push it to the client
+                route = await track_route(client_id, origin, destination, penalties, version)
+            if route is None:
+                route = await plan_route(origin, destination, penalties, osrm_task, version,
+                                         safe_zone['id'] if safe_zone else None)
+            elif osrm_task is not None:
+                osrm_task.cancel()
         
         scenario = {
             'origin': origin,
             'destination': destination,
             'hazard_streets': hazard_streets,
-            'safe_route': route
+            'safe_route': route,
+            'safe_zone': safe_zone
         }
         return JSONResponse(content=scenario)
     except Exception as e:
+        count_error('find_safe_zone', e)
         return JSONResponse(content={'error': str(e)}, status_code=500)
 
 # ---- Run ----
@@ -10,6 +10,8 @@ import json
 import random
 import time
 
+from sos_store import new_sos_id
+
 # ========== MOCK ENVIRONMENT ========== #
 # Simulate offline mode and LM Studio model response
 
@@ -44,7 +46,7 @@ class SafeRouteAI:
         return route
 
     def send_sos(self, survivors=1, location="User Location"):
-        sos_id = f"SOS-{random.randint(1000,9999)}"
+        sos_id = new_sos_id()
         hazard_data["sos_pings"].append({
             "id": sos_id,
             "location": location,
@@ -0,0 +1,259 @@
+"""
+Capacity-aware assignment of SOS groups to shelters.
+
+Each SOS ping is a group of ``survivors`` people that stays together; each
+safe zone has a capacity (None = unlimited). The solver minimises total
+travel time with a greedy-with-repair heuristic:
+
+  * insertion: groups are placed in order of regret (how much worse their
+    second-best feasible shelter is than their best), each into its cheapest
+    shelter with room left. Regrets sit in a priority queue; placing a group
+    only recomputes the groups whose two best shelters included the one that
+    just filled up;
+  * repair: relocate a group to a cheaper shelter with room, or swap two
+    groups between shelters when both fit and the total time drops, until no
+    move improves (or MAX_REPAIR_PASSES).
+
+The solver keeps its state between calls. New pings are inserted into the
+existing assignment and only the groups around them are repaired. Cost
+updates (a new hazard_version) or capacity changes warm-start from the
+current assignment instead of solving from scratch.
+"""
+
+import heapq
+import math
+import threading
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+MAX_REPAIR_PASSES = 4
+
+
+class Group:
+    __slots__ = ('id', 'survivors', 'lat', 'lon', 'ts', 'costs')
+
+    def __init__(self, group_id: str, survivors: int, lat: float, lon: float, ts: int,
+                 costs: Dict[str, float]):
+        self.id = group_id
+        self.survivors = max(1, int(survivors or 1))
+        self.lat = lat
+        self.lon = lon
+        self.ts = ts
+        # zone id -> travel time (s); zones missing here are unreachable for this group
+        self.costs = costs
+
+
+class ShelterAssigner:
+    def __init__(self):
+        self.capacity: Dict[str, Optional[int]] = {}
+        self.load: Dict[str, int] = {}
+        self.groups: Dict[str, Group] = {}
+        self.assignment: Dict[str, str] = {}
+        # zone id -> its groups (a dict as an insertion-ordered set)
+        self.members: Dict[str, Dict[str, None]] = defaultdict(dict)
+        self.unassigned = set()
+        self.version = None
+        self.moves = 0
+        self._lock = threading.Lock()
+
+    # --- feasibility helpers ---
+    def _room(self, zone_id: str) -> float:
+        cap = self.capacity.get(zone_id)
+        if cap is None:
+            return math.inf if zone_id in self.capacity else 0
+        return cap - self.load.get(zone_id, 0)
+
+    def _place(self, g: Group, zone_id: Optional[str]):
+        old = self.assignment.pop(g.id, None)
+        if old is not None:
+            self.load[old] -= g.survivors
+            self.members[old].pop(g.id, None)
+        self.unassigned.discard(g.id)
+        if zone_id is None:
+            self.unassigned.add(g.id)
+        else:
+            self.assignment[g.id] = zone_id
+            self.load[zone_id] = self.load.get(zone_id, 0) + g.survivors
+            self.members[zone_id][g.id] = None
+
+    def _options(self, g: Group) -> List[Tuple[float, str]]:
+        return sorted((c, z) for z, c in g.costs.items() if z in self.capacity and self._room(z) >= g.survivors)
+
+    def _insert(self, gids: Iterable[str]):
+        """Place groups by decreasing regret, each into its cheapest shelter with room."""
+        pending = {gid: i for i, gid in enumerate(dict.fromkeys(gids)) if gid in self.groups}
+        heap = []
+        # gid -> its two best feasible shelters when its regret was last computed
+        top: Dict[str, Tuple[str, ...]] = {}
+        by_zone: Dict[str, List[str]] = defaultdict(list)
+
+        def push(gid: str):
+            options = self._options(self.groups[gid])
+            top[gid] = tuple(z for _, z in options[:2])
+            if options:
+                regret = options[1][0] - options[0][0] if len(options) > 1 else math.inf
+                heapq.heappush(heap, (-regret, pending[gid], gid, options[0][1]))
+
+        for gid in pending:
+            for zone_id in self.groups[gid].costs:
+                by_zone[zone_id].append(gid)
+            push(gid)
+        while heap:
+            _, _, gid, zone_id = heapq.heappop(heap)
+            if gid not in pending or top[gid][:1] != (zone_id,):
+                continue  # placed already, or a stale entry
+            g = self.groups[gid]
+            self._place(g, zone_id)
+            del pending[gid]
+            # room only shrinks here, so only groups that just lost one of their two best options change
+            room = self._room(zone_id)
+            for other in by_zone[zone_id]:
+                if other in pending and zone_id in top[other] and room < self.groups[other].survivors:
+                    push(other)
+        # nothing left fits anywhere
+        for gid in pending:
+            self._place(self.groups[gid], None)
+
+    def _repair(self, gids: Iterable[str]):
+        """Relocate / swap moves around ``gids`` until none lowers the total travel time."""
+        focus = set(gids)
+        for _ in range(MAX_REPAIR_PASSES):
+            improved = False
+            for gid in list(focus):
+                g = self.groups.get(gid)
+                if g is None:
+                    continue
+                current = self.assignment.get(gid)
+                cur_cost = g.costs.get(current, math.inf) if current is not None else math.inf
+                for cost, zone_id in sorted((c, z) for z, c in g.costs.items() if z in self.capacity):
+                    if cost >= cur_cost:
+                        break
+                    if self._room(zone_id) >= g.survivors:
+                        self._place(g, zone_id)
+                        self.moves += 1
+                        improved = True
+                        break
+                    if current is None:
+                        continue
+                    # swap with a group in the full zone that is better off in ours
+                    swapped = self._try_swap(g, current, cur_cost, zone_id, cost)
+                    if swapped is not None:
+                        focus.add(swapped)
+                        improved = True
+                        break
+            if self.unassigned:
+                before = len(self.unassigned)
+                self._insert(list(self.unassigned))
+                improved = improved or len(self.unassigned) < before
+            if not improved:
+                return
+
+    def _try_swap(self, g: Group, zone_a: str, cost_a: float, zone_b: str, cost_b: float) -> Optional[str]:
+        room_a, room_b = self._room(zone_a), self._room(zone_b)
+        for hid in list(self.members[zone_b]):
+            h = self.groups[hid]
+            h_cost_a = h.costs.get(zone_a)
+            if h_cost_a is None:
+                continue
+            delta = (cost_b + h_cost_a) - (cost_a + h.costs[zone_b])
+            if delta >= 0:
+                continue
+            # capacity after the swap: zone_a loses g and gains h, zone_b the reverse
+            if room_a + g.survivors - h.survivors < 0 or room_b + h.survivors - g.survivors < 0:
+                continue
+            self._place(g, None)
+            self._place(h, None)
+            self._place(g, zone_b)
+            self._place(h, zone_a)
+            self.moves += 1
+            return hid
+        return None
+
+    # --- public API ---
+    def room(self, zone_id: str, capacity: Optional[int] = None) -> float:
+        """Places left in a shelter; ``capacity`` is used for shelters the solver hasn't seen yet."""
+        cap = self.capacity.get(zone_id, capacity)
+        return math.inf if cap is None else cap - self.load.get(zone_id, 0)
+
+    def set_capacities(self, capacity: Dict[str, Optional[int]]):
+        """Update the shelter set; groups in shelters that shrank or vanished are re-placed."""
+        with self._lock:
+            self.capacity = dict(capacity)
+            displaced = []
+            for zone_id in list(self.load):
+                if zone_id not in self.capacity:
+                    displaced += list(self.members[zone_id])
+            for gid in displaced:
+                self._place(self.groups[gid], None)
+            for zone_id, cap in self.capacity.items():
+                # evict the largest groups first until the zone fits again
+                while cap is not None and self.load.get(zone_id, 0) > cap:
+                    gid = max(self.members[zone_id], key=lambda m: self.groups[m].survivors)
+                    self._place(self.groups[gid], None)
+                    displaced.append(gid)
+            self._insert(list(self.unassigned))
+            self._repair(displaced or list(self.unassigned))
+
+    def add_groups(self, groups: List[Group]):
+        """Insert new groups into the current assignment and repair around them."""
+        with self._lock:
+            for g in groups:
+                if g.id in self.groups:
+                    self._place(self.groups[g.id], None)
+                    self.unassigned.discard(g.id)
+                self.groups[g.id] = g
+            new_ids = [g.id for g in groups]
+            self._insert(new_ids)
+            # repair the new groups and the groups sharing their shelters
+            touched = dict.fromkeys(self.assignment.get(gid) for gid in new_ids)
+            self._repair(new_ids + [gid for z in touched if z is not None for gid in self.members[z]])
+
+    def remove_groups(self, gids: Iterable[str]):
+        with self._lock:
+            freed = set()
+            for gid in gids:
+                g = self.groups.pop(gid, None)
+                if g is None:
+                    continue
+                zone_id = self.assignment.get(gid)
+                if zone_id is not None:
+                    freed.add(zone_id)
+                self._place(g, None)
+                self.unassigned.discard(gid)
+            if freed:
+                # room opened up: unplaced groups and anyone who'd rather be there may move in
+                self._insert(list(self.unassigned))
+                self._repair([gid for gid, g in self.groups.items() if any(z in g.costs for z in freed)])
+
+    def update_costs(self, costs: Dict[str, Dict[str, float]], version=None):
+        """New travel times (e.g. after a hazard change); warm-starts from the current assignment."""
+        with self._lock:
+            self.version = version
+            for gid, row in costs.items():
+                g = self.groups.get(gid)
+                if g is None:
+                    continue
+                g.costs = row
+                zone_id = self.assignment.get(gid)
+                if zone_id is not None and zone_id not in row:
+                    self._place(g, None)  # its shelter became unreachable
+            self._insert(list(self.unassigned))
+            self._repair(list(self.groups))
+
+    def total_cost(self) -> float:
+        return sum(self.groups[gid].costs[z] for gid, z in self.assignment.items())
+
+    def result(self) -> dict:
+        with self._lock:
+            assignments = [{'sos_id': gid, 'safe_zone': z, 'survivors': self.groups[gid].survivors,
+                            'duration_s': round(self.groups[gid].costs[z], 1)}
+                           for gid, z in self.assignment.items()]
+            unassigned = []
+            for gid in self.unassigned:
+                g = self.groups[gid]
+                nearest = min(g.costs, key=g.costs.get) if g.costs else None
+                unassigned.append({'sos_id': gid, 'survivors': g.survivors, 'nearest_zone': nearest})
+            zones = [{'id': z, 'capacity': cap, 'assigned': self.load.get(z, 0)} for z, cap in self.capacity.items()
+                     if self.load.get(z, 0) or any(z in g.costs for g in self.groups.values())]
+            return {'assignments': assignments, 'unassigned': unassigned, 'zones': zones,
+                    'total_duration_s': round(self.total_cost(), 1), 'moves': self.moves}
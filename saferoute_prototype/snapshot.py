@@ -0,0 +1,314 @@
+"""
+Memory-mapped snapshot of the road graph, safe zones and active hazards.
+
+Parsing road_network.json and snapping hazards to edges take seconds for a
+city extract, and every worker used to repeat it into its own heap. A
+snapshot stores all of it as flat typed columns in one file that every
+worker maps read-only: the road graph is served straight from the mapping
+(zero-copy memoryviews, shared by all processes through the page cache), so
+startup is a few milliseconds and resident memory no longer grows with the
+worker count. Safe zones and hazards (with the edges they already snapped
+to) are small and are copied back into the live registries on startup.
+
+Layout: a fixed header (magic, format version, byte-order mark, directory
+length), a JSON directory naming every column with its typecode, offset and
+length, then the 8-byte aligned columns. Strings are stored as
+``<name>_offsets`` + ``<name>_text`` (UTF-8) pairs.
+
+The API writes a snapshot when it had to build the graph from the extract
+and again on shutdown; write one ahead of a deployment with:
+    python snapshot.py build [road_network.json] [road_network.snap]
+"""
+
+import array
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from hazard_feed import HazardUpdate
+from road_graph import RoadGraph, load_road_graph
+
+MAGIC = b'SRSN'
+FORMAT_VERSION = 1
+BYTE_ORDER_MARK = 0x01020304
+# magic, version, byte order mark, directory length; native byte order like the columns, so
+# the byte order mark tells a snapshot written on a machine of the other endianness apart
+_HEADER = struct.Struct('=4sIIQ')
+
+
+class StringTable:
+    """Read-only sequence of strings decoded on access from an offsets + UTF-8 column pair."""
+
+    def __init__(self, offsets, text):
+        self.offsets = offsets
+        self.text = text
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        if i < 0:
+            i += len(self)
+        return str(self.text[self.offsets[i]:self.offsets[i + 1]], 'utf-8')
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+def _strings(values: Iterable[str]) -> Tuple[array.array, bytes]:
+    offsets = array.array('q', [0])
+    chunks = []
+    for value in values:
+        data = value.encode('utf-8')
+        chunks.append(data)
+        offsets.append(offsets[-1] + len(data))
+    return offsets, b''.join(chunks)
+
+
+def _column(values, typecode: str):
+    """``values`` as a buffer of ``typecode`` items, without copying when it already is one."""
+    if isinstance(values, (bytes, bytearray)):
+        return memoryview(values)
+    try:
+        view = memoryview(values)
+        if view.format == typecode:
+            return view
+    except TypeError:
+        pass
+    return memoryview(array.array(typecode, values))
+
+
+def _source_stamp(path: Optional[str]) -> Optional[dict]:
+    if not path or not os.path.exists(path):
+        return None
+    st = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def _graph_columns(graph: RoadGraph) -> Dict[str, Tuple[str, object]]:
+    rev_offsets, rev_edges, edge_sources = graph._reverse()
+    name_offsets, name_text = _strings(graph.names)
+    return {
+        'lats': ('d', graph.lats), 'lons': ('d', graph.lons),
+        'offsets': ('q', graph.offsets), 'targets': ('q', graph.targets), 'lengths': ('d', graph.lengths),
+        'edge_class': ('B', graph.edge_class), 'edge_name': ('q', graph.edge_name),
+        'name_offsets': ('q', name_offsets), 'name_text': ('B', name_text),
+        'cell_keys': ('q', graph.cell_keys), 'cell_nodes': ('q', graph.cell_nodes),
+        'rev_offsets': ('i', rev_offsets), 'rev_edges': ('i', rev_edges), 'edge_sources': ('i', edge_sources),
+    }
+
+
+def _zone_columns(zones: List[dict]) -> Dict[str, Tuple[str, object]]:
+    columns = {
+        'zone_lat': ('d', [z['lat'] for z in zones]),
+        'zone_lon': ('d', [z['lon'] for z in zones]),
+        'zone_capacity': ('q', [z['capacity'] if z.get('capacity') is not None else -1 for z in zones]),
+    }
+    for field in ('id', 'name', 'kind'):
+        offsets, text = _strings(str(z.get(field) or '') for z in zones)
+        columns[f'zone_{field}_offsets'] = ('q', offsets)
+        columns[f'zone_{field}_text'] = ('B', text)
+    return columns
+
+
+def _hazard_columns(hazards: list) -> Dict[str, Tuple[str, object]]:
+    part_offsets, point_offsets, edge_offsets = array.array('q', [0]), array.array('q', [0]), array.array('q', [0])
+    lats, lons, edges = array.array('d'), array.array('d'), array.array('q')
+    for hz in hazards:
+        for part in hz.parts:
+            for lat, lon in part:
+                lats.append(lat)
+                lons.append(lon)
+            point_offsets.append(len(lats))
+        part_offsets.append(len(point_offsets) - 1)
+        edges.extend(sorted(hz.edges))
+        edge_offsets.append(len(edges))
+    columns = {
+        'hazard_updated': ('d', [hz.updated for hz in hazards]),
+        'hazard_expires': ('d', [hz.expires if hz.expires is not None else math.nan for hz in hazards]),
+        'hazard_part_offsets': ('q', part_offsets), 'hazard_point_offsets': ('q', point_offsets),
+        'hazard_lat': ('d', lats), 'hazard_lon': ('d', lons),
+        'hazard_edge_offsets': ('q', edge_offsets), 'hazard_edges': ('q', edges),
+    }
+    for field in ('id', 'name', 'hazard_type'):
+        offsets, text = _strings(getattr(hz, field) or '' for hz in hazards)
+        columns[f'hazard_{field}_offsets'] = ('q', offsets)
+        columns[f'hazard_{field}_text'] = ('B', text)
+    return columns
+
+
+def save(path: str, graph: Optional[RoadGraph] = None, zones: Iterable[dict] = (), hazards: Iterable = (),
+         hazard_version: int = 0, source: Optional[str] = None):
+    """Write a snapshot atomically; ``hazards`` are hazard_feed.Hazard objects, ``source``
+    the extract ``graph`` was built from (checked by Snapshot.matches)."""
+    zones, hazards = list(zones), list(hazards)
+    columns = dict(_graph_columns(graph)) if graph is not None else {}
+    columns.update(_zone_columns(zones))
+    columns.update(_hazard_columns(hazards))
+    buffers = {name: _column(values, typecode) for name, (typecode, values) in columns.items()}
+    directory = {
+        'created': time.time(),
+        'source': _source_stamp(source) if graph is not None else None,
+        'hazard_version': hazard_version,
+        'has_graph': graph is not None,
+        'edge_reach': list(graph._edge_reach()) if graph is not None else None,
+        'sections': {},
+    }
+    # offsets are relative to the end of the directory, so it can be sized before they are known
+    pos = 0
+    for name, (typecode, _) in columns.items():
+        pos += -pos % 8
+        view = buffers[name]
+        directory['sections'][name] = [typecode, pos, view.nbytes // array.array(typecode).itemsize]
+        pos += view.nbytes
+    blob = json.dumps(directory).encode('utf-8')
+    blob += b' ' * (-(_HEADER.size + len(blob)) % 8)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, BYTE_ORDER_MARK, len(blob)))
+        f.write(blob)
+        base = f.tell()
+        for name in columns:
+            f.write(b'\0' * (base + directory['sections'][name][1] - f.tell()))
+            f.write(buffers[name].cast('B'))
+    # readers keep their mapping of the replaced file
+    os.replace(tmp, path)
+
+
+class Snapshot:
+    def __init__(self, path: str, mm: mmap.mmap, directory: dict, columns: Dict[str, memoryview]):
+        self.path = path
+        self._mm = mm
+        self.directory = directory
+        self.columns = columns
+        self.hazard_version = directory.get('hazard_version', 0)
+        self._graph = None
+
+    def matches(self, source: Optional[str]) -> bool:
+        """Was the graph built from the current version of ``source`` (or is there no source to check)?"""
+        if not self.directory.get('has_graph'):
+            return False
+        stamp = _source_stamp(source)
+        return stamp is None or self.directory.get('source') == stamp
+
+    @property
+    def graph(self) -> Optional[RoadGraph]:
+        """The road graph over the mapped columns (built once, nothing copied)."""
+        if self._graph is None and self.directory.get('has_graph'):
+            c = self.columns
+            graph = RoadGraph(c['lats'], c['lons'], c['offsets'], c['targets'], c['lengths'], c['edge_class'],
+                              c['edge_name'], StringTable(c['name_offsets'], c['name_text']),
+                              c['cell_keys'], c['cell_nodes'])
+            graph._rev_offsets, graph._rev_edges, graph._edge_sources = \
+                c['rev_offsets'], c['rev_edges'], c['edge_sources']
+            graph._reach = tuple(self.directory['edge_reach'])
+            self._graph = graph
+        return self._graph
+
+    def _strings(self, name: str) -> StringTable:
+        return StringTable(self.columns[f'{name}_offsets'], self.columns[f'{name}_text'])
+
+    def zones(self) -> List[dict]:
+        """Safe zones as SafeZoneRegistry.add keyword arguments."""
+        c = self.columns
+        ids, names, kinds = self._strings('zone_id'), self._strings('zone_name'), self._strings('zone_kind')
+        return [{'zone_id': ids[i], 'name': names[i], 'lat': c['zone_lat'][i], 'lon': c['zone_lon'][i],
+                 'capacity': c['zone_capacity'][i] if c['zone_capacity'][i] >= 0 else None, 'kind': kinds[i]}
+                for i in range(len(ids))]
+
+    def hazards(self) -> List[Tuple[HazardUpdate, frozenset]]:
+        """Active hazards as updates to re-apply, each with the edges it had snapped to."""
+        c = self.columns
+        ids, names, types = self._strings('hazard_id'), self._strings('hazard_name'), self._strings('hazard_hazard_type')
+        part_offsets, point_offsets = c['hazard_part_offsets'], c['hazard_point_offsets']
+        lats, lons = c['hazard_lat'], c['hazard_lon']
+        out = []
+        for i in range(len(ids)):
+            parts = [[[lats[p], lons[p]] for p in range(point_offsets[j], point_offsets[j + 1])]
+                     for j in range(part_offsets[i], part_offsets[i + 1])]
+            expires = c['hazard_expires'][i]
+            update = HazardUpdate(ids[i], types[i], parts, names[i] or None, updated=c['hazard_updated'][i],
+                                  expires=None if math.isnan(expires) else expires)
+            edges = c['hazard_edges'][c['hazard_edge_offsets'][i]:c['hazard_edge_offsets'][i + 1]]
+            out.append((update, frozenset(edges.tolist())))
+        return out
+
+    def stats(self) -> dict:
+        graph = self.graph
+        return {
+            'bytes': len(self._mm),
+            'age_s': round(time.time() - self.directory.get('created', 0), 1),
+            'nodes': graph.num_nodes if graph is not None else 0,
+            'edges': graph.num_edges if graph is not None else 0,
+            'zones': len(self.columns['zone_lat']),
+            'hazards': len(self.columns['hazard_updated']),
+            'hazard_version': self.hazard_version,
+        }
+
+
+def load(path: str) -> Optional[Snapshot]:
+    """Map the snapshot at ``path``; None when it is missing, empty, truncated or in another format."""
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError) as e:
+        # ValueError: an empty file cannot be mapped
+        print(f"[snapshot] {path}: cannot map ({e}), ignoring it")
+        return None
+    try:
+        snap = _open(path, mm)
+    except (ValueError, KeyError, TypeError, struct.error) as e:
+        print(f"[snapshot] {path}: unreadable snapshot ({e}), ignoring it")
+        snap = None
+    if snap is None:
+        mm.close()
+    return snap
+
+
+def _open(path: str, mm: mmap.mmap) -> Optional[Snapshot]:
+    if len(mm) < _HEADER.size:
+        print(f"[snapshot] {path}: truncated, ignoring it")
+        return None
+    magic, version, bom, dir_len = _HEADER.unpack_from(mm, 0)
+    if magic != MAGIC or version != FORMAT_VERSION or bom != BYTE_ORDER_MARK:
+        print(f"[snapshot] {path}: unsupported snapshot format, ignoring it")
+        return None
+    base = _HEADER.size + dir_len
+    if base > len(mm):
+        print(f"[snapshot] {path}: truncated, ignoring it")
+        return None
+    directory = json.loads(bytes(mm[_HEADER.size:base]))
+    # check every column fits before any view is taken: mm can only be closed while none is exported
+    bounds = {}
+    for name, (typecode, offset, length) in directory['sections'].items():
+        start = base + offset
+        end = start + length * array.array(typecode).itemsize
+        if offset < 0 or length < 0 or end > len(mm):
+            print(f"[snapshot] {path}: truncated, ignoring it")
+            return None
+        bounds[name] = (typecode, start, end)
+    view = memoryview(mm)
+    columns = {name: view[start:end].cast(typecode) for name, (typecode, start, end) in bounds.items()}
+    return Snapshot(path, mm, directory, columns)
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1] == 'build':
+        src = sys.argv[2] if len(sys.argv) > 2 else 'road_network.json'
+        out_path = sys.argv[3] if len(sys.argv) > 3 else os.path.splitext(src)[0] + '.snap'
+        g = load_road_graph(src)
+        if g is None:
+            sys.exit(f"No road network at {src}")
+        save(out_path, g, source=src)
+        print(f"Saved {out_path}: {g.num_nodes} nodes, {g.num_edges} edges, {os.path.getsize(out_path)} bytes")
+    elif len(sys.argv) >= 3 and sys.argv[1] == 'info':
+        snap = load(sys.argv[2])
+        print(json.dumps(snap.stats() if snap is not None else None, indent=2))
+    else:
+        print(__doc__)
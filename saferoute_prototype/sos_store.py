@@ -0,0 +1,346 @@
+"""
+SQLite persistence for SOS pings.
+
+The database runs in WAL mode so readers never block the writer. Reads use a
+small pool of long-lived connections. Writes go through a write-behind queue:
+one writer thread collects the pings submitted within a few milliseconds and
+commits them in a single transaction. Each caller gets a Future that resolves
+only after its batch is committed, so a ping is durable before /sos answers.
+
+Rows carry an epoch-millisecond ``ts`` and a coarse grid ``cell`` so the
+responders view can page incrementally (``since`` cursor) and filter by the
+visible bbox through indexes instead of scanning the table. Pages follow the
+rowid, which SQLite assigns under the write lock and so in commit order (rows
+are never deleted, so rowids are not reused):
+with several workers writing to one file, a ping stamped earlier by one of
+them can commit after a later one from another, and paging by ``ts`` would
+step over it.
+
+IDs are ULID-style ("SOS-" + 26 Crockford base32 characters: 48-bit
+millisecond time, 80 random bits, incremented within the same millisecond), so
+they never collide, sort by creation time and double as the paging cursor. An
+optional client idempotency key is unique, so a retried submission resolves
+to the ping that was already stored.
+"""
+
+import math
+import queue
+import secrets
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import List, Optional, Tuple
+
+from metrics import SQLITE_SECONDS
+
+# How long the writer waits for more pings after the first one of a batch
+DEFAULT_BATCH_INTERVAL = 0.005
+DEFAULT_MAX_BATCH = 500
+DEFAULT_POOL_SIZE = 4
+# How long save() waits for its batch to commit (the busy timeout plus slack)
+DEFAULT_COMMIT_TIMEOUT = 10.0
+
+DEFAULT_PAGE_LIMIT = 1000
+# Grid bucket size (degrees) of the spatial cell column, ~1 km
+CELL_DEG = 0.01
+# Above this many latitude rows a bbox query just filters on lat/lon
+_MAX_CELL_ROWS = 40
+
+_COLUMNS = 'id, lat, lon, message, survivors, timestamp, ts'
+_INSERT = ('INSERT INTO sos_pings (id, lat, lon, message, survivors, timestamp, ts, cell, idem_key) '
+           'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)')
+
+ID_PREFIX = 'SOS-'
+_CROCKFORD = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+_CROCKFORD_VALUE = {c: i for i, c in enumerate(_CROCKFORD)}
+_ULID_LEN = 26
+
+
+class MonotonicULID:
+    """ULID generator that stays strictly increasing within the process, even for
+    several IDs in one millisecond or when the wall clock steps backwards."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_ms = 0
+        self._last_rand = 0
+
+    def new(self) -> str:
+        now = int(time.time() * 1000)
+        with self._lock:
+            if now > self._last_ms:
+                self._last_ms, self._last_rand = now, secrets.randbits(80)
+            else:
+                self._last_rand += 1
+                if self._last_rand >> 80:
+                    self._last_ms, self._last_rand = self._last_ms + 1, 0
+            value = (self._last_ms << 80) | self._last_rand
+        return ''.join(_CROCKFORD[(value >> shift) & 31] for shift in range(125, -1, -5))
+
+
+_ulids = MonotonicULID()
+
+
+def new_sos_id() -> str:
+    return ID_PREFIX + _ulids.new()
+
+
+def sos_id_ms(sos_id: str) -> Optional[int]:
+    """Creation time (epoch ms) encoded in a ULID-style SOS id, None for legacy ids."""
+    body = sos_id[len(ID_PREFIX):] if sos_id.startswith(ID_PREFIX) else ''
+    if len(body) != _ULID_LEN:
+        return None
+    try:
+        ms = 0
+        for c in body[:10]:
+            ms = ms * 32 + _CROCKFORD_VALUE[c]
+    except KeyError:
+        return None
+    return ms
+
+
+def sos_cell(lat: Optional[float], lon: Optional[float]) -> Optional[int]:
+    if lat is None or lon is None:
+        return None
+    return (int(math.floor(lat / CELL_DEG)) + 9000) * 100000 + int(math.floor(lon / CELL_DEG)) + 18000
+
+
+def _parse_ctime_ms(stamp: Optional[str]) -> int:
+    try:
+        return int(time.mktime(time.strptime(stamp, '%a %b %d %H:%M:%S %Y')) * 1000)
+    except (TypeError, ValueError):
+        return 0
+
+
+def make_cursor(ts: int, sos_id: str) -> str:
+    """The id itself when it encodes ``ts``; "<ts>_<id>" for legacy ids."""
+    if sos_id_ms(sos_id) == ts:
+        return sos_id
+    return f"{ts}_{sos_id}"
+
+
+def parse_cursor(cursor: str) -> Tuple[int, str]:
+    if '_' in cursor:
+        ts, _, sos_id = cursor.partition('_')
+        return int(ts), sos_id
+    ts = sos_id_ms(cursor)
+    if ts is None:
+        raise ValueError(f"invalid cursor: {cursor}")
+    return ts, cursor
+
+
+def _row(ping: dict, idempotency_key: Optional[str] = None) -> tuple:
+    lat, lon = ping['location']['lat'], ping['location']['lon']
+    ts = ping.get('ts') or sos_id_ms(ping['id']) or int(time.time() * 1000)
+    return (ping['id'], lat, lon, ping['message'], ping['survivors'], ping['timestamp'], ts, sos_cell(lat, lon),
+            idempotency_key)
+
+
+def _ping(r) -> dict:
+    return {'id': r[0], 'location': {'lat': r[1], 'lon': r[2]}, 'message': r[3], 'survivors': r[4],
+            'timestamp': r[5], 'ts': r[6]}
+
+
+class SOSStore:
+    def __init__(self, path: str, batch_interval: float = DEFAULT_BATCH_INTERVAL,
+                 max_batch: int = DEFAULT_MAX_BATCH, pool_size: int = DEFAULT_POOL_SIZE):
+        self.path = path
+        self.batch_interval = batch_interval
+        self.max_batch = max_batch
+        self.batches = 0
+        self.rows_written = 0
+        self._queue: "queue.Queue" = queue.Queue()
+        self._pool: "queue.Queue" = queue.Queue()
+        self._writer_conn = self._connect(synchronous='FULL')
+        self._writer_conn.execute('''
+        CREATE TABLE IF NOT EXISTS sos_pings (
+            id TEXT PRIMARY KEY,
+            lat REAL,
+            lon REAL,
+            message TEXT,
+            survivors INTEGER,
+            timestamp TEXT
+        )
+        ''')
+        self._migrate(self._writer_conn)
+        for _ in range(pool_size):
+            self._pool.put(self._connect(synchronous='NORMAL'))
+        self._writer = threading.Thread(target=self._write_loop, name='sos-writer', daemon=True)
+        self._writer.start()
+
+    def _migrate(self, conn: sqlite3.Connection):
+        """Add the epoch ``ts`` and spatial ``cell`` columns (backfilled from the
+        old ctime strings) and their indexes to databases created before them."""
+        # read the schema inside the write lock: workers starting together migrate one at a time
+        conn.execute('BEGIN IMMEDIATE')
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(sos_pings)')}
+        if 'ts' not in columns:
+            conn.execute('ALTER TABLE sos_pings ADD COLUMN ts INTEGER')
+        if 'cell' not in columns:
+            conn.execute('ALTER TABLE sos_pings ADD COLUMN cell INTEGER')
+        if 'idem_key' not in columns:
+            conn.execute('ALTER TABLE sos_pings ADD COLUMN idem_key TEXT')
+        rows = conn.execute('SELECT id, lat, lon, timestamp FROM sos_pings WHERE ts IS NULL OR cell IS NULL').fetchall()
+        conn.executemany('UPDATE sos_pings SET ts = ?, cell = ? WHERE id = ?',
+                         [(_parse_ctime_ms(stamp), sos_cell(lat, lon), sos_id) for sos_id, lat, lon, stamp in rows])
+        conn.execute('CREATE INDEX IF NOT EXISTS sos_pings_ts ON sos_pings (ts, id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS sos_pings_cell_ts ON sos_pings (cell, ts)')
+        conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS sos_pings_idem_key ON sos_pings (idem_key) '
+                     'WHERE idem_key IS NOT NULL')
+        conn.execute('COMMIT')
+
+    def _connect(self, synchronous: str) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        # FULL on the writer: a commit is on disk before its Futures resolve
+        conn.execute(f'PRAGMA synchronous={synchronous}')
+        conn.execute('PRAGMA busy_timeout=5000')
+        conn.execute('PRAGMA cache_size=-16000')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+
+    @contextmanager
+    def reader(self):
+        """Borrow a pooled read connection."""
+        conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    def submit(self, ping: dict, idempotency_key: Optional[str] = None) -> Future:
+        """Queue a ping for the next batch; the Future resolves once it is committed, or fails
+        with sqlite3.IntegrityError if ``idempotency_key`` was already used. Cancelling it before
+        the writer picks it up withdraws the ping."""
+        fut: Future = Future()
+        self._queue.put((_row(ping, idempotency_key), fut))
+        return fut
+
+    def save(self, ping: dict, idempotency_key: Optional[str] = None, timeout: float = DEFAULT_COMMIT_TIMEOUT):
+        """Blocking insert (waits for the batch commit); raises concurrent.futures.TimeoutError
+        when it has not committed within ``timeout`` seconds."""
+        self.submit(ping, idempotency_key).result(timeout=timeout)
+
+    @SQLITE_SECONDS.time(db='sos', op='find_by_key')
+    def find_by_key(self, idempotency_key: str) -> Optional[dict]:
+        """The ping stored under a client idempotency key, if any."""
+        with self.reader() as conn:
+            row = conn.execute(f'SELECT {_COLUMNS} FROM sos_pings WHERE idem_key = ?', (idempotency_key,)).fetchone()
+        return _ping(row) if row else None
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            stop = False
+            # gather whatever else arrives within the batch window
+            try:
+                while len(batch) < self.max_batch:
+                    nxt = self._queue.get(timeout=self.batch_interval)
+                    if nxt is None:
+                        stop = True
+                        break
+                    batch.append(nxt)
+            except queue.Empty:
+                pass
+            # drop pings whose caller gave up (cancelled on timeout); the rest can no longer be cancelled
+            batch = [(row, fut) for row, fut in batch if fut.set_running_or_notify_cancel()]
+            try:
+                if batch:
+                    self._commit(batch)
+            except Exception as e:
+                # e.g. "database is locked" past the busy timeout: fail this batch, keep the writer alive
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+            if stop:
+                return
+
+    @SQLITE_SECONDS.time(db='sos', op='commit')
+    def _commit(self, batch: List[tuple]):
+        conn = self._writer_conn
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany(_INSERT, [row for row, _ in batch])
+            conn.execute('COMMIT')
+        except Exception:
+            # nothing to roll back when BEGIN itself failed (database locked by another worker)
+            if not conn.in_transaction:
+                raise
+            conn.execute('ROLLBACK')
+            # one bad row (e.g. duplicate id) must not fail the whole batch: retry one by one
+            for row, fut in batch:
+                try:
+                    conn.execute(_INSERT, row)
+                    fut.set_result(True)
+                    self.rows_written += 1
+                except Exception as e:
+                    fut.set_exception(e)
+            self.batches += 1
+            return
+        self.batches += 1
+        self.rows_written += len(batch)
+        for _, fut in batch:
+            fut.set_result(True)
+
+    @SQLITE_SECONDS.time(db='sos', op='load_all')
+    def load_all(self) -> List[dict]:
+        with self.reader() as conn:
+            rows = conn.execute(f'SELECT {_COLUMNS} FROM sos_pings ORDER BY ts DESC, id DESC').fetchall()
+        return [_ping(r) for r in rows]
+
+    @SQLITE_SECONDS.time(db='sos', op='query')
+    def query(self, since: Optional[str] = None, limit: int = DEFAULT_PAGE_LIMIT,
+              bbox: Optional[Tuple[float, float, float, float]] = None) -> Tuple[List[dict], Optional[str]]:
+        """Page through pings in commit order. Without ``since`` returns the newest ``limit`` pings
+        (newest first); with a cursor (normally the last id seen) returns the pings committed after it,
+        oldest first. A cursor whose ping is not stored (e.g. "<ts>_" for "since ts") falls back to
+        creation time. ``bbox`` is (south, west, north, east). Returns (pings, cursor to pass as
+        ``since`` next time)."""
+        where, params = [], []
+        if since:
+            ts, sos_id = parse_cursor(since)
+            with self.reader() as conn:
+                row = conn.execute('SELECT rowid FROM sos_pings WHERE id = ?', (sos_id,)).fetchone()
+            if row is not None:
+                where.append('rowid > ?')
+                params.append(row[0])
+            else:
+                where.append('(ts > ? OR (ts = ? AND id > ?))')
+                params += [ts, ts, sos_id]
+        if bbox is not None:
+            south, west, north, east = bbox
+            y0, y1 = int(math.floor(south / CELL_DEG)), int(math.floor(north / CELL_DEG))
+            if y1 - y0 < _MAX_CELL_ROWS:
+                # one indexed cell range per latitude row of the bbox
+                x0, x1 = int(math.floor(west / CELL_DEG)) + 18000, int(math.floor(east / CELL_DEG)) + 18000
+                ranges = []
+                for y in range(y0, y1 + 1):
+                    base = (y + 9000) * 100000
+                    ranges.append('cell BETWEEN ? AND ?')
+                    params += [base + x0, base + x1]
+                where.append('(' + ' OR '.join(ranges) + ')')
+            where.append('lat BETWEEN ? AND ? AND lon BETWEEN ? AND ?')
+            params += [south, north, west, east]
+        order = 'ASC' if since else 'DESC'
+        sql = f'SELECT {_COLUMNS} FROM sos_pings'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += f' ORDER BY rowid {order} LIMIT ?'
+        params.append(limit)
+        with self.reader() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        pings = [_ping(r) for r in rows]
+        if not pings:
+            return pings, since
+        newest = pings[-1] if since else pings[0]
+        return pings, make_cursor(newest['ts'], newest['id'])
+
+    def close(self):
+        """Flush pending writes and stop the writer thread."""
+        self._queue.put(None)
+        self._writer.join(timeout=5)
@@ -0,0 +1,316 @@
+"""
+Multi-worker mode: one hazard authority, every other worker a replica.
+
+With SAFEROUTE_HUB set to a Unix socket path, the workers of
+``uvicorn --workers N`` elect an authority by taking an exclusive lock on
+``<path>.lock``. The authority runs the hazard feed, so there is exactly one
+set of feed readers and one hazard_version counter, and serves the socket.
+The other workers connect to it and mirror its state:
+
+  * on connect a replica sends ``hello`` with whatever it queued while
+    disconnected, and gets ``sync`` back: the whole hazard set at the current
+    hazard_version, the recent SOS pings and counters, and the safe zones;
+  * every hazard batch the authority commits is broadcast with its version
+    and snapped edges, so replicas apply it without re-snapping and report
+    the same hazard_version;
+  * SOS pings, safe-zone edits and POST /admin/hazards bodies that reach a
+    replica are sent up; the authority applies them and relays them to the
+    other replicas.
+
+Messages are JSON lines; what they mean is up to the ``handle`` / ``sync``
+callbacks. The authority encodes each broadcast (and a new replica's sync)
+under its lock, which orders them, but only queues the bytes: every replica
+has its own sender thread, so a slow replica never holds up hazard commits
+or the other replicas. One that falls MAX_PEER_QUEUE messages behind is
+dropped and resyncs when it reconnects. When the authority exits its lock is released, the first replica
+to take it is promoted (it already mirrors the state, so it carries on from
+the same hazard_version) and the others reconnect to it.
+
+Without SAFEROUTE_HUB the hub is "standalone": this process is the authority
+and nothing is sent anywhere.
+"""
+
+import fcntl
+import json
+import os
+import socket
+import struct
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, List, Optional, Union
+
+# Pause between attempts to reach (or replace) the authority
+RECONNECT_DELAY = 0.2
+# A replica that can't take a broadcast within this long is dropped (it resyncs on reconnect)
+SEND_TIMEOUT = 5.0
+# Messages a disconnected replica keeps for the authority
+MAX_PENDING = 10000
+# Messages queued for one replica before the authority gives up on it
+MAX_PEER_QUEUE = 10000
+
+Message = Union[dict, Callable[[], dict]]
+
+
+def _encode(message: dict) -> bytes:
+    return (json.dumps(message, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+def _send_timeout(conn: socket.socket):
+    """Bound blocking sends without a socket timeout, which would also cut off the idle reader."""
+    conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, struct.pack('ll', int(SEND_TIMEOUT), 0))
+
+
+class _Peer:
+    """A connected replica and the encoded messages waiting to be sent to it."""
+
+    def __init__(self, conn: socket.socket, name: str):
+        self.conn = conn
+        self.name = name
+        self.queue: deque = deque()
+        self.cond = threading.Condition()
+        self.closed = False
+
+    def put(self, data: bytes) -> bool:
+        with self.cond:
+            if self.closed or len(self.queue) >= MAX_PEER_QUEUE:
+                return False
+            self.queue.append(data)
+            self.cond.notify()
+            return True
+
+    def take(self) -> Optional[bytes]:
+        with self.cond:
+            while not self.queue and not self.closed:
+                self.cond.wait()
+            return None if self.closed else self.queue.popleft()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.queue.clear()
+            self.cond.notify()
+        try:
+            # wakes the sender and the reader; the reader closes the socket
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class StateHub:
+    def __init__(self, path: Optional[str], handle: Callable[[dict], bool], sync: Callable[[], dict],
+                 promote: Callable[[List[dict]], None]):
+        """``handle(message)`` applies a message from another worker and returns True when the
+        authority should relay it to the other replicas; ``sync()`` is the full state sent to a
+        new replica; ``promote(pending)`` makes this process the authority, with the messages
+        it could not send up meanwhile."""
+        self.path = path
+        self.handle = handle
+        self.sync = sync
+        self.promote = promote
+        self.role = 'standalone' if not path else 'replica'
+        self.sent = 0
+        self.received = 0
+        self.promotions = 0
+        self.reconnects = 0
+        self.dropped = 0
+        self.last_error = None
+        # guards the connections and orders broadcasts against syncs
+        self._lock = threading.Lock()
+        self._replicas: Dict[socket.socket, _Peer] = {}
+        self._upstream: Optional[socket.socket] = None
+        self._pending: deque = deque(maxlen=MAX_PENDING)
+        self._lock_file = None
+        self._server: Optional[socket.socket] = None
+        self._stop = threading.Event()
+
+    @property
+    def is_authority(self) -> bool:
+        return self.role != 'replica'
+
+    def start(self):
+        """Take the authority role if it is free, else keep a replica connection in the background."""
+        if not self.path:
+            self.promote([])
+        elif self._try_lock():
+            self._become_authority()
+        else:
+            threading.Thread(target=self._replica_loop, name='state-hub-replica', daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        with self._lock:
+            peers = list(self._replicas.values())
+            self._replicas.clear()
+            conns = [self._upstream] if self._upstream is not None else []
+        for peer in peers:
+            peer.close()
+        for conn in conns + ([self._server] if self._server is not None else []):
+            try:
+                conn.close()
+            except OSError:
+                pass
+
+    def _try_lock(self) -> bool:
+        f = open(self.path + '.lock', 'a+')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        # held until this process exits
+        self._lock_file = f
+        return True
+
+    # --- authority ---
+    def _become_authority(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        server.listen(64)
+        self._server = server
+        with self._lock:
+            self.role = 'authority'
+            pending = list(self._pending)
+            self._pending.clear()
+        self.promotions += 1
+        self.promote(pending)
+        threading.Thread(target=self._accept, name='state-hub-accept', daemon=True).start()
+
+    def _accept(self):
+        while not self._stop.is_set():
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                return
+            _send_timeout(conn)
+            threading.Thread(target=self._serve_replica, args=(conn,), name='state-hub-peer', daemon=True).start()
+
+    def _serve_replica(self, conn: socket.socket):
+        peer = None
+        try:
+            lines = conn.makefile('r', encoding='utf-8')
+            hello = json.loads(lines.readline() or '{}')
+            for message in hello.get('pending', ()):
+                self._from_replica(message, conn)
+            peer = _Peer(conn, str(hello.get('pid', '?')))
+            with self._lock:
+                # the sync goes first in its queue, so every later broadcast reaches the replica after it
+                peer.put(_encode(self.sync()))
+                self._replicas[conn] = peer
+            threading.Thread(target=self._send_loop, args=(peer,), name='state-hub-send', daemon=True).start()
+            for line in lines:
+                self._from_replica(json.loads(line), conn)
+        except (OSError, ValueError) as e:
+            self.last_error = str(e)[:200]
+        finally:
+            with self._lock:
+                self._replicas.pop(conn, None)
+            if peer is not None:
+                peer.close()
+            conn.close()
+
+    def _send_loop(self, peer: _Peer):
+        while True:
+            data = peer.take()
+            if data is None:
+                return
+            try:
+                peer.conn.sendall(data)
+                self.sent += 1
+            except OSError as e:
+                self.last_error = str(e)[:200]
+                self._drop(peer)
+                return
+
+    def _drop(self, peer: _Peer):
+        with self._lock:
+            if self._replicas.get(peer.conn) is peer:
+                del self._replicas[peer.conn]
+                self.dropped += 1
+        peer.close()
+
+    def _from_replica(self, message: dict, origin: socket.socket):
+        self.received += 1
+        if self.handle(message):
+            self._broadcast(message, exclude=origin)
+
+    def _broadcast(self, message: Message, exclude: Optional[socket.socket] = None):
+        with self._lock:
+            targets = [peer for conn, peer in self._replicas.items() if conn is not exclude]
+            if not targets:
+                return
+            data = _encode(message() if callable(message) else message)
+            lagging = [peer for peer in targets if not peer.put(data)]
+        for peer in lagging:
+            self._drop(peer)
+
+    # --- replica ---
+    def _replica_loop(self):
+        while not self._stop.is_set():
+            if self._try_lock():
+                self._become_authority()
+                return
+            conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                conn.connect(self.path)
+                _send_timeout(conn)
+            except OSError:
+                conn.close()
+                time.sleep(RECONNECT_DELAY)
+                continue
+            try:
+                with self._lock:
+                    pending = list(self._pending)
+                    self._pending.clear()
+                    conn.sendall(_encode({'op': 'hello', 'pid': os.getpid(), 'pending': pending}))
+                    self._upstream = conn
+                for line in conn.makefile('r', encoding='utf-8'):
+                    self.received += 1
+                    self.handle(json.loads(line))
+            except (OSError, ValueError) as e:
+                self.last_error = str(e)[:200]
+            finally:
+                with self._lock:
+                    self._upstream = None
+                conn.close()
+            self.reconnects += 1
+            time.sleep(RECONNECT_DELAY)
+
+    def send(self, message: Message):
+        """Share a local change: the authority broadcasts it to every replica, a replica sends it
+        to the authority (or keeps it until reconnected). ``message`` may be a callable, only
+        built when somebody will receive it."""
+        if self.role == 'standalone':
+            return
+        if self.role == 'authority':
+            self._broadcast(message)
+            return
+        message = message() if callable(message) else message
+        with self._lock:
+            if self._upstream is not None:
+                try:
+                    self._upstream.sendall(_encode(message))
+                    self.sent += 1
+                    return
+                except OSError:
+                    pass
+            self._pending.append(message)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'role': self.role,
+                'pid': os.getpid(),
+                'replicas': len(self._replicas),
+                'connected': self._upstream is not None if self.role == 'replica' else None,
+                'sent': self.sent,
+                'received': self.received,
+                'pending': len(self._pending),
+                'queued': sum(len(peer.queue) for peer in self._replicas.values()),
+                'dropped': self.dropped,
+                'promotions': self.promotions,
+                'reconnects': self.reconnects,
+                'last_error': self.last_error,
+            }
@@ -0,0 +1,127 @@
+"""
+In-memory SOS and hazard state of one API process.
+
+Replaces the old global ``hazard_data`` dict. Recent SOS pings live in a
+capped ring buffer of ``__slots__`` records (the full history is in SQLite),
+and the figures /status reports are kept as running counters, so memory stays
+flat over long uptimes and the summary is O(1). Every mutation and read goes
+through one lock.
+"""
+
+import threading
+from collections import deque
+from typing import Dict, Iterable, List, Optional
+
+DEFAULT_MAX_RECENT_SOS = 10000
+
+HAZARD_KINDS = ('flood_zones', 'closed_roads', 'power_outages')
+# Named hazard area kind each feed hazard_type is reported under (fire has none)
+HAZARD_TYPE_KINDS = {'flooded': 'flood_zones', 'blocked': 'closed_roads', 'powerline': 'power_outages'}
+
+
+class SOSRecord:
+    __slots__ = ('id', 'lat', 'lon', 'location', 'message', 'survivors', 'timestamp', 'ts')
+
+    def __init__(self, sos_id: str, lat: Optional[float], lon: Optional[float], message: str, survivors: int,
+                 timestamp: str, ts: Optional[int] = None, location=None):
+        self.id = sos_id
+        self.lat = lat
+        self.lon = lon
+        # free-text location for pings without coordinates (SafeRouteAI.send_sos)
+        self.location = location
+        self.message = message
+        self.survivors = survivors
+        self.timestamp = timestamp
+        self.ts = ts
+
+    @classmethod
+    def from_ping(cls, ping: dict) -> 'SOSRecord':
+        loc = ping.get('location')
+        if isinstance(loc, dict):
+            return cls(ping['id'], loc.get('lat'), loc.get('lon'), ping.get('message', ''), ping.get('survivors', 1),
+                       ping.get('timestamp'), ping.get('ts'))
+        return cls(ping['id'], None, None, ping.get('message', ''), ping.get('survivors', 1),
+                   ping.get('timestamp'), ping.get('ts'), loc)
+
+    def to_dict(self) -> dict:
+        location = {'lat': self.lat, 'lon': self.lon} if self.location is None else self.location
+        return {'id': self.id, 'location': location, 'message': self.message, 'survivors': self.survivors,
+                'timestamp': self.timestamp, 'ts': self.ts}
+
+
+class StateStore:
+    def __init__(self, hazards: Optional[Dict[str, Iterable[str]]] = None,
+                 max_recent_sos: int = DEFAULT_MAX_RECENT_SOS):
+        self._lock = threading.Lock()
+        self._hazards: Dict[str, List[str]] = {kind: [] for kind in HAZARD_KINDS}
+        for kind, names in (hazards or {}).items():
+            self._hazards[kind] = list(dict.fromkeys(names))
+        self._recent: deque = deque(maxlen=max_recent_sos)
+        self.sos_total = 0
+        self.survivors_total = 0
+        self._recent_survivors = 0
+
+    # --- hazards ---
+    def hazards(self, kind: str) -> List[str]:
+        with self._lock:
+            return list(self._hazards.get(kind, ()))
+
+    def set_hazard(self, kind: str, name: str, present: bool = True) -> bool:
+        """Add or remove a named hazard area; returns True if anything changed."""
+        with self._lock:
+            names = self._hazards.setdefault(kind, [])
+            if present and name not in names:
+                names.append(name)
+                return True
+            if not present and name in names:
+                names.remove(name)
+                return True
+            return False
+
+    def hazards_matching(self, text: str) -> List[str]:
+        """Hazard kinds with an area whose name contains ``text``."""
+        with self._lock:
+            return [kind for kind, names in self._hazards.items() if any(text in n for n in names)]
+
+    # --- SOS pings ---
+    def add_sos(self, ping: dict) -> SOSRecord:
+        record = SOSRecord.from_ping(ping)
+        with self._lock:
+            if len(self._recent) == self._recent.maxlen:
+                self._recent_survivors -= self._recent[0].survivors
+            self._recent.append(record)
+            self._recent_survivors += record.survivors
+            self.sos_total += 1
+            self.survivors_total += record.survivors
+        return record
+
+    def recent_sos(self, limit: Optional[int] = None) -> List[dict]:
+        """The newest pings held in memory, newest first."""
+        with self._lock:
+            records = list(self._recent)
+        records.reverse()
+        return [r.to_dict() for r in records[:limit]]
+
+    def export_sos(self) -> dict:
+        """The recent pings (oldest first) and counters, for load_sos in another process."""
+        with self._lock:
+            return {'recent': [r.to_dict() for r in self._recent], 'sos_total': self.sos_total,
+                    'survivors_total': self.survivors_total}
+
+    def load_sos(self, state: dict):
+        """Replace the recent pings and counters with another process's (state_hub sync)."""
+        records = [SOSRecord.from_ping(p) for p in state.get('recent', ())]
+        with self._lock:
+            self._recent.clear()
+            self._recent.extend(records)
+            self._recent_survivors = sum(r.survivors for r in self._recent)
+            self.sos_total = state.get('sos_total', len(records))
+            self.survivors_total = state.get('survivors_total', self._recent_survivors)
+
+    def summary(self) -> dict:
+        with self._lock:
+            out = {kind: len(names) for kind, names in self._hazards.items()}
+            out['active_sos'] = len(self._recent)
+            out['active_survivors'] = self._recent_survivors
+            out['total_sos'] = self.sos_total
+        return out
@@ -0,0 +1,74 @@
+import math
+import random
+
+import pytest
+
+import contraction
+from conftest import street_dump
+from road_graph import load_overpass_json
+
+
+@pytest.fixture(scope='module')
+def graph():
+    return load_overpass_json(street_dump(8, seed=7))
+
+
+@pytest.fixture(scope='module')
+def ch(graph, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('ch') / 'streets.ch')
+    contraction.save(contraction.build(graph), path)
+    return contraction.load(path, graph)
+
+
+def path_cost(graph, nodes, penalties):
+    total = 0.0
+    for u, v in zip(nodes, nodes[1:]):
+        costs = [graph.lengths[e] * penalties.get(e, 1.0)
+                 for e in range(graph.offsets[u], graph.offsets[u + 1]) if graph.targets[e] == v]
+        total += min(costs)
+    return total
+
+
+def assert_same_costs(graph, ch, penalties, pairs):
+    for s, t in pairs:
+        expected = graph.shortest_path(s, t, penalties)
+        found = ch.shortest_path(s, t, penalties)
+        if expected is None:
+            assert found is None, (s, t)
+            continue
+        assert found is not None, (s, t)
+        nodes, cost = found
+        assert (nodes[0], nodes[-1]) == (s, t)
+        assert cost == pytest.approx(expected[1], rel=1e-9), (s, t)
+        assert path_cost(graph, nodes, penalties) == pytest.approx(cost, rel=1e-9), (s, t)
+
+
+def test_hazard_free_distances_match_astar(graph, ch):
+    n = graph.num_nodes
+    assert_same_costs(graph, ch, {}, [(s, t) for s in range(n) for t in range(n)])
+
+
+def test_penalised_routes_match_astar(graph, ch):
+    rng = random.Random(3)
+    n = graph.num_nodes
+    pairs = [(rng.randrange(n), rng.randrange(n)) for _ in range(300)]
+    for _ in range(5):
+        penalties = {e: rng.choice((2.0, 10.0, math.inf)) for e in rng.sample(range(graph.num_edges), 40)}
+        assert_same_costs(graph, ch, penalties, pairs)
+    assert ch.stats()['hazard_detours'] > 0
+
+
+def test_index_for_another_graph_is_refused(ch, grid_graph, tmp_path):
+    path = str(tmp_path / 'grid.ch')
+    contraction.save(ch, path)
+    assert contraction.load(path, grid_graph) is None
+    assert contraction.load(str(tmp_path / 'missing.ch'), grid_graph) is None
+
+
+@pytest.mark.parametrize('keep', [0, 10, contraction._HEADER.size, -8])
+def test_truncated_index_is_refused(ch, graph, tmp_path, keep):
+    path = str(tmp_path / 'streets.ch')
+    contraction.save(ch, path)
+    with open(path, 'r+b') as f:
+        f.truncate(keep if keep >= 0 else f.seek(0, 2) + keep)
+    assert contraction.load(path, graph) is None
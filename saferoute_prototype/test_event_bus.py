@@ -0,0 +1,89 @@
+import asyncio
+import threading
+
+from event_bus import EventBus, client_topic
+
+
+def frames(sub):
+    """(event, data line) of every frame queued for a subscriber."""
+    out = []
+    while not sub.queue.empty():
+        lines = sub.queue.get_nowait().decode().splitlines()
+        out.append((lines[1][len('event: '):], lines[2][len('data: '):]))
+    return out
+
+
+def test_fan_out_by_topic_and_client():
+    async def run():
+        bus = EventBus()
+        sos, routes = bus.subscribe(['sos']), bus.subscribe(['route'], client_id='c1')
+        bus.publish('sos', {'id': 1})
+        bus.publish('route_invalidated', {'bbox': None})
+        bus.publish('route_update', {'route': []}, topic=client_topic('c1'))
+        bus.publish('route_update', {'route': []}, topic=client_topic('c2'))
+        return frames(sos), frames(routes)
+
+    sos, routes = asyncio.run(run())
+    assert [event for event, _ in sos] == ['sos']
+    assert [event for event, _ in routes] == ['route_invalidated', 'route_update']
+
+
+def test_reconnect_replays_after_last_event_id():
+    async def run():
+        bus = EventBus()
+        ids = [bus.publish('sos', {'n': n}) for n in range(5)]
+        return frames(bus.subscribe(['sos'], last_event_id=ids[1]))
+
+    assert [data for _, data in asyncio.run(run())] == ['{"n":2}', '{"n":3}', '{"n":4}']
+
+
+def test_gap_older_than_the_ring_resyncs():
+    async def run():
+        bus = EventBus(replay=3)
+        for n in range(10):
+            bus.publish('sos', {'n': n})
+        return frames(bus.subscribe(['sos'], last_event_id=f'{bus.epoch}-1')), bus.resyncs
+
+    replayed, resyncs = asyncio.run(run())
+    assert replayed[0] == ('resync', '{"reason":"missed events"}')
+    assert [data for _, data in replayed[1:]] == ['{"n":7}', '{"n":8}', '{"n":9}']
+    assert resyncs == 1
+
+
+def test_id_from_another_process_resyncs():
+    async def run():
+        before, after = EventBus(), EventBus()
+        last = [before.publish('sos', {'n': n}) for n in range(3)][-1]
+        for n in range(5):
+            after.publish('sos', {'n': n})
+        return [frames(after.subscribe(['sos'], last_event_id=event_id)) for event_id in (last, '2', 'junk')]
+
+    for replayed in asyncio.run(run()):
+        # the counters overlap, but nothing after "2" here follows the client's event 2
+        assert replayed == [('resync', '{"reason":"unknown event id"}')]
+
+
+def test_slow_subscriber_backlog_is_replaced_by_resync():
+    async def run():
+        bus = EventBus(queue_size=4)
+        slow, idle = bus.subscribe(['sos']), bus.subscribe(['hazard'])
+        for n in range(10):
+            bus.publish('sos', {'n': n})
+        return frames(slow), frames(idle), slow.dropped
+
+    slow, idle, dropped = asyncio.run(run())
+    assert len(slow) <= 4 and ('resync', '{"reason":"slow consumer"}') in slow
+    assert slow[-1] == ('sos', '{"n":9}')
+    assert dropped > 0 and idle == []
+
+
+def test_publish_from_another_thread():
+    async def run():
+        bus = EventBus()
+        sub = bus.subscribe(['hazard'])
+        thread = threading.Thread(target=bus.publish, args=('hazard', {'hazard_version': 3}))
+        thread.start()
+        thread.join()
+        return await asyncio.wait_for(sub.queue.get(), timeout=5)
+
+    assert b'"hazard_version":3' in asyncio.run(run())
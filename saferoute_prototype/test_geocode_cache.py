@@ -0,0 +1,74 @@
+import pytest
+
+import geocode_cache
+from geocode_cache import GeocodeCache, normalize_address
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(geocode_cache, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def cache(tmp_path, clock):
+    return GeocodeCache(str(tmp_path / 'geocode.db'), ttl=100, negative_ttl=10, stale_ttl=50, max_entries=3)
+
+
+def test_fresh_stale_miss_by_ttl(cache, clock):
+    cache.put('1 Main St', [40.0, -74.0])
+    clock.now += 99
+    assert cache.lookup('1 Main St') == ('fresh', [40.0, -74.0])
+    clock.now += 2
+    assert cache.lookup('1 Main St') == ('stale', [40.0, -74.0])
+    assert cache.get('1 Main St') == (False, None)
+    clock.now += 50
+    assert cache.lookup('1 Main St') == ('miss', None)
+    assert cache.lookup('2 Main St') == ('miss', None)
+
+
+def test_negative_entries(cache, clock):
+    cache.put('Nowhere', None)
+    assert cache.lookup('Nowhere') == ('fresh', None)
+    assert cache.get('Nowhere') == (True, None)
+    clock.now += 11
+    assert cache.lookup('Nowhere') == ('stale', None)
+    stats = cache.stats()
+    assert (stats['negative_hits'], stats['stale_hits'], stats['hits']) == (2, 1, 0)
+
+
+def test_lru_eviction_at_capacity(tmp_path, clock):
+    cache = GeocodeCache(str(tmp_path / 'geocode.db'), max_entries=3)
+    for i, name in enumerate('abc'):
+        clock.now += 1
+        cache.put(name, [40.0, -74.0 + i])
+    # a hit long enough after the put refreshes last_used, so 'a' outlives 'b'
+    clock.now += 400
+    assert cache.lookup('a')[0] == 'fresh'
+    clock.now += 1
+    cache.put('d', [40.0, -73.0])
+    cache.evict()
+    assert cache.stats()['entries'] == 3
+    assert [cache.lookup(name)[0] for name in 'abcd'] == ['fresh', 'miss', 'fresh', 'fresh']
+
+
+def test_expired_entries_past_the_stale_window_are_evicted(cache, clock):
+    cache.put('old', [40.0, -74.0])
+    clock.now += 151
+    cache.evict()
+    assert cache.stats()['entries'] == 0
+
+
+def test_key_normalization(cache):
+    assert normalize_address('  123 Main St. ,  Springfield,IL ') == '123 main st, springfield, il'
+    cache.put('123 Main St., Springfield', [40.0, -74.0])
+    assert cache.lookup('123  main st , SPRINGFIELD') == ('fresh', [40.0, -74.0])
@@ -0,0 +1,28 @@
+from geometry import polylines_crossed, seg_intersect
+
+
+def test_proper_crossing():
+    assert seg_intersect((0, 0), (2, 2), (0, 2), (2, 0))
+    assert seg_intersect((0, 0), (2, 2), (0, 2), (2, 0), touching=True)
+
+
+def test_touches_only_count_when_asked():
+    shared_endpoint = ((0, 0), (1, 1), (1, 1), (2, 0))
+    endpoint_on_segment = ((0, 0), (2, 0), (1, 0), (1, 1))
+    collinear_overlap = ((0, 0), (2, 0), (1, 0), (3, 0))
+    for case in (shared_endpoint, endpoint_on_segment, collinear_overlap):
+        assert not seg_intersect(*case)
+        assert seg_intersect(*case, touching=True)
+
+
+def test_disjoint_segments():
+    assert not seg_intersect((0, 0), (1, 0), (0, 1), (1, 1), touching=True)
+    assert not seg_intersect((0, 0), (1, 0), (2, 0), (3, 0), touching=True)
+
+
+def test_batch_kernel_matches_scalar_test():
+    route = [[0, 0], [1, 1], [2, 0], [3, 1]]
+    hazards = [[[0, 1], [1, 0]], [[5, 5], [6, 6]], [[2.5, 0], [2.5, 2]], [[1, 1], [1, 2]]]
+    expected = [any(seg_intersect(tuple(route[i]), tuple(route[i + 1]), tuple(h[j]), tuple(h[j + 1]))
+                    for i in range(len(route) - 1) for j in range(len(h) - 1)) for h in hazards]
+    assert list(polylines_crossed(route, hazards)) == expected == [True, False, True, False]
@@ -0,0 +1,98 @@
+import json
+import threading
+
+from conftest import grid_point, post_hazard, wait_for
+from hazard_feed import HazardSet, HazardUpdate
+
+
+def events(module, event: str):
+    """Data of the recently published ``event`` frames, oldest first."""
+    found = []
+    for _, _, frame in list(module.event_bus._recent):
+        lines = frame.decode().splitlines()
+        if f'event: {event}' in lines:
+            found.append(json.loads(lines[2][len('data: '):]))
+    return found
+
+
+def cells(route):
+    return {(round((lat - grid_point(0, 0)[0]) * 1000), round((lon - grid_point(0, 0)[1]) * 1000))
+            for lat, lon in route}
+
+
+def route_params(start, dest, **extra):
+    (slat, slon), (dlat, dlon) = grid_point(*start), grid_point(*dest)
+    return dict(extra, start_lat=slat, start_lon=slon, dest_lat=dlat, dest_lon=dlon)
+
+
+def test_one_batch_one_version_everywhere(api):
+    module = api.module
+    params = route_params((7, 0), (7, 9))
+    assert {(7, 4), (7, 5)} <= cells(api.get('/compute_route', params=params).json()['route'])
+    version = module.hazard_version
+    post_hazard(api, 'version-1', [grid_point(7, 3), grid_point(7, 6)], name='Row 7')
+    wait_for(lambda: module.hazard_version > version)
+    assert module.hazard_version == version + 1
+    assert api.get('/status').json()['hazard_version'] == version + 1
+    body = api.get('/compute_route', params=params).json()
+    assert body['hazard_version'] == version + 1
+    assert not {(7, 4), (7, 5)} & cells(body['route'])
+    assert events(module, 'hazard')[-1]['hazard_version'] == version + 1
+    assert events(module, 'route_invalidated')[-1]['hazard_version'] == version + 1
+    post_hazard(api, 'version-1', [grid_point(7, 3), grid_point(7, 6)], status='cleared')
+    wait_for(lambda: module.hazard_version > version + 1)
+    assert {(7, 4), (7, 5)} <= cells(api.get('/compute_route', params=params).json()['route'])
+
+
+def test_tracked_route_is_pushed_at_the_new_version(api):
+    module = api.module
+    params = route_params((6, 0), (6, 9), client_id='client-6')
+    assert {(6, 4), (6, 5)} <= cells(api.get('/compute_route', params=params).json()['route'])
+    version = module.hazard_version
+    post_hazard(api, 'version-2', [grid_point(6, 3), grid_point(6, 6)], name='Row 6')
+    wait_for(lambda: any(e['hazard_version'] > version for e in events(module, 'route_update')))
+    update = events(module, 'route_update')[-1]
+    assert update['hazard_version'] == module.hazard_version
+    assert not {(6, 4), (6, 5)} & cells(update['route'])
+    post_hazard(api, 'version-2', [grid_point(6, 3), grid_point(6, 6)], status='cleared')
+    wait_for(lambda: module.hazard_version > version + 1)
+    module.route_tracker.forget('client-6')
+
+
+def test_replica_follows_the_authority_version(api):
+    module = api.module
+    version = module.hazard_version
+    module.handle_hub_message({'op': 'hazards', 'version': version + 5, 'upserted': [], 'removed': []})
+    assert module.hazard_version == version + 5
+    assert module.route_cache.version == version + 5
+    # a late message for an older version is ignored
+    module.handle_hub_message({'op': 'hazards', 'version': version + 2, 'upserted': [], 'removed': []})
+    assert module.hazard_version == version + 5
+
+
+def test_snapshot_waits_for_the_batch_being_applied(grid_graph):
+    hazards = HazardSet(grid_graph)
+    snapping, release = threading.Event(), threading.Event()
+    snap = hazards._snap
+
+    def slow_snap(update):
+        if update.id == 'row-2':
+            snapping.set()
+            release.wait(5)
+        return snap(update)
+
+    hazards._snap = slow_snap
+    batch = [HazardUpdate(f'row-{r}', 'flooded', [[grid_point(r, 3), grid_point(r, 6)]], f'Row {r}', updated=1.0)
+             for r in (1, 2, 3)]
+    applier = threading.Thread(target=hazards.apply, args=(batch,))
+    applier.start()
+    assert snapping.wait(5)
+    taken = []
+    reader = threading.Thread(target=lambda: taken.append(hazards.snapshot()))
+    reader.start()
+    reader.join(0.1)
+    assert not taken  # not half-way through the batch
+    release.set()
+    applier.join(5)
+    reader.join(5)
+    assert sorted(hz.id for hz in taken[0]) == ['row-1', 'row-2', 'row-3']
@@ -0,0 +1,97 @@
+import math
+import random
+
+import pytest
+
+from conftest import grid_point
+from incremental_route import ActiveRouteTracker, LPAStar, changed_edges_between
+
+
+def random_penalties(graph, rnd, count):
+    return {e: rnd.choice([math.inf, 3.0, 10.0]) for e in rnd.sample(range(graph.num_edges), count)}
+
+
+def astar_cost(graph, src, dst, penalties):
+    found = graph.shortest_path(src, dst, penalties)
+    return math.inf if found is None else found[1]
+
+
+def test_lpa_star_matches_a_star_through_repairs(grid_graph):
+    rnd = random.Random(7)
+    for _ in range(20):
+        src, dst = rnd.sample(range(grid_graph.num_nodes), 2)
+        penalties = random_penalties(grid_graph, rnd, 20)
+        search = LPAStar(grid_graph, src, dst, penalties)
+        assert search.compute()
+        assert search.cost == pytest.approx(astar_cost(grid_graph, src, dst, penalties))
+        for _ in range(5):
+            new = random_penalties(grid_graph, rnd, 20)
+            assert search.update(new, changed_edges_between(penalties, new))
+            penalties = new
+            assert search.cost == pytest.approx(astar_cost(grid_graph, src, dst, penalties))
+
+
+def row_crossing(graph, row=5):
+    """Penalties flooding every edge into or along ``row`` (cuts the grid in two)."""
+    return graph.hazard_penalties([{'name': f'Row {row}', 'hazard_type': 'flooded',
+                                    'geometry': [grid_point(row, c) for c in range(10)]}])
+
+
+def test_track_catches_up_with_a_batch_committed_meanwhile(grid_graph):
+    tracker = ActiveRouteTracker(grid_graph)
+    blocked = row_crossing(grid_graph)
+    route = tracker.track('c1', grid_point(0, 5), grid_point(9, 5), {}, 1, lambda: (blocked, 2))
+    # planned before the row flooded, returned after: the river is now uncrossable
+    assert route is None
+    open_route = tracker.track('c2', grid_point(0, 5), grid_point(4, 5), {}, 1, lambda: (blocked, 2))
+    assert open_route is not None
+    assert tracker.stats()['caught_up'] == 2
+    # the repair pass for version 2 finds it already there
+    assert tracker.repair(blocked, blocked, 2) == []
+
+
+def test_repair_diffs_routes_that_missed_a_pass(grid_graph):
+    tracker = ActiveRouteTracker(grid_graph)
+    blocked = row_crossing(grid_graph)
+    # the pass for version 2 ran before this route (planned at version 1) was tracked
+    tracker.repair(blocked, blocked, 2)
+    assert tracker.track('c1', grid_point(0, 5), grid_point(9, 5), {}, 1) is not None
+    other = dict(blocked)
+    other[0] = 5.0
+    updates = tracker.repair(other, [0], 3)
+    assert updates == [('c1', None)]
+
+
+def test_node_budget_evicts_least_recent_routes(grid_graph):
+    tracker = ActiveRouteTracker(grid_graph, max_nodes=120)
+    for i in range(10):
+        tracker.track(f'c{i}', grid_point(0, 0), grid_point(9, 9), {}, 0)
+        stats = tracker.stats()
+        assert stats['nodes'] <= 120
+        assert stats['nodes'] == sum(r.search.size for r in tracker._routes.values())
+    assert tracker.stats()['evicted'] > 0
+    assert 'c9' in tracker._routes and 'c0' not in tracker._routes
+
+
+def test_repair_keeps_the_node_count(grid_graph):
+    tracker = ActiveRouteTracker(grid_graph)
+    tracker.track('c1', grid_point(0, 0), grid_point(9, 9), {}, 0)
+    blocked = row_crossing(grid_graph, row=3)
+    tracker.repair(blocked, blocked, 1)
+    assert tracker.stats()['nodes'] == sum(r.search.size for r in tracker._routes.values())
+
+
+def test_pushed_repairs_keep_a_route_tracked(grid_graph):
+    tracker = ActiveRouteTracker(grid_graph, ttl=60)
+    tracker.track('moved', grid_point(0, 2), grid_point(9, 2), {}, 0)
+    tracker.track('unmoved', grid_point(8, 0), grid_point(8, 9), {}, 0)
+    for route in tracker._routes.values():
+        route.touched -= 50
+    flooded = grid_graph.hazard_penalties([{'name': 'Row 5', 'hazard_type': 'flooded',
+                                            'geometry': [grid_point(5, c) for c in range(5)]}])
+    assert [client for client, _ in tracker.repair(flooded, flooded, 1)] == ['moved']
+    for route in tracker._routes.values():
+        route.touched -= 20
+    tracker.repair(flooded, [], 2)
+    # the client sent the detour 20 s ago is still following it; the other went quiet 70 s ago
+    assert list(tracker._routes) == ['moved']
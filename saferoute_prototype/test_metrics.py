@@ -0,0 +1,40 @@
+import asyncio
+
+from metrics import HTTP_SECONDS, STREAM_SECONDS, MetricsMiddleware, RequestProfiler
+
+
+def asgi_app(content_type: bytes, after_start=None):
+    async def app(scope, receive, send):
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [(b'content-type', content_type)]})
+        if after_start:
+            after_start()
+        await send({'type': 'http.response.body', 'body': b'data: x\n\n'})
+    return app
+
+
+def call(app, path: str):
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        pass
+
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'route': type('Route', (), {'path': path})}
+    asyncio.run(app(scope, receive, send))
+
+
+def test_streams_are_kept_out_of_request_latency():
+    profiler = RequestProfiler(sample=1.0)
+    profiling = []
+    app = asgi_app(b'text/event-stream; charset=utf-8', lambda: profiling.append(profiler._busy.locked()))
+    call(MetricsMiddleware(app, profiler), '/test-stream')
+    assert HTTP_SECONDS.count(route='/test-stream', method='GET', status=200) == 0
+    assert STREAM_SECONDS.count(route='/test-stream', method='GET', status=200) == 1
+    # the sampled profile is dropped as soon as the stream starts, not held for its lifetime
+    assert profiling == [False]
+
+
+def test_plain_responses_are_request_latency():
+    call(MetricsMiddleware(asgi_app(b'application/json')), '/test-json')
+    assert HTTP_SECONDS.count(route='/test-json', method='GET', status=200) == 1
+    assert STREAM_SECONDS.count(route='/test-json', method='GET', status=200) == 0
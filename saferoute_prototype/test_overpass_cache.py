@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+
+from overpass_cache import OverpassTileCache, TooManyTiles, tiles_for_bbox
+
+BBOX = (40.0, -74.003, 40.003, -74.0)
+
+
+def way(way_id, *points):
+    return {'type': 'way', 'id': way_id, 'tags': {'name': f'Street {way_id}', 'highway': 'residential'},
+            'geometry': [{'lat': lat, 'lon': lon} for lat, lon in points]}
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return OverpassTileCache(str(tmp_path / 'overpass.db'))
+
+
+def test_missing_tiles_are_fetched_once(cache):
+    queries = []
+
+    async def fetch(q):
+        queries.append(q)
+        return {'elements': [way(1, (40.001, -74.001), (40.002, -74.002)), way(2, (41.0, -75.0), (41.1, -75.1))]}
+
+    async def run():
+        first = await cache.query('streets', *BBOX, fetch=fetch)
+        second = await cache.query('streets', *BBOX)
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert [el['id'] for el in first] == [1]
+    assert second == first
+    assert len(queries) == 1
+    assert cache.tile_misses == len(tiles_for_bbox(*BBOX))
+
+
+def test_uncached_bbox_without_fetch_is_none(cache):
+    assert asyncio.run(cache.query('schools', *BBOX)) is None
+
+
+def test_tile_cap(cache):
+    async def fetch(q):
+        raise AssertionError('must not reach Overpass')
+
+    with pytest.raises(TooManyTiles):
+        asyncio.run(cache.query('schools', 39.0, -75.0, 41.0, -73.0, fetch=fetch))
@@ -0,0 +1,183 @@
+import asyncio
+import itertools
+import time
+
+import httpx
+import pytest
+
+from resilience import (HEDGES, CircuitBreaker, CircuitOpenError, RateLimitedError, TokenBucket, Upstream,
+                        is_host_failure, retry_after, revalidate)
+
+_hosts = itertools.count()
+
+
+def upstream(**kwargs) -> Upstream:
+    """An Upstream on a host of its own (breakers are shared per host)."""
+    return Upstream('test', f'http://test-{next(_hosts)}.invalid/api', **kwargs)
+
+
+def status_error(code: int, headers=None) -> httpx.HTTPStatusError:
+    request = httpx.Request('GET', 'http://test.invalid/')
+    response = httpx.Response(code, headers=headers, request=request)
+    return httpx.HTTPStatusError(f'HTTP {code}', request=request, response=response)
+
+
+def test_opens_after_consecutive_failures():
+    breaker = CircuitBreaker('test', failure_threshold=3, reset_timeout=60)
+    for _ in range(2):
+        breaker.before_call()
+        breaker.failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.before_call()
+    breaker.failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    assert breaker.stats()['rejected'] == 1
+
+
+def test_retry_after_opens_at_once():
+    exc = status_error(429, {'Retry-After': '30'})
+    assert is_host_failure(exc) and retry_after(exc) == 30.0
+    assert not is_host_failure(status_error(404))
+    breaker = CircuitBreaker('test', failure_threshold=3, reset_timeout=0.01)
+    breaker.failure(retry_after(exc))
+    time.sleep(0.02)
+    # the host's Retry-After outlasts the reset timeout
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_half_open_probe_success_closes():
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=0.02)
+    breaker.failure()
+    time.sleep(0.03)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()  # one probe at a time
+    breaker.success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.before_call()
+
+
+def test_half_open_probe_failure_reopens_with_backoff():
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=0.02)
+    breaker.failure()
+    time.sleep(0.03)
+    breaker.before_call()
+    breaker.failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.reset_timeout == pytest.approx(0.04)
+    assert breaker.opened == 2
+
+
+def test_bucket_refuses_past_max_wait():
+    async def run():
+        bucket = TokenBucket(rate=1.0, burst=1.0)
+        await bucket.acquire(max_wait=0.0)
+        assert not bucket.try_acquire()
+        with pytest.raises(RateLimitedError):
+            await bucket.acquire(max_wait=0.1)
+        started = time.monotonic()
+        fast = TokenBucket(rate=20.0)
+        await fast.acquire(max_wait=0.0)
+        await fast.acquire(max_wait=1.0)  # waits ~50 ms for the next token
+        return time.monotonic() - started
+
+    assert 0.03 < asyncio.run(run()) < 0.5
+
+
+def test_rejected_call_is_not_sent():
+    up = upstream(bucket=TokenBucket(rate=0.001), max_wait=0.0)
+    sent = []
+
+    async def request():
+        sent.append(1)
+        return 'ok'
+
+    async def run():
+        assert await up.call(request) == 'ok'
+        with pytest.raises(RateLimitedError):
+            await up.call(request)
+
+    asyncio.run(run())
+    assert sent == [1]
+
+
+def test_client_errors_leave_the_failure_count_alone():
+    up = upstream()
+
+    async def fail(exc):
+        raise exc
+
+    async def run():
+        for exc in (httpx.ConnectError('down'), httpx.ConnectError('down'), status_error(404), ValueError('body')):
+            with pytest.raises(type(exc)):
+                await up.call(lambda: fail(exc))
+        assert up.breaker.failures == 2
+        with pytest.raises(httpx.ConnectError):
+            await up.call(lambda: fail(httpx.ConnectError('down')))
+        assert up.breaker.state == CircuitBreaker.OPEN
+        # a bad answer to the half-open probe frees the probe slot without closing the circuit
+        up.breaker._open_until = 0.0
+        with pytest.raises(ValueError):
+            await up.call(lambda: fail(ValueError('body')))
+        assert up.breaker.state == CircuitBreaker.HALF_OPEN
+        up.breaker.before_call()
+
+    asyncio.run(run())
+
+
+def test_hedge_fires_after_the_delay_and_cancels_the_loser():
+    up = upstream(hedge=True)
+    for _ in range(20):
+        up.latency.add(0.01)
+    assert up.hedge_delay() == pytest.approx(0.05)
+    calls, cancelled = [], []
+
+    async def request():
+        n = len(calls)
+        calls.append(time.monotonic())
+        try:
+            await asyncio.sleep(10 if n == 0 else 0)
+        except asyncio.CancelledError:
+            cancelled.append(n)
+            raise
+        return n
+
+    async def run():
+        started = time.monotonic()
+        result = await up.call(request)
+        await asyncio.sleep(0)
+        return result, started
+
+    won = HEDGES.value(service='test', result='won')
+    result, started = asyncio.run(run())
+    assert result == 1
+    assert calls[1] - started >= 0.05
+    assert cancelled == [0]
+    assert HEDGES.value(service='test', result='won') == won + 1
+
+
+def test_revalidate_runs_one_refresh_per_key():
+    async def run():
+        gate = asyncio.Event()
+        runs = []
+
+        async def refresh():
+            runs.append(1)
+            await gate.wait()
+
+        assert revalidate('test', 'key', refresh)
+        assert not revalidate('test', 'key', refresh)
+        assert revalidate('test', 'other', refresh)
+        await asyncio.sleep(0)
+        gate.set()
+        for _ in range(5):
+            await asyncio.sleep(0)
+        assert len(runs) == 2
+        # finished refreshes no longer block the key
+        assert revalidate('test', 'key', refresh)
+        await asyncio.sleep(0)
+
+    asyncio.run(run())
@@ -0,0 +1,107 @@
+import math
+import random
+
+import pytest
+
+from conftest import ADMIN_TOKEN, GRID_STEP, grid_point, street_dump
+from road_graph import CLASS_SPEED_MS, HAZARD_PENALTIES, load_overpass_json
+
+
+def cell(graph, node):
+    return round((graph.lats[node] - grid_point(0, 0)[0]) / GRID_STEP), \
+        round((graph.lons[node] - grid_point(0, 0)[1]) / GRID_STEP)
+
+
+def route_cells(graph, start, end, penalties=None):
+    found = graph.shortest_path(graph.nearest_node(*grid_point(*start)), graph.nearest_node(*grid_point(*end)),
+                                penalties)
+    return None if found is None else [cell(graph, n) for n in found[0]]
+
+
+def flooded(cols, row=5, name='Row 5'):
+    return {'name': name, 'hazard_type': 'flooded', 'geometry': [grid_point(row, c) for c in cols]}
+
+
+def test_route_does_not_cross_a_flooded_street_at_an_intersection(grid_graph):
+    direct = route_cells(grid_graph, (0, 5), (9, 5))
+    assert (5, 5) in direct
+    penalties = grid_graph.hazard_penalties([flooded(range(3, 8))])
+    detour = route_cells(grid_graph, (0, 5), (9, 5), penalties)
+    assert detour is not None
+    assert not {(5, c) for c in range(3, 8)} & set(detour)
+
+
+def test_unnamed_hazard_geometry_still_blocks(grid_graph):
+    penalties = grid_graph.hazard_penalties([flooded(range(3, 8), name=None)])
+    detour = route_cells(grid_graph, (0, 5), (9, 5), penalties)
+    assert not {(5, c) for c in range(3, 8)} & set(detour)
+
+
+def test_street_spanning_the_grid_cuts_it(grid_graph):
+    penalties = grid_graph.hazard_penalties([flooded(range(10))])
+    assert route_cells(grid_graph, (0, 5), (9, 5), penalties) is None
+    assert route_cells(grid_graph, (0, 0), (4, 9), penalties) is not None
+
+
+def test_powerline_is_a_finite_penalty(grid_graph):
+    hazard = dict(flooded(range(10)), hazard_type='powerline')
+    penalties = grid_graph.hazard_penalties([hazard])
+    assert set(penalties.values()) == {HAZARD_PENALTIES['powerline']}
+    assert math.isfinite(HAZARD_PENALTIES['powerline'])
+    assert route_cells(grid_graph, (0, 5), (9, 5), penalties) is not None
+
+
+def path_legs(graph, nodes, penalties):
+    """(metres, seconds) along a node path, taking the cheapest edge of each step."""
+    metres = secs = 0.0
+    for u, v in zip(nodes, nodes[1:]):
+        e = min((e for e in range(graph.offsets[u], graph.offsets[u + 1]) if graph.targets[e] == v),
+                key=lambda e: graph.lengths[e] * penalties.get(e, 1.0))
+        metres += graph.lengths[e]
+        secs += graph.lengths[e] / CLASS_SPEED_MS[graph.edge_class[e]]
+    return metres, secs
+
+
+@pytest.mark.parametrize('n_sources, n_targets', [(3, 7), (7, 3)])
+def test_matrix_matches_shortest_paths(n_sources, n_targets):
+    # forward trees from the sources when they are fewer, reverse trees from the targets otherwise
+    graph = load_overpass_json(street_dump(8, seed=5))
+    rng = random.Random(n_sources)
+    penalties = {e: rng.choice((3.0, math.inf)) for e in rng.sample(range(graph.num_edges), 30)}
+    sources = rng.sample(range(graph.num_nodes), n_sources)
+    targets = rng.sample(range(graph.num_nodes), n_targets)
+    for pen in ({}, penalties):
+        rows = graph.matrix(sources, targets, pen)
+        for i, s in enumerate(sources):
+            for j, t in enumerate(targets):
+                found = graph.shortest_path(s, t, pen)
+                if found is None:
+                    assert rows[i][j] is None, (s, t)
+                else:
+                    assert rows[i][j] == pytest.approx(path_legs(graph, found[0], pen)), (s, t)
+
+
+def test_evacuation_matrix_request(api):
+    headers = {'X-Admin-Token': ADMIN_TOKEN}
+    for zone_id, cell in (('matrix-a', (0, 0)), ('matrix-b', (9, 9))):
+        lat, lon = grid_point(*cell)
+        r = api.post('/admin/safe_zones', json={'id': zone_id, 'name': zone_id, 'lat': lat, 'lon': lon}, headers=headers)
+        assert r.status_code == 200
+    try:
+        origins = [grid_point(0, 2), grid_point(8, 9)]
+        r = api.post('/evacuation_matrix', json={'origins': origins, 'safe_zones': ['matrix-a', 'matrix-b']})
+        assert r.status_code == 200, r.text
+        body = r.json()
+        assert [a['safe_zone'] for a in body['assignments']] == ['matrix-a', 'matrix-b']
+        graph = api.module.road_graph
+        a, b = graph.nearest_node(*grid_point(0, 0)), graph.nearest_node(*grid_point(9, 9))
+        o = graph.nearest_node(*grid_point(0, 2))
+        assert body['distance_m'][0] == pytest.approx([graph.shortest_path(o, a)[1], graph.shortest_path(o, b)[1]],
+                                                      abs=0.1)
+        assert body['hazard_version'] == api.module.hazard_version
+        bad = api.post('/evacuation_matrix', json={'origins': origins, 'safe_zones': ['no-such-zone']})
+        assert bad.status_code == 400
+        assert api.post('/evacuation_matrix', json={'origins': []}).status_code == 400
+    finally:
+        for zone_id in ('matrix-a', 'matrix-b'):
+            api.delete(f'/admin/safe_zones/{zone_id}', headers=headers)
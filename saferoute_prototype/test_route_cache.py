@@ -0,0 +1,63 @@
+from conftest import grid_point, post_hazard, wait_for
+from route_cache import RouteCache, polyline_bbox
+
+
+def line(*cells):
+    return [grid_point(*c) for c in cells]
+
+
+def test_hits_only_at_the_current_version():
+    cache = RouteCache(version=3)
+    cache.put('a', 3, line((0, 0), (0, 5)))
+    assert cache.get('a', 3) == line((0, 0), (0, 5))
+    assert cache.get('a', 2) is None
+
+
+def test_put_under_an_old_version_is_ignored():
+    cache = RouteCache(version=4)
+    cache.put('a', 3, line((0, 0), (0, 5)))
+    assert len(cache) == 0
+
+
+def test_advance_drops_only_routes_near_the_change():
+    cache = RouteCache(version=1)
+    cache.put('near', 1, line((0, 0), (0, 9)))
+    cache.put('far', 1, line((9, 0), (9, 9)))
+    cache.advance(2, [polyline_bbox(line((1, 3), (1, 6)))])
+    assert cache.get('near', 2) is None
+    assert cache.get('far', 2) == line((9, 0), (9, 9))
+    assert cache.stats()['invalidated'] == 1 and cache.stats()['carried_forward'] == 1
+
+
+def test_lru_bound():
+    cache = RouteCache(max_entries=2)
+    for key in 'abc':
+        cache.put(key, 0, line((0, 0), (0, 1)))
+    assert cache.get('a', 0) is None and cache.get('c', 0) is not None
+
+
+def test_routing_leaves_the_hazard_version_alone(api):
+    version = api.get('/status').json()['hazard_version']
+    params = {'start_lat': grid_point(0, 0)[0], 'start_lon': grid_point(0, 0)[1],
+              'dest_lat': grid_point(0, 9)[0], 'dest_lon': grid_point(0, 9)[1]}
+    for _ in range(3):
+        assert api.get('/compute_route', params=params).status_code == 200
+        api.get('/find_safe_zone', params={'address': 'Test Address'})
+    assert api.get('/status').json()['hazard_version'] == version
+    assert api.module.route_cache.stats()['hits'] >= 2
+
+
+def test_hazard_elsewhere_keeps_cached_routes(api):
+    module = api.module
+    params = {'start_lat': grid_point(9, 0)[0], 'start_lon': grid_point(9, 0)[1],
+              'dest_lat': grid_point(9, 9)[0], 'dest_lon': grid_point(9, 9)[1]}
+    api.get('/compute_route', params=params)
+    carried = module.route_cache.stats()['carried_forward']
+    version = module.hazard_version
+    post_hazard(api, 'far-away', line((2, 2), (2, 3)), name='Row 2')
+    wait_for(lambda: module.hazard_version > version)
+    assert module.route_cache.stats()['carried_forward'] > carried
+    hits = module.route_cache.stats()['hits']
+    api.get('/compute_route', params=params)
+    assert module.route_cache.stats()['hits'] == hits + 1
+    post_hazard(api, 'far-away', line((2, 2), (2, 3)), status='cleared')
@@ -0,0 +1,75 @@
+import random
+
+import pytest
+
+from geometry import haversine_m
+from safe_zones import SafeZoneRegistry
+
+
+def brute_force(registry, lat, lon, k, max_dist_m=None, min_capacity=None):
+    found = []
+    for zone in registry.all():
+        d = haversine_m(lat, lon, zone['lat'], zone['lon'])
+        cap = zone['capacity']
+        if (max_dist_m is None or d <= max_dist_m) and (min_capacity is None or cap is None or cap >= min_capacity):
+            found.append((d, zone['id']))
+    return sorted(found)[:k]
+
+
+def assert_matches(registry, rng, queries=50, **kwargs):
+    for _ in range(queries):
+        lat, lon = rng.uniform(39.9, 40.1), rng.uniform(-74.1, -73.9)
+        expected = brute_force(registry, lat, lon, **kwargs)
+        got = registry.nearest(lat, lon, **kwargs)
+        assert [z['id'] for z, _ in got] == [z for _, z in expected]
+        assert [d for _, d in got] == pytest.approx([d for d, _ in expected], rel=1e-6)
+
+
+@pytest.fixture
+def registry():
+    rng = random.Random(11)
+    registry = SafeZoneRegistry()
+    for i in range(300):
+        registry.add(f'z{i}', f'Zone {i}', rng.uniform(39.9, 40.1), rng.uniform(-74.1, -73.9),
+                     rng.choice((None, 50, 200, 800)))
+    return registry
+
+
+def test_nearest_matches_brute_force(registry):
+    rng = random.Random(1)
+    assert registry._tree is not None
+    assert_matches(registry, rng, k=1)
+    assert_matches(registry, rng, k=8, max_dist_m=3000)
+    assert_matches(registry, rng, k=5, min_capacity=200)
+
+
+def test_pending_adds_and_removed_zones(registry):
+    rng = random.Random(2)
+    registry.remove('z0')
+    registry.remove('z1')
+    registry.add('z2', 'Zone 2 moved', 40.0, -74.0, 100)
+    registry.add('new', 'New Shelter', 40.001, -74.001, None)
+    assert registry._pending and registry._removed
+    assert 'z0' not in registry and 'new' in registry
+    assert_matches(registry, rng, k=6)
+    [(zone, d)] = registry.nearest(40.001, -74.001)
+    assert zone['id'] == 'new' and d < 1
+
+
+def test_rebuild_after_removals(registry):
+    rng = random.Random(3)
+    for i in range(0, 300, 3):
+        registry.remove(f'z{i}')
+    # past the rebuild threshold the tree is rebuilt without the tombstones
+    assert len(registry._tree_ids) < 300
+    assert len(registry._removed) < 32
+    assert_matches(registry, rng, k=4)
+    assert len(registry) == 200
+
+
+def test_set_capacity(registry):
+    assert registry.set_capacity('z5', 10)
+    assert registry.get('z5')['capacity'] == 10
+    assert not registry.set_capacity('missing', 10)
+    lat, lon = registry.get('z5')['lat'], registry.get('z5')['lon']
+    assert registry.nearest(lat, lon, min_capacity=20)[0][0]['id'] != 'z5'
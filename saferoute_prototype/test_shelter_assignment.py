@@ -0,0 +1,104 @@
+import math
+import random
+
+from shelter_assignment import Group, ShelterAssigner
+
+
+def random_groups(n, zones, seed, candidates=3):
+    rnd = random.Random(seed)
+    return [Group(f'g{i:04d}', rnd.randint(1, 4), 0.0, 0.0, i,
+                  {z: rnd.uniform(60, 3600) for z in rnd.sample(zones, candidates)})
+            for i in range(n)]
+
+
+def check_consistent(a: ShelterAssigner):
+    for zone_id, cap in a.capacity.items():
+        members = a.members.get(zone_id, {})
+        assert sum(a.groups[gid].survivors for gid in members) == a.load.get(zone_id, 0)
+        assert cap is None or a.load.get(zone_id, 0) <= cap
+    assert {gid for z, m in a.members.items() for gid in m} == set(a.assignment)
+    assert all(gid in a.members[z] for gid, z in a.assignment.items())
+    assert set(a.assignment) | a.unassigned == set(a.groups)
+    assert not set(a.assignment) & a.unassigned
+
+
+def test_capacity_is_respected():
+    zones = [f'z{i}' for i in range(6)]
+    a = ShelterAssigner()
+    a.set_capacities({z: 10 for z in zones})
+    a.add_groups(random_groups(60, zones, 1))
+    check_consistent(a)
+    assert a.unassigned
+
+
+def test_regret_insertion_keeps_the_group_with_no_alternative():
+    a = ShelterAssigner()
+    a.set_capacities({'near': 2, 'far': 10})
+    flexible = Group('flexible', 2, 0, 0, 0, {'near': 100, 'far': 110})
+    stuck = Group('stuck', 2, 0, 0, 1, {'near': 100})
+    a.add_groups([flexible, stuck])
+    assert a.assignment == {'flexible': 'far', 'stuck': 'near'}
+
+
+def test_swap_lowers_total_cost():
+    a = ShelterAssigner()
+    a.set_capacities({'a': 2, 'b': 2})
+    a.add_groups([Group('g', 2, 0, 0, 0, {'a': 500, 'b': 100})])
+    a.add_groups([Group('h', 2, 0, 0, 1, {'a': 50, 'b': 1000})])
+    assert a.assignment == {'g': 'b', 'h': 'a'}
+    check_consistent(a)
+
+
+def reference_insert(a: ShelterAssigner, gids):
+    """The plain O(n^2) regret insertion: rescan every pending group before each placement."""
+    pending = list(gids)
+    while pending:
+        best_gid, best_regret, best_zone = None, -1.0, None
+        for gid in pending:
+            options = a._options(a.groups[gid])
+            if not options:
+                continue
+            regret = options[1][0] - options[0][0] if len(options) > 1 else math.inf
+            if regret > best_regret:
+                best_gid, best_regret, best_zone = gid, regret, options[0][1]
+        if best_gid is None:
+            break
+        a._place(a.groups[best_gid], best_zone)
+        pending.remove(best_gid)
+    for gid in pending:
+        a._place(a.groups[gid], None)
+
+
+def test_insertion_matches_full_rescan():
+    zones = [f'z{i}' for i in range(8)]
+    for seed in range(10):
+        placed = []
+        for insert in (None, reference_insert):
+            a = ShelterAssigner()
+            a.set_capacities({z: 15 if i % 3 else None for i, z in enumerate(zones)})
+            a._repair = lambda gids: None
+            groups = random_groups(120, zones, seed)
+            a.groups.update((g.id, g) for g in groups)
+            (insert or ShelterAssigner._insert)(a, [g.id for g in groups])
+            check_consistent(a)
+            placed.append(dict(a.assignment))
+        assert placed[0] == placed[1]
+
+
+def test_incremental_updates_stay_consistent():
+    zones = [f'z{i}' for i in range(10)]
+    a = ShelterAssigner()
+    a.set_capacities({z: 12 for z in zones})
+    groups = random_groups(80, zones, 2)
+    for i in range(0, 80, 8):
+        a.add_groups(groups[i:i + 8])
+        check_consistent(a)
+    a.remove_groups([g.id for g in groups[:20]])
+    check_consistent(a)
+    a.set_capacities({z: 6 for z in zones[:8]})
+    check_consistent(a)
+    rnd = random.Random(3)
+    a.update_costs({g.id: {z: c * rnd.uniform(0.5, 2) for z, c in g.costs.items()} for g in groups[20:]}, version=1)
+    check_consistent(a)
+    assert a.version == 1
+
@@ -0,0 +1,105 @@
+import mmap
+
+import pytest
+
+import snapshot
+from conftest import grid_point
+from hazard_feed import HazardSet, HazardUpdate
+
+ZONE = {'id': 'zone-1', 'name': 'Test School', 'lat': 40.005, 'lon': -73.995, 'capacity': 300, 'kind': 'school'}
+
+
+@pytest.fixture
+def saved(grid_graph, tmp_path):
+    hazards = HazardSet(grid_graph)
+    hazards.apply([HazardUpdate('hz-1', 'flooded', [[grid_point(5, 3), grid_point(5, 7)]], 'Row 5', updated=100.0,
+                                expires=4e9)])
+    path = str(tmp_path / 'grid.snap')
+    snapshot.save(path, grid_graph, [ZONE], hazards.hazards.values(), hazard_version=7)
+    return path, hazards
+
+
+@pytest.fixture
+def mappings(monkeypatch):
+    """Every mmap snapshot.load opens, to check rejected files are unmapped."""
+    opened = []
+    real = mmap.mmap
+
+    def tracked(*args, **kwargs):
+        mm = real(*args, **kwargs)
+        opened.append(mm)
+        return mm
+
+    monkeypatch.setattr(snapshot.mmap, 'mmap', tracked)
+    return opened
+
+
+def test_round_trip(grid_graph, saved):
+    path, hazards = saved
+    snap = snapshot.load(path)
+    graph = snap.graph
+    assert (graph.num_nodes, graph.num_edges) == (grid_graph.num_nodes, grid_graph.num_edges)
+    assert list(graph.names) == list(grid_graph.names)
+    for s, t in ((0, 99), (5, 94), (42, 17)):
+        assert graph.shortest_path(s, t)[1] == pytest.approx(grid_graph.shortest_path(s, t)[1])
+    assert snap.zones() == [{'zone_id': 'zone-1', 'name': 'Test School', 'lat': 40.005, 'lon': -73.995,
+                             'capacity': 300, 'kind': 'school'}]
+    [(update, edges)] = snap.hazards()
+    hz = hazards.hazards['hz-1']
+    assert (update.id, update.name, update.hazard_type, update.parts) == (hz.id, hz.name, hz.hazard_type, hz.parts)
+    assert (update.updated, update.expires) == (hz.updated, hz.expires)
+    assert edges == hz.edges and edges
+    assert snap.hazard_version == 7
+    assert snap.matches(None)
+
+
+def test_stale_source_does_not_match(grid_graph, tmp_path):
+    source = tmp_path / 'grid.json'
+    source.write_text('{}')
+    path = str(tmp_path / 'grid.snap')
+    snapshot.save(path, grid_graph, source=str(source))
+    assert snapshot.load(path).matches(str(source))
+    source.write_text('{"elements": []}')
+    assert not snapshot.load(path).matches(str(source))
+
+
+def rewrite(path, offset, data):
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        f.write(data)
+
+
+def test_other_format_version_is_refused(saved, mappings):
+    path, _ = saved
+    rewrite(path, 4, snapshot.struct.pack('=I', snapshot.FORMAT_VERSION + 1))
+    assert snapshot.load(path) is None
+    assert mappings[0].closed
+
+
+def test_other_byte_order_is_refused(saved, mappings):
+    path, _ = saved
+    swapped = snapshot.BYTE_ORDER_MARK.to_bytes(4, 'big' if snapshot.sys.byteorder == 'little' else 'little')
+    rewrite(path, 8, swapped)
+    assert snapshot.load(path) is None
+    assert mappings[0].closed
+
+
+@pytest.mark.parametrize('keep', [0, 10, 100, -8])
+def test_truncated_file_is_refused(saved, mappings, keep):
+    path, _ = saved
+    with open(path, 'r+b') as f:
+        f.truncate(keep if keep >= 0 else f.seek(0, 2) + keep)
+    assert snapshot.load(path) is None
+    assert all(mm.closed for mm in mappings)
+
+
+def test_corrupt_directory_is_refused(saved, mappings):
+    path, _ = saved
+    rewrite(path, snapshot._HEADER.size, b'{not json')
+    assert snapshot.load(path) is None
+    assert mappings[0].closed
+
+
+def test_missing_file(tmp_path):
+    assert snapshot.load(str(tmp_path / 'missing.snap')) is None
+    assert snapshot.load('') is None
@@ -0,0 +1,173 @@
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+import pytest
+
+from sos_store import SOSStore, make_cursor, new_sos_id, parse_cursor, sos_id_ms
+
+
+def make_ping(lat=40.0, lon=-74.0, message='help', survivors=1):
+    sos_id = new_sos_id()
+    ts = sos_id_ms(sos_id)
+    return {'id': sos_id, 'location': {'lat': lat, 'lon': lon}, 'message': message, 'survivors': survivors,
+            'timestamp': time.ctime(ts / 1000), 'ts': ts}
+
+
+@pytest.fixture
+def store(tmp_path):
+    s = SOSStore(str(tmp_path / 'sos.db'))
+    yield s
+    s.close()
+
+
+@pytest.fixture
+def locked(store):
+    """Another connection holding the write lock, with the writer's busy timeout cut short."""
+    store._writer_conn.execute('PRAGMA busy_timeout=50')
+    other = sqlite3.connect(store.path, isolation_level=None)
+    other.execute('BEGIN IMMEDIATE')
+    yield other
+    other.execute('ROLLBACK')
+    other.close()
+
+
+def test_batched_submits_commit(store):
+    futures = [store.submit(make_ping(message=str(i))) for i in range(50)]
+    for fut in futures:
+        assert fut.result(timeout=5) is True
+    assert len(store.load_all()) == 50
+    assert store.rows_written == 50
+
+
+def test_duplicate_id_fails_only_its_own_ping(store):
+    ping = make_ping()
+    store.save(ping)
+    dup, ok = store.submit(ping), store.submit(make_ping())
+    with pytest.raises(sqlite3.IntegrityError):
+        dup.result(timeout=5)
+    assert ok.result(timeout=5) is True
+
+
+def test_idempotency_key_is_unique(store):
+    first, retry = store.submit(make_ping(), 'key-1'), store.submit(make_ping(), 'key-1')
+    assert first.result(timeout=5) is True
+    with pytest.raises(sqlite3.IntegrityError):
+        retry.result(timeout=5)
+    assert store.find_by_key('key-1')['id'] == store.load_all()[0]['id']
+
+
+def test_locked_database_fails_the_batch(store, locked):
+    fut = store.submit(make_ping())
+    with pytest.raises(sqlite3.OperationalError, match='locked'):
+        fut.result(timeout=5)
+
+
+def test_writer_survives_a_locked_database(store, locked):
+    with pytest.raises(sqlite3.OperationalError):
+        store.submit(make_ping()).result(timeout=5)
+    locked.execute('ROLLBACK')
+    locked.execute('BEGIN')
+    assert store._writer.is_alive()
+    store.save(make_ping(), timeout=5)
+    assert len(store.load_all()) == 1
+
+
+def test_save_times_out(store):
+    # a writer stuck behind a long batch window never answers in time
+    store.batch_interval = 1.0
+    store.max_batch = 2
+    with pytest.raises(FutureTimeout):
+        store.save(make_ping(), timeout=0.1)
+
+
+def test_cancelled_ping_is_withdrawn(store):
+    store.batch_interval = 0.2
+    store.max_batch = 3
+    kept = store.submit(make_ping(message='kept'))
+    withdrawn = store.submit(make_ping(message='withdrawn'))
+    assert withdrawn.cancel()
+    assert kept.result(timeout=5) is True
+    assert [p['message'] for p in store.load_all()] == ['kept']
+
+
+def page_all(store, since, limit, bbox=None):
+    seen = []
+    while True:
+        pings, since = store.query(since=since, limit=limit, bbox=bbox)
+        if not pings:
+            return seen, since
+        seen += [p['id'] for p in pings]
+
+
+def test_cursor_paging_sees_every_ping_once(store):
+    first = [make_ping(message=str(i)) for i in range(5)]
+    for ping in first:
+        store.save(ping)
+    newest, cursor = store.query(limit=3)
+    assert [p['id'] for p in newest] == [p['id'] for p in reversed(first)][:3]
+    assert cursor == first[-1]['id']
+    # many ids share a millisecond: the id breaks ties within it
+    later = [make_ping(message=str(i)) for i in range(25)]
+    for fut in [store.submit(p) for p in later]:
+        fut.result(timeout=5)
+    seen, cursor = page_all(store, cursor, limit=4)
+    assert seen == [p['id'] for p in later]
+    assert cursor == later[-1]['id']
+    assert store.query(since=cursor) == ([], cursor)
+
+
+def test_bbox_paging(store):
+    inside = [make_ping(lat=40.0 + i * 0.005, lon=-74.0) for i in range(6)]
+    outside = [make_ping(lat=41.5, lon=-74.0), make_ping(lat=40.01, lon=-73.0)]
+    for ping in inside + outside:
+        store.save(ping)
+    bbox = (39.99, -74.01, 40.03, -73.99)
+    pings, cursor = store.query(limit=100, bbox=bbox)
+    assert {p['id'] for p in pings} == {p['id'] for p in inside}
+    seen, _ = page_all(store, inside[1]['id'], limit=2, bbox=bbox)
+    assert seen == [p['id'] for p in inside[2:]]
+
+
+def test_ping_committed_late_by_another_writer_is_paged(store):
+    other = SOSStore(store.path)
+    try:
+        early, late = make_ping(message='early'), make_ping(message='late')
+        other.save(late)
+        pings, cursor = store.query(limit=10)
+        assert [p['id'] for p in pings] == [late['id']]
+        # stamped before `late`, committed after it (e.g. by a slower worker)
+        store.save(early)
+        seen, _ = page_all(store, cursor, limit=10)
+        assert seen == [early['id']]
+    finally:
+        other.close()
+
+
+def test_legacy_ids_page_by_timestamp(store):
+    old = {'id': 'SOS-1700000000-42', 'location': {'lat': 40.0, 'lon': -74.0}, 'message': 'legacy',
+           'survivors': 1, 'timestamp': time.ctime(1700000000), 'ts': 1700000000000}
+    store.save(old)
+    new = make_ping()
+    store.save(new)
+    pings, cursor = store.query(limit=1)
+    assert pings[0]['id'] == new['id']
+    legacy_cursor = make_cursor(old['ts'], old['id'])
+    assert legacy_cursor == '1700000000000_SOS-1700000000-42'
+    assert parse_cursor(legacy_cursor) == (old['ts'], old['id'])
+    assert [p['id'] for p in store.query(since=legacy_cursor)[0]] == [new['id']]
+    with pytest.raises(ValueError):
+        parse_cursor('not-a-cursor')
+
+
+def test_concurrent_retries_store_one_ping(api):
+    body = {'lat': 40.004, 'lon': -73.996, 'message': 'trapped', 'survivors': 2}
+    headers = {'Idempotency-Key': 'race-1'}
+    with ThreadPoolExecutor(8) as pool:
+        responses = list(pool.map(lambda _: api.post('/sos', json=body, headers=headers), range(16)))
+    assert {r.status_code for r in responses} == {200}
+    ids = {r.json()['id'] for r in responses}
+    assert len(ids) == 1
+    assert sum(1 for r in responses if not r.json().get('duplicate')) == 1
+    stored = api.get('/sos', params={'bbox': '40.003,-73.997,40.005,-73.995'}).json()['sos']
+    assert [p['id'] for p in stored] == list(ids)
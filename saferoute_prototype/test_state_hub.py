@@ -0,0 +1,139 @@
+import json
+import queue
+import socket
+import time
+
+import pytest
+
+import state_hub
+from conftest import wait_for
+from state_hub import StateHub
+
+
+class Worker:
+    """A StateHub with recording callbacks."""
+
+    def __init__(self, path, state=None):
+        self.received = queue.Queue()
+        self.promoted = []
+        self.state = state or {}
+        self.hub = StateHub(path, self.handle, lambda: {'op': 'sync', 'state': dict(self.state)}, self.promoted.append)
+
+    def handle(self, message):
+        self.received.put(message)
+        return message.get('op') == 'relay'
+
+    def next(self, timeout=5.0):
+        return self.received.get(timeout=timeout)
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'hub.sock')
+
+
+@pytest.fixture
+def workers():
+    started = []
+    yield started
+    for w in started:
+        w.hub.stop()
+        if w.hub._lock_file is not None:
+            w.hub._lock_file.close()
+
+
+def start(workers, path, **kw):
+    w = Worker(path, **kw)
+    w.hub.start()
+    workers.append(w)
+    return w
+
+
+def test_standalone_promotes_itself():
+    w = Worker(None)
+    w.hub.start()
+    assert w.hub.role == 'standalone' and w.promoted == [[]]
+    w.hub.send({'op': 'x'})  # goes nowhere
+
+
+def test_one_authority_and_a_synced_replica(workers, path):
+    authority = start(workers, path, state={'version': 7})
+    replica = start(workers, path)
+    assert authority.hub.role == 'authority' and replica.hub.role == 'replica'
+    assert replica.next() == {'op': 'sync', 'state': {'version': 7}}
+    authority.hub.send({'op': 'hazards', 'version': 8})
+    assert replica.next() == {'op': 'hazards', 'version': 8}
+
+
+def test_replica_changes_are_relayed_to_the_others(workers, path):
+    authority = start(workers, path)
+    a, b = start(workers, path), start(workers, path)
+    a.next(), b.next()  # syncs
+    wait_for(lambda: a.hub.stats()['connected'] and b.hub.stats()['connected'])
+    a.hub.send({'op': 'relay', 'n': 1})
+    assert authority.next() == {'op': 'relay', 'n': 1}
+    assert b.next() == {'op': 'relay', 'n': 1}
+    assert a.received.empty()
+
+
+def test_messages_sent_while_disconnected_are_kept(workers, path):
+    replica = Worker(path)
+    replica.hub.send({'op': 'relay', 'n': 1})
+    assert replica.hub.stats()['pending'] == 1
+    authority = start(workers, path)
+    replica.hub.start()
+    workers.append(replica)
+    assert authority.next() == {'op': 'relay', 'n': 1}
+
+
+def connect_silent(path):
+    """A replica that says hello and then never reads."""
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    conn.connect(path)
+    conn.sendall(json.dumps({'op': 'hello', 'pid': 'slow'}).encode() + b'\n')
+    return conn
+
+
+def test_slow_replica_does_not_block_broadcasts(workers, path, monkeypatch):
+    monkeypatch.setattr(state_hub, 'SEND_TIMEOUT', 1.0)
+    authority = start(workers, path)
+    fast = start(workers, path)
+    fast.next()
+    slow = connect_silent(path)
+    wait_for(lambda: authority.hub.stats()['replicas'] == 2)
+    blob = 'x' * 100000
+    started = time.monotonic()
+    for i in range(100):
+        authority.hub.send({'op': 'hazards', 'version': i, 'blob': blob})
+    assert time.monotonic() - started < 1.0
+    assert [fast.next()['version'] for _ in range(100)] == list(range(100))
+    # its sender times out and gives up on it; it would resync on reconnect
+    wait_for(lambda: authority.hub.stats()['dropped'] == 1)
+    assert authority.hub.stats()['replicas'] == 1
+    slow.close()
+
+
+def test_replica_too_far_behind_is_dropped(workers, path, monkeypatch):
+    monkeypatch.setattr(state_hub, 'MAX_PEER_QUEUE', 20)
+    authority = start(workers, path)
+    slow = connect_silent(path)
+    wait_for(lambda: authority.hub.stats()['replicas'] == 1)
+    for i in range(100):
+        authority.hub.send({'op': 'hazards', 'version': i, 'blob': 'x' * 100000})
+    wait_for(lambda: authority.hub.stats()['replicas'] == 0)
+    assert authority.hub.stats()['dropped'] == 1
+    slow.close()
+
+
+def test_replica_takes_over_when_the_authority_exits(workers, path):
+    authority = start(workers, path, state={'version': 3})
+    replica = start(workers, path)
+    replica.next()
+    authority.hub.stop()
+    authority.hub._lock_file.close()  # what process exit does
+    authority.hub._lock_file = None
+    wait_for(lambda: replica.hub.role == 'authority')
+    assert replica.promoted == [[]]
+    late = start(workers, path)
+    assert late.next()['op'] == 'sync'
@@ -0,0 +1,24 @@
+from conftest import grid_point, post_hazard, wait_for
+from state_store import HAZARD_KINDS, HAZARD_TYPE_KINDS, StateStore
+
+
+def test_every_hazard_type_maps_to_a_known_kind():
+    assert set(HAZARD_TYPE_KINDS.values()) <= set(HAZARD_KINDS)
+
+
+def test_set_hazard_reports_changes():
+    store = StateStore()
+    assert store.set_hazard('closed_roads', 'Main St')
+    assert not store.set_hazard('closed_roads', 'Main St')
+    assert store.hazards('closed_roads') == ['Main St']
+    assert store.set_hazard('closed_roads', 'Main St', False)
+    assert store.hazards('closed_roads') == []
+
+
+def test_feed_hazards_are_listed_under_their_kind(api):
+    store = api.module.state_store
+    post_hazard(api, 'kinds-1', [grid_point(2, 1), grid_point(2, 2)], 'blocked', name='Test Closure')
+    wait_for(lambda: 'Test Closure' in store.hazards('closed_roads'))
+    post_hazard(api, 'kinds-1', [grid_point(2, 1), grid_point(2, 2)], 'blocked', name='Test Closure',
+                status='cleared')
+    wait_for(lambda: 'Test Closure' not in store.hazards('closed_roads'))
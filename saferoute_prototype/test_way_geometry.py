@@ -0,0 +1,58 @@
+import asyncio
+
+from loadtest import _query_key
+
+LAT, LON = 45.0, -100.0
+WAY = [[LAT, LON - 0.0005], [LAT, LON + 0.0005]]
+
+
+def spy_overpass(api, monkeypatch):
+    """Route the API's Overpass calls to the stub: the exact-name query answers with a way next to
+    the point at once, the looser name variants stall. Returns (queries sent, queries cancelled)."""
+    module = api.module
+    real = module.upstream.overpass
+    sent, cancelled = [], []
+
+    async def overpass(query, *args, **kwargs):
+        sent.append(query)
+        try:
+            if '"name"~"^' in query:
+                api.stub.recordings.put('overpass', _query_key(query), {'elements': [
+                    {'type': 'way', 'id': 1, 'tags': {'highway': 'residential', 'name': 'Test Way'},
+                     'geometry': [{'lat': lat, 'lon': lon} for lat, lon in WAY]}]})
+            else:
+                await asyncio.sleep(10)
+            return await real(query, *args, **kwargs)
+        except asyncio.CancelledError:
+            cancelled.append(query)
+            raise
+
+    monkeypatch.setattr(module.upstream, 'overpass', overpass)
+    return sent, cancelled
+
+
+def test_first_close_match_wins_and_is_memoized(api, monkeypatch):
+    module = api.module
+    sent, cancelled = spy_overpass(api, monkeypatch)
+    fetch = lambda name: api.portal.call(module.fetch_way_geometry, name, LAT, LON)
+    assert fetch('Memo Way') == WAY
+    assert len(sent) == 3
+    # the stalled name variants were cancelled once the exact match answered
+    api.portal.call(asyncio.sleep, 0.05)
+    assert len(cancelled) == 2 and all('"name"~"^' not in q for q in cancelled)
+    assert fetch('Memo Way') == WAY
+    assert len(sent) == 3
+
+
+def test_memo_is_bounded(api, monkeypatch):
+    module = api.module
+    sent, _ = spy_overpass(api, monkeypatch)
+    monkeypatch.setattr(module, 'WAY_GEOMETRY_MEMO_SIZE', 1)
+    fetch = lambda name: api.portal.call(module.fetch_way_geometry, name, LAT, LON)
+    fetch('First Way')
+    fetch('Second Way')
+    assert len(module.way_geometry_memo) == 1
+    fetch('Second Way')
+    assert len(sent) == 6
+    fetch('First Way')
+    assert len(sent) == 9
@@ -0,0 +1,135 @@
+"""
+Async access to the upstream map services (Nominatim, Overpass, OSRM).
+
+Every call goes through one shared httpx.AsyncClient, so connections are
+pooled and kept alive across requests (HTTP/2 when the ``h2`` package is
+installed) instead of opening a new TLS connection per call. Independent
+calls can be awaited together with asyncio.gather.
+
+Each service also runs under a resilience.Upstream policy: a per-host
+circuit breaker (a failing host is refused in milliseconds instead of
+waiting out the timeout), a token bucket (the public instances' usage
+policies, about 1 request/second; SAFEROUTE_<SERVICE>_RPS overrides, 0
+disables) and, for OSRM, hedged requests.
+"""
+
+import asyncio
+import os
+from typing import List, Optional
+
+import httpx
+
+from metrics import UPSTREAM_SECONDS, count_error
+from resilience import TokenBucket, Upstream
+
+try:
+    import h2  # noqa: F401  (enables HTTP/2 in httpx)
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+# Overridable so a self-hosted instance (or the loadtest.py stubs) can stand in for the public ones
+NOMINATIM_URL = os.environ.get('SAFEROUTE_NOMINATIM_URL', 'https://nominatim.openstreetmap.org/search')
+OVERPASS_URL = os.environ.get('SAFEROUTE_OVERPASS_URL', 'https://overpass-api.de/api/interpreter')
+OSRM_URL = os.environ.get('SAFEROUTE_OSRM_URL', 'https://router.project-osrm.org/route/v1/driving')
+HEADERS = {'User-Agent': 'SafeRoutePrototype/1.0'}
+
+# service -> (default URL, requests/second and burst allowed against it)
+PUBLIC_RATE_LIMITS = {
+    'nominatim': ('https://nominatim.openstreetmap.org/search', 1.0, 1),
+    'overpass': ('https://overpass-api.de/api/interpreter', 1.0, 2),
+    'osrm': ('https://router.project-osrm.org/route/v1/driving', 1.0, 2),
+}
+
+
+def _rate_limit(service: str, url: str) -> Optional[TokenBucket]:
+    """Token bucket for ``service``: the public instance's policy unless overridden by env."""
+    default_url, rate, burst = PUBLIC_RATE_LIMITS[service]
+    env = os.environ.get(f'SAFEROUTE_{service.upper()}_RPS')
+    if env is not None:
+        rate, burst = float(env), max(1, float(env))
+    elif url != default_url:
+        return None
+    return TokenBucket(rate, burst) if rate > 0 else None
+
+
+NOMINATIM = Upstream('nominatim', NOMINATIM_URL, _rate_limit('nominatim', NOMINATIM_URL), max_wait=2.0)
+OVERPASS = Upstream('overpass', OVERPASS_URL, _rate_limit('overpass', OVERPASS_URL), max_wait=3.0)
+OSRM = Upstream('osrm', OSRM_URL, _rate_limit('osrm', OSRM_URL), max_wait=1.0, hedge=True)
+UPSTREAMS = (NOMINATIM, OVERPASS, OSRM)
+
+_client: Optional[httpx.AsyncClient] = None
+_client_loop = None
+
+
+def get_client() -> httpx.AsyncClient:
+    """The shared pooled client, created on first use in the running event loop."""
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client.is_closed or _client_loop is not loop:
+        _client = httpx.AsyncClient(
+            http2=HTTP2,
+            headers=HEADERS,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30),
+            timeout=httpx.Timeout(15.0, connect=5.0),
+        )
+        _client_loop = loop
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def stats() -> dict:
+    return {u.name: {'host': u.breaker.name, 'circuit': u.breaker.state,
+                     'rate_limit': u.bucket.rate if u.bucket else None,
+                     'hedge_delay_s': round(u.hedge_delay(), 3) if u.hedge else None} for u in UPSTREAMS}
+
+
+@UPSTREAM_SECONDS.time(service='nominatim')
+async def nominatim_search(query: str, limit: int = 1, timeout: float = 5,
+                           viewbox: Optional[List[float]] = None) -> List[dict]:
+    """``viewbox`` = [south, west, north, east] restricts results to that box."""
+    params = {'q': query, 'format': 'json', 'limit': limit}
+    if viewbox:
+        south, west, north, east = viewbox
+        params.update(viewbox=f'{west},{north},{east},{south}', bounded=1)
+
+    async def request():
+        r = await get_client().get(NOMINATIM_URL, params=params, timeout=timeout)
+        r.raise_for_status()
+        return r.json()
+    return await NOMINATIM.call(request)
+
+
+@UPSTREAM_SECONDS.time(service='overpass')
+async def overpass(query: str, timeout: float = 15) -> dict:
+    async def request():
+        r = await get_client().post(OVERPASS_URL, data={'data': query}, timeout=timeout)
+        r.raise_for_status()
+        return r.json()
+    return await OVERPASS.call(request)
+
+
+async def osrm_route(origin: List[float], destination: List[float], timeout: float = 10) -> Optional[List[List[float]]]:
+    """Street-level route from OSRM as [lat, lon] pairs, or None if it is unavailable."""
+    try:
+        url = f'{OSRM_URL}/{origin[1]},{origin[0]};{destination[1]},{destination[0]}'
+
+        async def request():
+            r = await get_client().get(url, params={'overview': 'full', 'geometries': 'geojson'}, timeout=timeout)
+            r.raise_for_status()
+            return r.json()
+        with UPSTREAM_SECONDS.time(service='osrm'):
+            data = await OSRM.call(request)
+        if data.get('code') == 'Ok' and data.get('routes'):
+            # OSRM returns [lon, lat] pairs, we need [lat, lon]
+            coords = data['routes'][0]['geometry']['coordinates']
+            return [[pt[1], pt[0]] for pt in coords]
+    except Exception as e:
+        count_error('osrm', e)
+    return None